@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# Memory used by the iSAX tree per indexed time series, as traced by
+# tracemalloc while inserting the SAX words of random walks.  The words
+# themselves are computed before tracing starts, since the database keeps
+# them anyway.
+import sys
+import tracemalloc
+import numpy as np
+from procs import isax_symbols_many
+from tsdb.trees import Tree_Initializer
+
+
+def bytes_per_series(n, threshold=10, wordlength=16, tslen=256, cardinality=64):
+    values = np.cumsum(np.random.randn(n, tslen), axis=1)
+    words = isax_symbols_many(values, cardinality, wordlength)
+    pks = ["ts-{}".format(i) for i in range(n)]
+    tracemalloc.start()
+    tree = Tree_Initializer(threshold=threshold, wordlength=wordlength, cardinality=cardinality).tree
+    for pk, word in zip(pks, words):
+        tree.insert(pk, word)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size/n
+
+
+if __name__ == '__main__':
+    np.random.seed(0)
+    for n in [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]:
+        print("{:>8} series: {:8.1f} bytes per series".format(n, bytes_per_series(n)))
@@ -128,7 +128,7 @@ if __name__=='__main__':
             else:
                 self.master2.destroy()
                 self.master3 = tk.Tk()
-            self.label_1 = tk.Label(self.master3,text="Please enter the file name for the query (as .npy file): ")
+            self.label_1 = tk.Label(self.master3,text="Please enter the file name for the query (a .npy file holding a 2 x N array of times and values): ")
             self.entry = tk.Entry(self.master3)
             self.button1 = tk.Button(self.master3, text="continue", command=self.on_button4)
             self.label_1.pack()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import sys
+import multiprocessing
+from tsdb import TSDBServer, PersistentDB
+
+schema = {
+  'pk': {'type': str, 'index': None},  #will be indexed anyways
+  'ts': {'index': None},
+  'order': {'type': int, 'index': 1},
+  'blarg': {'type': int, 'index': 1},
+  'mean': {'type': float, 'index': 1},
+  'std': {'type': float, 'index': 1},
+  'vp': {'type': bool, 'index': 1}
+}
+
+NUMSHARDS = 4
+SHARDPORT = 10000
+
+
+def shard(i):
+    # Every shard is an ordinary server over its own database
+    db = PersistentDB(schema, 'pk', load=False, overwrite=True, dbname="db_shard{}".format(i))
+    TSDBServer(db, port=SHARDPORT+i).run()
+
+def main(nshards=NUMSHARDS):
+    shards = [multiprocessing.Process(target=shard, args=(i,)) for i in range(nshards)]
+    for process in shards:
+        process.start()
+    try:
+        TSDBServer(None, port=9999, shards=[SHARDPORT+i for i in range(nshards)], pkfield='pk').run()
+    finally:
+        for process in shards:
+            process.terminate()
+
+if __name__=='__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else NUMSHARDS)
@@ -17,7 +17,8 @@ def random_ts(a):
     return ts.TimeSeries(t, v)
 
 def stand(x, m, s):
-    return (x-m)/s
+    "standardize x, given its mean and std; a constant x becomes all zeros"
+    return (x-m)/s if s > 0 else x-m
 
 def ccor(ts1, ts2):
     "given two standardized time series, compute their cross-correlation using FFT"
@@ -40,6 +41,31 @@ def kernel_corr(ts1, ts2, mult=1):
     #your code here.
     return np.sum(np.exp(mult * ccor(ts1,ts2))) / np.sqrt(np.sum(np.exp(mult * ccor(ts1,ts1))) * np.sum(np.exp(mult * ccor(ts2,ts2))))
 
+# Batched versions of the above, for comparing one series against many.  The
+# inverse transforms used by ccor are computed once per series (its
+# "spectrum"), and a whole block of series is transformed with a single FFT
+# call along the last axis.
+def spectra_many(matrix):
+    "standardize each row of a 2d array of series values, and return the inverse FFT of each row"
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    # Constant rows become all zeros, as in stand
+    std = matrix.std(axis=1, keepdims=True)
+    standardized = (matrix - matrix.mean(axis=1, keepdims=True)) / np.where(std > 0, std, 1)
+    return nfft.ifft(standardized, axis=-1)
+
+def self_kernels(spectra, mult=1):
+    "the kernel K(y,y) of each series, given the rows of spectra_many"
+    return np.sum(np.exp(mult * nfft.fft(spectra * np.conj(spectra), axis=-1)), axis=-1)
+
+def kernel_corr_spectra(qspectrum, spectra, mult=1, qkernel=None, kernels=None):
+    "kernel_corr of one series against each row of spectra, as returned by spectra_many"
+    if qkernel is None:
+        qkernel = self_kernels(qspectrum[np.newaxis], mult)[0]
+    if kernels is None:
+        kernels = self_kernels(spectra, mult)
+    cross = np.sum(np.exp(mult * nfft.fft(qspectrum * np.conj(spectra), axis=-1)), axis=-1)
+    return cross / np.sqrt(qkernel * kernels)
+
 
 #this is for a quick and dirty test of these functions
 #you might need to add procs to pythonpath for this to work
@@ -1,7 +1,7 @@
 import timeseries as ts
 import numpy as np
 
-from ._corr import stand, kernel_corr
+from ._corr import stand, kernel_corr, spectra_many, self_kernels, kernel_corr_spectra
 
 import asyncio
 
@@ -40,3 +40,26 @@ def corr_indb(ts1, ts2):
     #since we are normalized the autocorrs are 1
     kerndist = np.sqrt(2*(1-kerncorr)).real
     return kerndist
+
+# Vectorized version of corr_indb: the distances from query (a TimeSeries or
+# array of values) to each row of matrix, a 2d array of series values of the
+# same length, computed with one batched FFT per block of rows
+def corr_many(query, matrix, block=1024):
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    dists = np.empty(matrix.shape[0])
+    for start in range(0, matrix.shape[0], block):
+        spectra, kernels = corr_prepare(matrix[start:start+block])
+        dists[start:start+block] = corr_many_prepared(query, spectra, kernels)
+    return dists
+
+# The part of corr_many which depends only on the stored series: their
+# standardized spectra and self-kernels, which may be computed once and kept
+def corr_prepare(matrix):
+    spectra = spectra_many(matrix)
+    return spectra, self_kernels(spectra, 5)
+
+# corr_many, given the output of corr_prepare for the rows of matrix
+def corr_many_prepared(query, spectra, kernels):
+    qspectrum = spectra_many(np.asarray(getattr(query, 'data', query), dtype=float))[0]
+    kerncorr = kernel_corr_spectra(qspectrum, spectra, 5, kernels=kernels)
+    return np.sqrt(2*(1-kerncorr)).real
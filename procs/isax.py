@@ -52,35 +52,63 @@ async def main(pk, row, arg):
 # Identical to proc_main except for the arguments, intended for
 # use within the database class rather than as a trigger
 def isax_indb(ts1,a,w,switch=0):
+    if switch == 0:
+        return isax_many(np.asarray(ts1.data)[np.newaxis],a,w)[0]
+    return symbols_to_words(sax_symbols(paa_indb(ts1,w,switch)[np.newaxis],a),a)[0]
+
+# The piecewise aggregate approximation of the standardized series, i.e. the
+# w segment means which isax_indb maps to symbols.  With switch=1 the segments
+# are equal spans of time rather than equal numbers of points.
+def paa_indb(ts1, w, switch=0):
+    if switch == 0:
+        return paa_many(np.asarray(ts1.data)[np.newaxis], w)[0]
     series = stand(ts1,ts1.mean(),ts1.std())
-    symbols = ['{0:b}'.format(i).zfill(int(np.log(a-1)/np.log(2))+1) for i in range(a)]
+    times = np.asarray(series.time) - series.time[0]
+    n = times[-1]
+    # Points on a boundary between two segments count towards both
+    starts = np.searchsorted(times, n/w*np.arange(w), side='left')
+    ends = np.searchsorted(times, n/w*np.arange(1, w+1), side='right')
+    sums = np.concatenate(([0.], np.cumsum(series.data)))
+    return w/n*(sums[ends]-sums[starts])
+
+def stand_many(matrix):
+    "Standardize each row of a 2d array of series values; constant rows become all zeros"
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    std = matrix.std(axis=1, keepdims=True)
+    return (matrix - matrix.mean(axis=1, keepdims=True)) / np.where(std > 0, std, 1)
+
+def paa_many(matrix, w):
+    "PAA of each standardized row of a 2d array of series values"
+    matrix = stand_many(matrix)
+    n = matrix.shape[1]
+    if n % w == 0:
+        return matrix.reshape(matrix.shape[0], w, n//w).mean(axis=2)
+    # Uneven segments are summed and scaled by w/n, as in the per-point definition
+    bounds = (n/w*np.arange(w+1)).astype(int)
+    sums = np.concatenate((np.zeros((matrix.shape[0], 1)), np.cumsum(matrix, axis=1)), axis=1)
+    return w/n*(sums[:,bounds[1:]]-sums[:,bounds[:-1]])
+
+def sax_symbols(paa, a):
+    "Map PAA values to symbols 0..a-1; a value equal to a breakpoint takes the lower symbol"
     if a in Breakpoints:
         breakpoints = Breakpoints[a]
-    elif '1' not in '{0:b}'.format(wordlength)[1:]:
+    elif '1' not in '{0:b}'.format(a)[1:]:
         breakpoints = norm.ppf(np.array([i/a for i in range(1,a)]))
     else:
         raise ValueError('Breakpoints do not exist for cardinality {}'.format(a))
-    breakpoints = np.array([*breakpoints,np.inf])
-    T = np.zeros((w))
-    if switch == 0:
-        n = len(series)
-    else:
-        n = series.time[-1]-series.time[0]
-    SAX = []
-    for i in range(w):
-        if switch == 0:
-            T[i] = w/n*sum([series.data[j] for j in range(int(n/w*i),int(n/w*(i+1)))])
-        else:
-            interval = series.data[np.intersect1d(np.where(n/w*(i+1) >= series.time-series.time[0] ),np.where(n/w*i <= series.time-series.time[0]))]
-            T[i] = w/n*sum(interval)
-        for j in range(a):
-            if j == a-1:
-                SAX.append(symbols[j])
-                break
-            if T[i]<=breakpoints[0]:
-                SAX.append(symbols[0])
-                break
-            if T[i]>breakpoints[j] and T[i]<=breakpoints[j+1]:
-                SAX.append(symbols[j+1])
-                break
-    return SAX
+    return np.searchsorted(breakpoints, paa, side='left')
+
+def symbols_to_words(symbols, a):
+    "Convert rows of integer symbols to SAX words, i.e. lists of bit strings"
+    bits = int(np.log(a-1)/np.log(2))+1
+    names = ['{0:b}'.format(i).zfill(bits) for i in range(a)]
+    return [[names[j] for j in row] for row in symbols.tolist()]
+
+def isax_many(matrix, a, w):
+    "The SAX words of cardinality a and length w of each row of a 2d array of series values"
+    return symbols_to_words(sax_symbols(paa_many(matrix, w), a), a)
+
+def isax_symbols_many(matrix, a, w):
+    "Same as isax_many with each word as an array of integer symbols, the form stored in the SAX tree"
+    dtype = np.uint8 if a <= 2**8 else np.uint16
+    return sax_symbols(paa_many(matrix, w), a).astype(dtype)
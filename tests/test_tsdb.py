@@ -1,13 +1,23 @@
 import unittest
+import atexit
+import asyncio
 
 import multiprocessing
 import time
 from timeseries import TimeSeries
-from tsdb.persistentdb import PersistentDB
+from tsdb.persistentdb import PersistentDB, OPMAP
+from tsdb.trees import OrderedIndex
+from tsdb.bitmap import BitmapIndex
 from tsdb.tsdb_client import *
-from tsdb.tsdb_server import TSDBServer
+from tsdb.tsdb_server import TSDBServer, TSDBProtocol, TSDBCoordinatorProtocol, shard_of
+from tsdb.workers import ScoringPool, PARALLEL_MIN
 from tsdb.tsdb_error import *
 import numpy as np
+import os
+import shutil
+import tempfile
+import procs
+from procs.isax import isax_indb, isax_many, isax_symbols_many, paa_many
 from scipy.stats import norm
 
 schema = {
@@ -19,6 +29,14 @@ schema = {
   'vp': {'type': bool, 'index': 1}
 }
 
+# The databases written by the tests live in a temporary directory
+TMPDIR = tempfile.mkdtemp()
+
+atexit.register(shutil.rmtree, TMPDIR, True)
+
+def tmp(filename):
+    return os.path.join(TMPDIR, filename)
+
 def tsmaker(m, s, j):
     "returns metadata and a time series in the shape of a jittered normal"
     t = np.arange(0.0, 1.0, 0.01)
@@ -29,62 +47,62 @@ class MyTest(unittest.TestCase):
     
     def test_badinput(self):
         with self.assertRaises(ValueError):
-            db = PersistentDB({'pk':{'type':int}}, 'pk', dbname='testdb', overwrite=True)
+            db = PersistentDB({'pk':{'type':int}}, 'pk', dbname=tmp('testdb'), overwrite=True)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, threshold='a')
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, threshold='a')
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 12, dbname='testdb', overwrite=True, threshold='a')
+            db = PersistentDB(schema, 12, dbname=tmp('testdb'), overwrite=True, threshold='a')
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, wordlength='a')
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength='a')
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, threshold=-10)
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, threshold=-10)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, wordlength=-10)
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength=-10)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, cardinality=-10)
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, cardinality=-10)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, wordlength=10)
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength=10)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, tslen=300)
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, tslen=300)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, tslen='256')
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, tslen='256')
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, tslen=8)
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, tslen=8)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, cardinality=10.5)
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, cardinality=10.5)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, cardinality=10)
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, cardinality=10)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True, cardinality=128)
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, cardinality=128)
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', load='yes')
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load='yes')
         with self.assertRaises(ValueError):
-            db = PersistentDB(schema, 'pk', dbname='testdb', overwrite='yes')
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite='yes')
         with self.assertRaises(ValueError):
             db = PersistentDB(schema, 'pk', dbname=123, overwrite=True)
 
         with self.assertRaises(ValueError):
-            db = PersistentDB({'pk':{'type':str, 'index':None}, 'DELETE':{'type':bool, 'index':1}}, 'pk', dbname='testdb', overwrite=True)
+            db = PersistentDB({'pk':{'type':str, 'index':None}, 'DELETE':{'type':bool, 'index':1}}, 'pk', dbname=tmp('testdb'), overwrite=True)
         with self.assertRaises(ValueError):
-            db = PersistentDB({'pk':{'type':str, 'index':None}, 'mean:ie':{'type':float, 'index':1}}, 'pk', dbname='testdb', overwrite=True)
+            db = PersistentDB({'pk':{'type':str, 'index':None}, 'mean:ie':{'type':float, 'index':1}}, 'pk', dbname=tmp('testdb'), overwrite=True)
         with self.assertRaises(ValueError):
-            db = PersistentDB({'pk':{'type':str, 'index':None}, 'mean':{'type':dict, 'index':1}}, 'pk', dbname='testdb', overwrite=True)
+            db = PersistentDB({'pk':{'type':str, 'index':None}, 'mean':{'type':dict, 'index':1}}, 'pk', dbname=tmp('testdb'), overwrite=True)
         with self.assertRaises(ValueError):
-            db = PersistentDB([{'type':str, 'index':None}, {'type':float, 'index':1}], 'pk', dbname='testdb', overwrite=True)
+            db = PersistentDB([{'type':str, 'index':None}, {'type':float, 'index':1}], 'pk', dbname=tmp('testdb'), overwrite=True)
         with self.assertRaises(ValueError):
-            db = PersistentDB({'pk':{'type':int, 'index':None}, 'mean':{'type':float, 'index':1}}, 'pk', dbname='testdb', overwrite=True)
+            db = PersistentDB({'pk':{'type':int, 'index':None}, 'mean':{'type':float, 'index':1}}, 'pk', dbname=tmp('testdb'), overwrite=True)
         with self.assertRaises(ValueError):
-            db = PersistentDB({'pk':{'type':str, 'index':None}, 'd_vp-mean':{'type':float, 'index':1}}, 'pk', dbname='testdb', overwrite=True)
+            db = PersistentDB({'pk':{'type':str, 'index':None}, 'd_vp-mean':{'type':float, 'index':1}}, 'pk', dbname=tmp('testdb'), overwrite=True)
         with self.assertRaises(ValueError):
-            db = PersistentDB({'pk':{'type':str, 'index':None}, 'vp':{'type':float, 'index':1}}, 'pk', dbname='testdb', overwrite=True)
+            db = PersistentDB({'pk':{'type':str, 'index':None}, 'vp':{'type':float, 'index':1}}, 'pk', dbname=tmp('testdb'), overwrite=True)
         with self.assertRaises(ValueError):
-            db = PersistentDB({'pk':{'type':str, 'index':None}, 'vp':{'type':bool, 'index':1}}, 'mean', dbname='testdb', overwrite=True)
+            db = PersistentDB({'pk':{'type':str, 'index':None}, 'vp':{'type':bool, 'index':1}}, 'mean', dbname=tmp('testdb'), overwrite=True)
 
 
     def test_db_tsinsert(self):
         ts1 = TimeSeries([1,2,3],[4,5,6])
         ts2 = TimeSeries([1,2,3],[4,5,6])
-        db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True)
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
         db.insert_ts('ts1', ts1)
         with self.assertRaises(ValueError):
             db.insert_ts('ts1', ts2)
@@ -97,16 +115,28 @@ class MyTest(unittest.TestCase):
 
     def test_db_upsertmeta(self):
         ts1 = TimeSeries([1,2,3],[4,5,6])
-        db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True)
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
         with self.assertRaises(ValueError):
             db.upsert_meta('ts1', {'mean':5})
         db.insert_ts('ts1', ts1)
         with self.assertRaises(ValueError):
             db.upsert_meta('ts1', 'mean' == 5)
         db.upsert_meta('ts1', {'mean':5})
+        # Values are stored converted to their schema type, as they are reloaded
+        db.insert_ts('ts2', ts1)
+        db.upsert_meta('ts1', {'vp':'False', 'order':'3', 'mean':'2.5'})
+        db.upsert_meta('ts2', {'vp':True, 'order':4})
+        self.assertEqual([db.rows['ts1'][f] for f in ('vp', 'order', 'mean')], [False, 3, 2.5])
+        self.assertEqual(db.select({'vp':False}, None)[0], ['ts1'])
+        with self.assertRaises(ValueError):
+            db.upsert_meta('ts1', {'order':'three'})
+        self.assertEqual(db.rows['ts1']['order'], 3)
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(newdb.rows['ts1']['vp'], False)
+        self.assertEqual(newdb.rows['ts1']['order'], 3)
 
     def test_db_select(self):
-        db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True)
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
         db.insert_ts('one', TimeSeries([1,2,3],[4,5,6]))
         db.insert_ts('two', TimeSeries([7,8,9],[3,4,5]))
         db.insert_ts('negone', TimeSeries([1,2,3],[-4,-5,-6]))
@@ -144,7 +174,7 @@ class MyTest(unittest.TestCase):
         self.assertEqual(pks, ['two', 'one'])
         
     def test_simsearch(self):
-        db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True)
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
         n_add = 50
         mus = np.random.uniform(low=0.0, high=1.0, size=n_add)
         sigs = np.random.uniform(low=0.05, high=0.4, size=n_add)
@@ -165,8 +195,361 @@ class MyTest(unittest.TestCase):
 
         closest = db.simsearch(query)
 
+        # Pruning with the vantage point bounds must not change the result
+        exact = sorted((db.dist(query, db.rows[pk]['ts']), pk) for pk in db.rows)
+        self.assertEqual(closest, exact[0][1])
+        nearest = db.simsearch(query, k=7)
+        self.assertEqual([pk for pk, d in nearest], [pk for d, pk in exact[:7]])
+        self.assertTrue(np.allclose([d for pk, d in nearest], [d for d, pk in exact[:7]]))
+        self.assertEqual(len(db.simsearch(query, k=100)), n_add)
+        with self.assertRaises(ValueError):
+            db.simsearch(query, k=0)
+        db.close()
+
+        # Nothing is returned if no distance is defined
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, dist=lambda ts1, ts2: np.nan)
+        for i in range(5):
+            db.insert_ts("ts-{}".format(i), tsmaker(0.5, 0.1, 0.1))
+        db.add_vp()
+        self.assertIsNone(db.simsearch(query))
+        self.assertEqual(db.simsearch(query, k=3), [])
+        self.assertEqual(db._candidate_fraction(3), 0.0)
+        db.close()
+
+    def test_range_search(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength=4)
+        for i in range(60):
+            db.insert_ts("ts-{}".format(i), tsmaker(np.random.uniform(), np.random.uniform(0.05, 0.4), np.random.uniform(0.05, 0.2)))
+        query = tsmaker(0.5, 0.2, 0.1)
+        exact = sorted((db.dist(query, db.rows[pk]['ts']), pk) for pk in db.rows)
+        r = (exact[9][0] + exact[10][0]) / 2
+        # Without vantage points every row is scored, with them some are pruned
+        self.assertEqual([pk for pk, d in db.range_search(query, r)], [pk for d, pk in exact[:10]])
+        for i in range(3):
+            db.add_vp()
+        matches = db.range_search(query, r)
+        self.assertEqual([pk for pk, d in matches], [pk for d, pk in exact[:10]])
+        self.assertTrue(np.allclose([d for pk, d in matches], [d for d, pk in exact[:10]]))
+        self.assertEqual(db.range_search(query, 0), [])
+        with self.assertRaises(ValueError):
+            db.range_search(query, -1)
+        # The iSAX variant agrees with a scan by standardized Euclidean distance
+        ts_SAX = db._resample_SAX(query)
+        q = (ts_SAX.data - ts_SAX.mean()) / ts_SAX.std()
+        exact = sorted((np.linalg.norm((row['ts'].data - row['ts'].mean()) / row['ts'].std() - q), pk) for pk, row in db.rows_SAX.items())
+        r = (exact[9][0] + exact[10][0]) / 2
+        self.assertEqual([pk for pk, d in db.range_search(query, r, sax=True)], [pk for d, pk in exact[:10]])
+        op = TSDBOp_RangeSearch(query, 0.5, True)
+        self.assertEqual(TSDBOp.from_json(op.to_json())['r'], 0.5)
+        db.close()
+
+    def test_workers(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength=4)
+        n = PARALLEL_MIN + 44
+        tslist = [tsmaker(np.random.uniform(), np.random.uniform(0.05, 0.4), np.random.uniform(0.05, 0.2)) for i in range(n)]
+        pks = ["ts-{}".format(i) for i in range(n)]
+        db.insert_many(pks, np.array([ts.time for ts in tslist]), np.array([ts.data for ts in tslist]))
+        db.add_vp()
+        query = tsmaker(0.5, 0.2, 0.1)
+        serial = db._dists_to(query, pks)
+        query_SAX = db._resample_SAX(query)
+        standardized = (query_SAX.data - query_SAX.mean()) / query_SAX.std()
+        serial_SAX = db._standardized_dists_to(standardized, pks)
+        server = TSDBServer(db, workers=2)
+        op = TSDBOp_AugmentedSelect('stats', ['mean', 'std'], None, {}, None)
+        try:
+            # Workers map the segments themselves, including records appended after they started
+            self.assertTrue(np.allclose(db._dists_to(query, pks), serial))
+            self.assertTrue(np.allclose(db._standardized_dists_to(standardized, pks), serial_SAX))
+            db.insert_ts("ts-new", query)
+            # The distance of a series to itself is only zero up to rounding
+            self.assertTrue(np.allclose(db._dists_to(query, pks+["ts-new"]), list(serial)+[0], atol=1e-6))
+            self.assertEqual(db.simsearch(query, 5)[0][0], "ts-new")
+            # The server waits for the workers without blocking its loop
+            loop = asyncio.new_event_loop()
+            results = loop.run_until_complete(TSDBProtocol(server)._augmented_select(op))['payload']
+            self.assertEqual(loop.run_until_complete(TSDBProtocol(server)._simsearch(TSDBOp_SimSearch(query, 5)))['payload'],
+                             db.simsearch(query, 5))
+            loop.close()
+            self.assertEqual(len(results), n+1)
+            self.assertAlmostEqual(results["ts-7"]['mean'], tslist[7].mean())
+            self.assertAlmostEqual(results["ts-7"]['std'], tslist[7].std())
+            # A segment recreated under the same name is remapped by the workers
+            db.close()
+            db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
+            db.workers = server.db.workers
+            db.insert_many(pks[::-1], np.array([ts.time for ts in tslist[::-1]]), np.array([ts.data for ts in tslist[::-1]]))
+            self.assertTrue(np.allclose(db._dists_to(query, pks), serial))
+        finally:
+            db.workers.close()
+        with self.assertRaises(ValueError):
+            TSDBServer(db, workers=-1)
+        db.close()
+
+    def test_trigger_lock(self):
+        # The upserts of a trigger wait for the database lock like any request
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        server = TSDBServer(db)
+        protocol = TSDBProtocol(server)
+        protocol._add_trigger(TSDBOp_AddTrigger('stats', 'insert_ts', ['mean', 'std'], None))
+        ts = tsmaker(0.5, 0.1, 0.1)
+        async def insert():
+            async with server.dblock:
+                protocol._insert_ts(TSDBOp_InsertTS('ts-0', ts))
+                protocol._insert_ts(TSDBOp_InsertTS('ts-1', ts))
+                await asyncio.sleep(0.01)
+                self.assertNotIn('mean', db.rows['ts-0'])
+                db.delete_ts('ts-1')
+            while protocol.futures:
+                await asyncio.sleep(0.01)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(insert())
+        loop.close()
+        self.assertAlmostEqual(db.rows['ts-0']['mean'], ts.mean())
+        self.assertAlmostEqual(db.rows['ts-0']['std'], ts.std())
+        self.assertNotIn('ts-1', db.rows)
+        db.close()
+
+    def test_sharded(self):
+        # Two shard servers and their coordinator, all on one event loop
+        loop = asyncio.new_event_loop()
+        dbs = [PersistentDB(schema, 'pk', dbname=tmp('testdb_shard{}'.format(i)), overwrite=True) for i in range(2)]
+        listeners = [loop.run_until_complete(loop.create_server(lambda db=db: TSDBProtocol(TSDBServer(db)), '127.0.0.1', 0)) for db in dbs]
+        ports = [listener.sockets[0].getsockname()[1] for listener in listeners]
+        coordinator = TSDBServer(None, shards=ports)
+        listener = loop.run_until_complete(loop.create_server(lambda: TSDBCoordinatorProtocol(coordinator), '127.0.0.1', 0))
+        port = listener.sockets[0].getsockname()[1]
+        def send(op):
+            response = loop.run_until_complete(request(op.to_json(), port))
+            return TSDBStatus(response['status']), response['payload']
+        try:
+            tslist = [tsmaker(np.random.uniform(), np.random.uniform(0.05, 0.4), np.random.uniform(0.05, 0.2)) for i in range(40)]
+            pks = ["ts-{}".format(i) for i in range(40)]
+            self.assertEqual(send(TSDBOp_InsertMany(pks[:30], tslist[:30], [{'order': i} for i in range(30)]))[0], TSDBStatus.OK)
+            for pk, ts in zip(pks[30:], tslist[30:]):
+                self.assertEqual(send(TSDBOp_InsertTS(pk, ts))[0], TSDBStatus.OK)
+                send(TSDBOp_UpsertMeta(pk, {'order': int(pk[3:])}))
+            # Writes are routed by pk, so a duplicate still reaches the shard holding it
+            self.assertEqual(send(TSDBOp_InsertTS("ts-3", tslist[0]))[0], TSDBStatus.INVALID_KEY)
+            self.assertEqual(sorted(pk for db in dbs for pk in db.rows), sorted(pks))
+            for i, db in enumerate(dbs):
+                self.assertTrue(0 < len(db.rows) < 40)
+                self.assertTrue(all(shard_of(pk, 2) == i for pk in db.rows))
+            self.assertEqual(send(TSDBOp_DeleteTS("ts-39"))[0], TSDBStatus.OK)
+            self.assertEqual(sorted(send(TSDBOp_Select({}, None, None))[1]), sorted(pks[:39]))
+            status, payload = send(TSDBOp_Select({'order': {'<': 10}}, ['order'], {'sort_by': '-order', 'limit': 3}))
+            self.assertEqual(list(payload.items()), [("ts-9", {'order': 9}), ("ts-8", {'order': 8}), ("ts-7", {'order': 7})])
+            status, payload = send(TSDBOp_Select({}, None, {'sort_by': '+order', 'limit': 2}))
+            self.assertEqual(list(payload.items()), [("ts-0", {}), ("ts-1", {})])
+            # A select by pk only goes to the shard holding it
+            status, payload = send(TSDBOp_Select({'pk': "ts-3"}, ['order'], None))
+            self.assertEqual((status, list(payload.items())), (TSDBStatus.OK, [("ts-3", {'order': 3})]))
+            status, payload = send(TSDBOp_AugmentedSelect('stats', ['mean', 'std'], None, {'pk': "ts-36"}, None))
+            self.assertEqual((status, list(payload)), (TSDBStatus.OK, ["ts-36"]))
+            self.assertAlmostEqual(payload["ts-36"]['mean'], tslist[36].mean())
+            status, payload = send(TSDBOp_AugmentedSelect('stats', ['mean', 'std'], None, {}, {'sort_by': '-order', 'limit': 5}))
+            self.assertEqual(list(payload), ["ts-38", "ts-37", "ts-36", "ts-35", "ts-34"])
+            self.assertAlmostEqual(payload["ts-36"]['mean'], tslist[36].mean())
+            self.assertEqual(len(send(TSDBOp_AugmentedSelect('stats', ['mean', 'std'], None, {}, None))[1]), 39)
+            # Searches merge the k nearest of every shard
+            self.assertEqual(send(TSDBOp_AddVP("ts-3"))[0], TSDBStatus.INVALID_OPERATION)
+            self.assertTrue(all(len(db.vps) == 0 for db in dbs))
+            self.assertEqual(send(TSDBOp_AddVP(None))[0], TSDBStatus.OK)
+            self.assertTrue(all(len(db.vps) == 1 for db in dbs))
+            status, (vps, fraction) = send(TSDBOp_ChooseVPs(2))
+            self.assertEqual(sorted(vps), sorted(vp for db in dbs for vp in db.vps[1:]))
+            self.assertTrue(0 <= fraction <= 1)
+            query = tsmaker(0.5, 0.2, 0.1)
+            exact = sorted((procs.corr_indb(query, ts), pk) for pk, ts in zip(pks[:39], tslist))
+            status, payload = send(TSDBOp_SimSearch(query, 5))
+            self.assertEqual([pk for pk, d in payload], [pk for d, pk in exact[:5]])
+            self.assertEqual(send(TSDBOp_SimSearch(query))[1], exact[0][1])
+            r = (exact[5][0] + exact[6][0]) / 2
+            self.assertEqual([pk for pk, d in send(TSDBOp_RangeSearch(query, r))[1]], [pk for d, pk in exact[:6]])
+            status, payload = send(TSDBOp_SimsearchSAX(query.to_json(), 3, True))
+            self.assertEqual(status, TSDBStatus.OK)
+            self.assertEqual(payload, sorted(payload, key=lambda match: match[1]))
+            self.assertEqual(len(payload), 3)
+        finally:
+            listener.close()
+            for shard in listeners:
+                shard.close()
+            loop.close()
+            for db in dbs:
+                db.close()
+        self.assertEqual(TSDBServer(None, shards=ports, pkfield='id').pkfield, 'id')
+        self.assertEqual(TSDBServer(dbs[0]).pkfield, 'pk')
+        with self.assertRaises(ValueError):
+            TSDBServer(dbs[0], shards=ports)
+        with self.assertRaises(ValueError):
+            TSDBServer(None, shards=[])
+
+    def test_corr_many(self):
+        query = tsmaker(0.5, 0.1, 0.1)
+        tslist = [tsmaker(np.random.uniform(), 0.1, 0.1) for i in range(30)]
+        dists = procs.corr_many(query, np.array([t.data for t in tslist]), block=8)
+        self.assertTrue(np.allclose(dists, [procs.corr_indb(query, t) for t in tslist]))
+        # Constant series have a defined distance, in both versions
+        flat = TimeSeries(query.time, np.ones(len(query.time)))
+        with np.errstate(all='raise'):
+            dists = procs.corr_many(flat, np.array([t.data for t in tslist] + [flat.data]))
+            self.assertTrue(np.allclose(dists, [procs.corr_indb(flat, t) for t in tslist + [flat]]))
+        self.assertAlmostEqual(dists[-1], 0)
+
+    def test_spectra(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        for i in range(20):
+            db.insert_ts("ts-{}".format(i), tsmaker(np.random.uniform(), 0.1, 0.1))
+        db.delete_ts("ts-3")
+        db.insert_ts("ts-3", tsmaker(0.5, 0.1, 0.1))
+        db.close()
+        query = tsmaker(0.5, 0.1, 0.1)
+        pks = ["ts-{}".format(i) for i in range(20)]
+        os.remove(tmp('testdb_ts_SAX_spec.seg'))
+        # Missing spectra are recomputed, as are all resampled ones when tslen changes
+        for tslen in [256, 128]:
+            newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True, tslen=tslen)
+            self.assertEqual(len(newdb.specstore), 20)
+            self.assertTrue(np.allclose(newdb._dists_to(query, pks), [procs.corr_indb(query, newdb.rows[pk]['ts']) for pk in pks]))
+            self.assertTrue(all(np.allclose(newdb.rows_SAX[pk]['ts'].data, newdb._resample_SAX(newdb.rows[pk]['ts']).data) for pk in pks))
+            query_SAX = newdb.rows_SAX["ts-0"]['ts']
+            self.assertTrue(np.allclose(newdb._dists_to(query_SAX, pks, sax=True), [procs.corr_indb(query_SAX, newdb.rows_SAX[pk]['ts']) for pk in pks]))
+            newdb.close()
+
+    def test_isax_many(self):
+        matrix = np.random.randn(40, 96)
+        words = isax_many(matrix, 16, 8)
+        for row, word in zip(matrix, words):
+            self.assertEqual(word, isax_indb(TimeSeries(np.arange(96), row), 16, 8))
+        self.assertEqual([len(symbol) for symbol in words[0]], [4]*8)
+        # The integer form stored in the SAX tree
+        symbols = isax_symbols_many(matrix, 16, 8)
+        self.assertEqual(symbols.dtype, np.uint8)
+        self.assertEqual(symbols.tolist(), [[int(symbol, 2) for symbol in word] for word in words])
+        # Uneven segments follow the per-point definition of isax_indb
+        standardized = (matrix - matrix.mean(axis=1, keepdims=True)) / matrix.std(axis=1, keepdims=True)
+        self.assertTrue(np.allclose(paa_many(matrix, 7), [[7/96*np.sum(r[int(96/7*i):int(96/7*(i+1))]) for i in range(7)] for r in standardized]))
+        # Time-based segments, with irregular sampling
+        t = np.sort(np.random.uniform(size=100))
+        ts = TimeSeries(t - t[0], np.random.randn(100))
+        self.assertEqual(len(isax_indb(ts, 8, 4, switch=1)), 4)
+
+    def test_sax_root(self):
+        # Root children only exist for non-empty buckets, even for long words
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength=32, threshold=10)
+        for i in range(20):
+            db.insert_ts("ts-{}".format(i), tsmaker(np.random.uniform(), 0.1, 0.1))
+        root = db.SAX_tree
+        self.assertEqual(sorted(root.children), root.buckets)
+        self.assertEqual(sum(root.bucket_counts.values()), 20)
+        word = db.SAX_words["ts-3"]
+        index = root.root_index(word)
+        for pk in [pk for pk in list(db.rows) if root.root_index(db.SAX_words[pk]) == index]:
+            db.delete_ts(pk)
+        self.assertFalse(index in root.children or index in root.buckets)
+        # The fallback finds the closest non-empty bucket
+        self.assertIsNone(root.search(word))
+        leaf = root.search2(word)
+        self.assertTrue(leaf.ts)
+        self.assertEqual(db.simsearch_SAX(db.rows_SAX[leaf.ts[0]]['ts']), leaf.ts[0])
+        db.close()
+
+    def test_sax_node_layout(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength=4, threshold=5)
+        for i in range(60):
+            db.insert_ts("ts-{}".format(i), tsmaker(np.random.uniform(), 0.1, 0.1))
+        db.delete_ts("ts-7")
+        def nodes(node):
+            yield node
+            for child in list(node.children.values()) + [node.left, node.right]:
+                if child is not None:
+                    yield from nodes(child)
+        rows = []
+        for node in nodes(db.SAX_tree):
+            self.assertFalse(hasattr(node, '__dict__'))
+            if node.parent is None or node.left is not None:
+                self.assertEqual((node.ts, node.row, node.count), ((), None, 0))
+                continue
+            # Leaf statistics in the pool match the words of the leaf
+            rows.append(node.row)
+            if not node.ts:
+                continue
+            values = np.array([node.word2number(word) for word in node.ts_SAX])
+            self.assertEqual(node.count, len(node.ts))
+            self.assertTrue(np.allclose(node.online_mean, values.mean(axis=0)))
+            if len(values) > 1:
+                self.assertTrue(np.allclose(node.online_stdev, values.std(axis=0, ddof=1)))
+        self.assertEqual(len(set(rows)), len(rows))
+        self.assertFalse(set(rows) & set(db.SAX_tree.pool.free))
+        db.close()
+
+    def test_sax_delete_merge(self):
+        with self.assertRaises(ValueError):
+            PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, threshold=5, merge_floor=6)
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength=4, threshold=5, merge_floor=5)
+        for i in range(100):
+            db.insert_ts("ts-{}".format(i), tsmaker(np.random.uniform(), np.random.uniform(0.05, 0.4), np.random.uniform(0.05, 0.2)))
+        def depth(node):
+            return 1 + max([depth(child) for child in list(node.children.values()) + [node.left, node.right] if child is not None] or [0])
+        deep = depth(db.SAX_tree)
+        self.assertTrue(deep > 2)
+        for i in range(96):
+            db.delete_ts("ts-{}".format(i))
+        with self.assertRaises(ValueError):
+            db.SAX_tree.delete(db.SAX_words["ts-99"], "ts-0")
+        # The four survivors end up in leaves merged back up to the root buckets
+        self.assertEqual(depth(db.SAX_tree), 2)
+        pool = db.SAX_tree.pool
+        self.assertEqual(sorted(pool.leaves), sorted(db.rows))
+        for pk, leaf in pool.leaves.items():
+            self.assertIn(pk, leaf.ts)
+            values = np.array([leaf.word2number(word) for word in leaf.ts_SAX])
+            self.assertEqual(leaf.count, len(values))
+            self.assertTrue(np.allclose(leaf.online_mean, values.mean(axis=0)))
+            if len(values) > 1:
+                self.assertTrue(np.allclose(leaf.online_stdev, values.std(axis=0, ddof=1), atol=1e-6))
+        self.assertEqual(db.simsearch_SAX(db.rows_SAX["ts-97"]['ts']), "ts-97")
+        db.close()
+
+    def test_sax_bulk_load(self):
+        def leaves(node):
+            if node.row is not None:
+                yield node
+            for child in list(node.children.values()) + [node.left, node.right]:
+                if child is not None:
+                    yield from leaves(child)
+        def check(db):
+            tree = db.SAX_tree
+            self.assertEqual(sorted(tree.pool.leaves), sorted(db.rows))
+            self.assertEqual(sum(tree.bucket_counts.values()), len(db.rows))
+            for pk, word in db.SAX_words.items():
+                self.assertIs(tree.search(word, pk), tree.pool.leaves[pk])
+            for leaf in leaves(tree):
+                self.assertTrue(leaf.count <= tree.th)
+                if leaf.count > 1:
+                    values = np.array([leaf.word2number(word) for word in leaf.ts_SAX])
+                    self.assertEqual(leaf.count, len(leaf.ts))
+                    self.assertTrue(np.allclose(leaf.online_mean, values.mean(axis=0)))
+                    self.assertTrue(np.allclose(leaf.online_stdev, values.std(axis=0, ddof=1)))
+        tslist = [tsmaker(np.random.uniform(), np.random.uniform(0.05, 0.4), np.random.uniform(0.05, 0.2)) for i in range(200)]
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength=4, threshold=5)
+        for i in range(20):
+            db.insert_ts("ts-{}".format(i), tslist[i])
+        # Batches land on existing leaves, filling some and overflowing others
+        pks = ["ts-{}".format(i) for i in range(20, 200)]
+        db.insert_many(pks[:10], [t.time for t in tslist[20:30]], [t.data for t in tslist[20:30]])
+        db.insert_many(pks[10:], [t.time for t in tslist[30:]], [t.data for t in tslist[30:]])
+        check(db)
+        db.delete_ts("ts-3")
+        db.close()
+        # A tree rebuilt on load after a parameter change is bulk loaded too
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True, wordlength=8, threshold=5)
+        check(newdb)
+        self.assertEqual(newdb.SAX_tree.word_length, 8)
+        newdb.close()
+
     def test_simsearchSAX(self):
-        db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True)
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
         n_add = 50
         mus = np.random.uniform(low=0.0, high=1.0, size=n_add)
         sigs = np.random.uniform(low=0.05, high=0.4, size=n_add)
@@ -180,9 +563,51 @@ class MyTest(unittest.TestCase):
         query = tsmaker(m, s, j)
 
         closest = db.simsearch_SAX(query)
+        self.assertTrue(closest in db.rows)
+
+        # The exact search agrees with a scan over all resampled series, by the 
+        # database's distance or by standardized Euclidean distance
+        ts_SAX = db._resample_SAX(query)
+        exact = sorted((db.dist(ts_SAX, row['ts']), pk) for pk, row in db.rows_SAX.items())
+        nearest = db.simsearch_SAX(query, k=5, exact=True)
+        self.assertEqual([pk for pk, d in nearest], [pk for d, pk in exact[:5]])
+        self.assertTrue(np.allclose([d for pk, d in nearest], [d for d, pk in exact[:5]]))
+        self.assertEqual(db.simsearch_SAX(query, k=5, max_leaves=1000, max_candidates=1000, deadline_ms=60000), nearest)
+        x1 = np.linspace(min(query.time), max(query.time), db.tslen_SAX)
+        q = np.interp(x1, query.time, query.data)
+        q = (q - q.mean()) / q.std()
+        exact = sorted((np.linalg.norm((row['ts'].data - row['ts'].mean()) / row['ts'].std() - q), pk) for pk, row in db.rows_SAX.items())
+        nearest = db.simsearch_SAX(query, k=5, exact=True, standardized=True)
+        self.assertEqual([pk for pk, d in nearest], [pk for d, pk in exact[:5]])
+        self.assertTrue(np.allclose([d for pk, d in nearest], [d for d, pk in exact[:5]]))
+        self.assertEqual(db.simsearch_SAX(query, exact=True, standardized=True), exact[0][1])
+
+        # Budgets stop the same search early; a generous one changes nothing
+        self.assertEqual(db.simsearch_SAX(query, k=5, max_leaves=1000, max_candidates=1000, deadline_ms=60000, standardized=True), nearest)
+        leaf = db.simsearch_SAX(query, k=50, max_leaves=1)
+        self.assertTrue(0 < len(leaf) <= db.threshold)
+        self.assertEqual(len(db.simsearch_SAX(query, k=50, max_candidates=1)), len(leaf))
+        self.assertEqual(len(db.simsearch_SAX(query, k=50, deadline_ms=1e-9)), len(leaf))
+        self.assertTrue(len(db.simsearch_SAX(query, k=50, max_leaves=2)) > len(leaf))
+        for budget in [{'max_leaves':0}, {'max_candidates':2.5}, {'deadline_ms':-1}]:
+            with self.assertRaises(ValueError):
+                db.simsearch_SAX(query, **budget)
+        op = TSDBOp_SimsearchSAX([[1,2], [3,4]], 3, max_leaves=2, deadline_ms=5, standardized=True)
+        self.assertEqual(TSDBOp.from_json(op.to_json()), op)
+
+        # Constant series standardize to zeros, and undefined distances are skipped
+        flat = TimeSeries(query.time, np.ones(len(query.time)))
+        db.insert_ts("ts-flat", flat)
+        for found in (db.simsearch_SAX(flat, k=60, exact=True), db.simsearch_SAX(query, k=60, max_leaves=1000)):
+            self.assertFalse(any(np.isnan(d) for pk, d in found))
+        found = dict(db.simsearch_SAX(flat, k=60, exact=True, standardized=True))
+        self.assertEqual(len(found), 51)
+        self.assertEqual(found.pop("ts-flat"), 0)
+        self.assertTrue(np.allclose(list(found.values()), np.sqrt(db.tslen_SAX)))
+        self.assertAlmostEqual(dict(db.simsearch_SAX(query, k=60, exact=True, standardized=True))["ts-flat"], np.linalg.norm(q))
 
     def test_trees(self):
-        db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True)
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
         n_add = 50
         mus = np.random.uniform(low=0.0, high=1.0, size=n_add)
         sigs = np.random.uniform(low=0.05, high=0.4, size=n_add)
@@ -202,7 +627,7 @@ class MyTest(unittest.TestCase):
             self.assertGreater(row['std'], 2)
 
     def test_load_del(self):
-        db = PersistentDB(schema, 'pk', dbname='testdb', overwrite=True)
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
         n_add = 50
         mus = np.random.uniform(low=0.0, high=1.0, size=n_add)
         sigs = np.random.uniform(low=0.05, high=0.4, size=n_add)
@@ -220,13 +645,436 @@ class MyTest(unittest.TestCase):
         pks, fields = db.select(meta={'vp':True}, fields=None)
         self.assertEqual(len(pks),1)
 
-        newdb = PersistentDB(schema, 'pk', dbname='testdb', load=True)
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
         pks, fields = db.select(meta={}, fields=['mean'])
         self.assertEqual(len(pks), n_add-1)
         self.assertTrue("ts-4" not in pks)
         for i in range(0,n_add-1):
             self.assertEqual(fields[i]['mean'], saveinfo[pks[i]])
 
+    def test_legacy_import(self):
+        # A database in the original layout: a text log and one .npy file per series
+        dbname = tmp('testdb_legacy')
+        os.makedirs(dbname+"_ts", exist_ok=True)
+        series = {}
+        with open(dbname, 'w') as fd:
+            for i in range(5):
+                pk = "ts-{}".format(i)
+                series[pk] = tsmaker(0.5, 0.1, 0.1)
+                np.save(dbname+"_ts/"+pk+"_ts.npy", np.vstack((series[pk].time, series[pk].data)))
+                fd.write(pk+':pk:'+pk+'\n')
+                fd.write(pk+':vp:False\n')
+                fd.write(pk+':mean:'+str(series[pk].mean())+'\n')
+            fd.write('ts-1:vp:True\n')
+            fd.write('ts-0:d_vp-ts-1:0.5\n')
+            fd.write('ts-3:DELETE:0\n')
+        db = PersistentDB(schema, 'pk', dbname=dbname, load=True)
+        self.assertTrue(os.path.exists(dbname+".v0"))
+        self.assertEqual(sorted(db.rows), ['ts-0', 'ts-1', 'ts-2', 'ts-4'])
+        self.assertEqual(db.vps, ['ts-1'])
+        self.assertTrue(np.allclose(db.rows['ts-2']['ts'].data, series['ts-2'].data))
+        self.assertEqual(db.rows['ts-4']['mean'], float(str(series['ts-4'].mean())))
+        self.assertTrue(db.rows['ts-1']['vp'])
+        self.assertFalse(db.rows['ts-0']['vp'])
+        db.close()
+        # The imported database loads in the current layout
+        db = PersistentDB(schema, 'pk', dbname=dbname, load=True)
+        self.assertEqual(sorted(db.rows), ['ts-0', 'ts-1', 'ts-2', 'ts-4'])
+        pks, fields = db.select(meta={'vp':True}, fields=None)
+        self.assertEqual(pks, ['ts-1'])
+        self.assertAlmostEqual(db.vpdists.get('ts-0', 'ts-1'), db.dist(series['ts-0'], series['ts-1']))
+        db.close()
+
+    def test_segments(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        saved = {}
+        for i in range(20):
+            saved["ts-{}".format(i)] = tsmaker(0.5, 0.1, 0.1)
+            db.insert_ts("ts-{}".format(i), saved["ts-{}".format(i)])
+        db.delete_ts("ts-3")
+        db.insert_ts("ts-3", saved["ts-4"])
+        db.delete_ts("ts-5")
+        self.assertEqual(db.tsstore.nrecords, 21)
+        self.assertEqual(len(db.tsstore), 19)
+
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(set(newdb.rows), set(saved) - set(["ts-5"]))
+        self.assertEqual(newdb.rows["ts-3"]['ts'], saved["ts-4"])
+        for pk in newdb.rows:
+            if pk != "ts-3":
+                self.assertEqual(newdb.rows[pk]['ts'], saved[pk])
+            self.assertTrue(np.allclose(newdb.rows_SAX[pk]['ts'].data, db.rows_SAX[pk]['ts'].data))
+        newdb.insert_ts("ts-20", saved["ts-0"])
+        self.assertEqual(newdb.rows["ts-20"]['ts'], saved["ts-0"])
+
+    def test_log(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, commit_records=100, commit_ms=60000)
+        for i in range(10):
+            db.insert_ts("ts-{}".format(i), tsmaker(0.5, 0.1, 0.1))
+            db.upsert_meta("ts-{}".format(i), {'order':i})
+        self.assertEqual(db.log.pending, 30)
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(len(newdb.rows), 0)
+        db.flush()
+        self.assertEqual(db.log.pending, 0)
+        db.delete_ts("ts-0")
+        db.close()
+
+        # A torn final frame is discarded on load and overwritten by the next write
+        with open(tmp('testdb'), 'ab') as fd:
+            fd.write(b'\x10\x00\x00\x00junk')
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(len(newdb.rows), 9)
+        self.assertEqual(newdb.rows["ts-7"]['order'], 7)
+        newdb.upsert_meta("ts-7", {'order':-7})
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(newdb.rows["ts-7"]['order'], -7)
+
+        # commit_records alone batches, and commit_ms bounds how long an idle group waits
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb2'), overwrite=True, commit_records=5)
+        db.insert_ts("ts-0", tsmaker(0.5, 0.1, 0.1))
+        self.assertEqual(db.log.pending, 2)
+        db.insert_ts("ts-1", tsmaker(0.5, 0.1, 0.1))
+        self.assertEqual(db.log.pending, 4)
+        db.insert_ts("ts-2", tsmaker(0.5, 0.1, 0.1))
+        self.assertEqual(db.log.pending, 0)
+        db.close()
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb2'), overwrite=True, commit_records=100, commit_ms=50)
+        db.insert_ts("ts-0", tsmaker(0.5, 0.1, 0.1))
+        self.assertEqual(db.log.pending, 2)
+        time.sleep(0.5)
+        self.assertEqual(db.log.pending, 0)
+        self.assertEqual(len(PersistentDB(schema, 'pk', dbname=tmp('testdb2'), load=True).rows), 1)
+        db.close()
+
+    def test_checkpoint(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, checkpoint_every=40)
+        for i in range(20):
+            db.insert_ts("ts-{}".format(i), tsmaker(0.5, 0.1, 0.1))
+            db.upsert_meta("ts-{}".format(i), {'order':i%5, 'mean':float(i)})
+        self.assertTrue(os.path.exists(tmp('testdb.ckpt')))
+        self.assertLess(db.log.records, 40)
+        db.add_vp("ts-1")
+        db.add_vp("ts-2")
+        db.checkpoint()
+        self.assertEqual(db.log.records, 0)
+        # Changes after the checkpoint are replayed on top of it
+        db.delete_ts("ts-1")
+        db.delete_ts("ts-3")
+        db.upsert_meta("ts-4", {'order':10})
+        db.insert_ts("ts-3", tsmaker(0.5, 0.1, 0.1))
+        db.add_vp("ts-5")
+
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(set(newdb.rows), set(db.rows))
+        self.assertEqual(newdb.vps, db.vps)
+        for pk in db.rows:
+            self.assertEqual(newdb.rows[pk]['ts'], db.rows[pk]['ts'])
+            for field in db.rows[pk]:
+                if field != 'ts':
+                    self.assertEqual(newdb.rows[pk][field], db.rows[pk][field])
+        for meta in [{'order':10}, {'order':{'<':2}}, {'mean':{'>=':3.5}}, {'d_vp-ts-5':{'<=':0.5}}, {'vp':True}]:
+            self.assertEqual(set(newdb.select(meta, None)[0]), set(db.select(meta, None)[0]))
+        self.assertFalse('d_vp-ts-1' in newdb.indexes)
+
+        # A delete which triggers a checkpoint is complete in it
+        deldb = PersistentDB(schema, 'pk', dbname=tmp('testdb2'), overwrite=True, checkpoint_every=1)
+        for i in range(5):
+            deldb.insert_ts("ts-{}".format(i), tsmaker(0.5, 0.1, 0.1))
+        deldb.delete_ts("ts-2")
+        deldb2 = PersistentDB(schema, 'pk', dbname=tmp('testdb2'), load=True)
+        self.assertFalse("ts-2" in deldb2.SAX_words)
+        self.assertEqual(len(deldb2.simsearch_SAX(deldb.rows["ts-1"]['ts'], k=10, exact=True)), 4)
+        deldb.close()
+
+        # Closing checkpoints, so the next load has no log to replay
+        db.close()
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(newdb.log.records, 0)
+        self.assertEqual(set(newdb.rows), set(db.rows))
+        self.assertEqual(newdb.vps, db.vps)
+        self.assertEqual(set(newdb.select({'d_vp-ts-5':{'<=':0.5}}, None)[0]), set(db.select({'d_vp-ts-5':{'<=':0.5}}, None)[0]))
+
+        # Indexes follow the schema the database is loaded with, not the checkpoint
+        newschema = dict(schema, order={'type': int, 'index': 'bitmap'}, mean={'type': float, 'index': None})
+        newdb = PersistentDB(newschema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertTrue(isinstance(newdb.indexes['order'], BitmapIndex))
+        self.assertFalse('mean' in newdb.indexes)
+        self.assertEqual(set(newdb.select({'order':10}, None)[0]), set(db.select({'order':10}, None)[0]))
+        with self.assertRaises(ValueError):
+            newdb.select({'mean':{'>=':3.5}}, None)
+        newdb.close()
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(set(newdb.select({'mean':{'>=':3.5}}, None)[0]), set(db.select({'mean':{'>=':3.5}}, None)[0]))
+
+    def test_saxtree_checkpoint(self):
+        def leafpks(node):
+            pks = list(node.ts)
+            for child in list(node.children.values()) + [node.left, node.right]:
+                if child is not None:
+                    pks += leafpks(child)
+            return pks
+
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True, wordlength=4, threshold=10)
+        for i in range(30):
+            db.insert_ts("ts-{}".format(i), tsmaker(np.random.uniform(), 0.1, 0.1))
+        db.checkpoint()
+        db.delete_ts("ts-0")
+        db.delete_ts("ts-1")
+        db.insert_ts("ts-1", tsmaker(0.5, 0.1, 0.1))
+        db.insert_ts("ts-30", tsmaker(0.5, 0.1, 0.1))
+
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True, wordlength=4, threshold=10)
+        self.assertEqual(sorted(leafpks(newdb.SAX_tree)), sorted(db.rows))
+        self.assertEqual(newdb.SAX_words.keys(), db.SAX_words.keys())
+        for pk in db.SAX_words:
+            self.assertTrue(np.array_equal(newdb.SAX_words[pk], db.SAX_words[pk]))
+        newdb.checkpoint()
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True, wordlength=4, threshold=10)
+        self.assertEqual(sorted(leafpks(newdb.SAX_tree)), sorted(db.rows))
+        self.assertEqual(newdb.simsearch_SAX(db.rows["ts-5"]['ts']), "ts-5")
+
+        # A different cardinality forces the tree to be rebuilt
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True, wordlength=4, threshold=10, cardinality=16)
+        self.assertEqual(sorted(leafpks(newdb.SAX_tree)), sorted(db.rows))
+        self.assertEqual(newdb.SAX_tree.card_bits, 4)
+        self.assertTrue(max(newdb.SAX_words["ts-5"]) < 16)
+
+    def test_orderedindex(self):
+        index = OrderedIndex(load=4)
+        pairs = {}
+        for i in range(300):
+            key = int(np.random.randint(0, 60))
+            index.put(key, "ts-{}".format(i))
+            pairs["ts-{}".format(i)] = key
+        for i in range(0, 300, 3):
+            index.delete(pairs.pop("ts-{}".format(i)), "ts-{}".format(i))
+        with self.assertRaises(KeyError):
+            index.delete(1000, "ts-1")
+        with self.assertRaises(KeyError):
+            index.delete(pairs["ts-1"], "ts-0")
+        self.assertEqual(list(index), sorted(set(pairs.values())))
+        bulk = OrderedIndex.from_pairs([(v, k) for k, v in pairs.items()], load=4)
+        self.assertEqual(list(bulk), list(index))
+        for opkey in OPMAP:
+            for key in [-1, 0, 17, 17.5, 59, 100]:
+                expected = set(pk for pk, v in pairs.items() if OPMAP[opkey](v, key))
+                self.assertEqual(set(index.collect(key, OPMAP[opkey])), expected)
+                self.assertEqual(set(bulk.collect(key, OPMAP[opkey])), expected)
+        self.assertEqual(index.get(17), set(pk for pk, v in pairs.items() if v == 17) or None)
+
+        # Monotonically increasing keys must neither degrade nor recurse
+        index = OrderedIndex()
+        for i in range(20000):
+            index.put(float(i), i)
+        self.assertEqual(len(index.collect(19990.0, OPMAP['>='])), 10)
+
+    def test_str_index(self):
+        strschema = dict(schema, name={'type': str, 'index': 1}, flag={'type': bool, 'index': 1})
+        db = PersistentDB(strschema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        names = ['apple', 'banana', 'cherry', 'date', 'elder', 'fig']
+        for i in range(30):
+            db.insert_ts("ts-{}".format(i), tsmaker(0.5, 0.1, 0.1))
+            db.upsert_meta("ts-{}".format(i), {'name':names[i % 6], 'flag':i % 2 == 0})
+        db.upsert_meta("ts-0", {'name':'cherry'})
+        db.delete_ts("ts-2")
+        for meta in [{'name':{'<':'cherry'}}, {'name':{'>=':'cherry'}}, {'name':{'!=':'date'}},
+                     {'name':'fig'}, {'name':'grape'}, {'flag':False}, {'name':{'<=':'date'}, 'flag':True}]:
+            expected = set(pk for pk, row in db.rows.items()
+                           if all(OPMAP[list(c)[0]](row[f], list(c.values())[0]) if isinstance(c, dict) else row[f] == c
+                                  for f, c in meta.items()))
+            self.assertEqual(set(db.select(meta, None)[0]), expected)
+        newdb = PersistentDB(strschema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(set(newdb.select({'name':{'>':'banana'}}, None)[0]), set(db.select({'name':{'>':'banana'}}, None)[0]))
+
+    def test_select_planner(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        for i in range(200):
+            db.insert_ts("ts-{}".format(i), tsmaker(0.5, 0.1, 0.1))
+            db.upsert_meta("ts-{}".format(i), {'order':i % 3, 'mean':float(i)})
+        self.assertEqual(db.indexes['order'].estimate(OPMAP['=='], 1), 67)
+        self.assertEqual(db.indexes['mean'].estimate(OPMAP['<'], 10.0), 10)
+        self.assertEqual(db.indexes['mean'].estimate(OPMAP['!='], 10.0), 199)
+        queries = [{'order':1, 'mean':{'<':20.0}},
+                   {'mean':{'>=':50.0, '<':60.0}, 'order':{'!=':0}},
+                   {'order':{'<=':1}, 'vp':False, 'mean':{'>':190.0}},
+                   {'order':2, 'mean':{'>':500.0}}]
+        for meta in queries:
+            expected = set()
+            for pk, row in db.rows.items():
+                conds = [(f, c) if isinstance(c, dict) else (f, {'==':c}) for f, c in meta.items()]
+                if all(OPMAP[o](row[f], v) for f, c in conds for o, v in c.items()):
+                    expected.add(pk)
+            self.assertEqual(set(db.select(meta, None)[0]), expected)
+
+    def test_bitmap_index(self):
+        bmschema = dict(schema, order={'type': int, 'index': 'bitmap'}, vp={'type': bool, 'index': 'bitmap'},
+                        blarg={'type': int, 'index': 'bitmap'})
+        db = PersistentDB(bmschema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        for i in range(60):
+            db.insert_ts("ts-{}".format(i), tsmaker(0.5, 0.1, 0.1))
+            db.upsert_meta("ts-{}".format(i), {'order':i % 5, 'blarg':i % 2, 'mean':float(i)})
+        self.assertTrue(isinstance(db.indexes['order'], BitmapIndex))
+        db.add_vp("ts-7")
+        db.checkpoint()
+        db.delete_ts("ts-3")
+        db.upsert_meta("ts-4", {'order':3})
+        db.insert_ts("ts-3", tsmaker(0.5, 0.1, 0.1))
+        db.upsert_meta("ts-3", {'order':0, 'blarg':1})
+        queries = [{'order':3}, {'order':{'>=':3}, 'blarg':1}, {'vp':True}, {'order':{'!=':0}, 'blarg':0, 'mean':{'<':30.0}},
+                   {'order':{'<':2}, 'mean':{'>':50.0}}]
+        newdb = PersistentDB(bmschema, 'pk', dbname=tmp('testdb'), load=True)
+        for meta in queries:
+            expected = set()
+            for pk, row in db.rows.items():
+                conds = [(f, c) if isinstance(c, dict) else (f, {'==':c}) for f, c in meta.items()]
+                if all(f in row and OPMAP[o](row[f], v) for f, c in conds for o, v in c.items()):
+                    expected.add(pk)
+            self.assertEqual(set(db.select(meta, None)[0]), expected)
+            self.assertEqual(set(newdb.select(meta, None)[0]), expected)
+        self.assertEqual(db.indexes['blarg'].estimate(OPMAP['=='], 1), 30)
+        # Building an index at once gives the same bitmaps as row-by-row puts
+        pairs = [(row['order'], pk) for pk, row in db.rows.items() if 'order' in row]
+        bulk = BitmapIndex.from_pairs(db.rowids, pairs)
+        self.assertEqual(list(bulk), list(db.indexes['order']))
+        self.assertEqual(bulk.count, db.indexes['order'].count)
+        for key in bulk:
+            self.assertEqual(bulk.get(key), db.indexes['order'].get(key))
+
+    def test_rowid_compaction(self):
+        bmschema = dict(schema, order={'type': int, 'index': 'bitmap'})
+        db = PersistentDB(bmschema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        for i in range(50):
+            db.insert_ts("ts-{}".format(i), tsmaker(0.5, 0.1, 0.1))
+            db.upsert_meta("ts-{}".format(i), {'order':i % 3})
+        db.add_vp("ts-49")
+        for i in range(0, 49, 2):
+            db.delete_ts("ts-{}".format(i))
+        queries = [{'order':1}, {'order':{'<':2}, 'd_vp-ts-49':{'<':0.5}}]
+        before = [set(db.select(meta, None)[0]) for meta in queries]
+        db.checkpoint()
+        self.assertEqual(len(db.rowids.pks), 25)
+        self.assertEqual(db.vpdists.lower_bounds([0.0]).shape, (25,))
+        newdb = PersistentDB(bmschema, 'pk', dbname=tmp('testdb'), load=True)
+        for meta, expected in zip(queries, before):
+            self.assertEqual(set(db.select(meta, None)[0]), expected)
+            self.assertEqual(set(newdb.select(meta, None)[0]), expected)
+        # Distances logged after the checkpoint use the new row ids
+        db.add_vp("ts-1")
+        newdb = PersistentDB(bmschema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(newdb.select({'d_vp-ts-1':{'<':0.5}}, None)[0], db.select({'d_vp-ts-1':{'<':0.5}}, None)[0])
+
+    def test_insert_many(self):
+        tslist = [tsmaker(0.5, 0.1, 0.1) for i in range(30)]
+        pks = ["ts-{}".format(i) for i in range(30)]
+        metas = [{'order':i%5, 'mean':float(i)} for i in range(30)]
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        db.insert_ts("ts-first", tsmaker(0.5, 0.1, 0.1))
+        db.add_vp("ts-first")
+        db.insert_many(pks, [t.time for t in tslist], [t.data for t in tslist], metas)
+        onebyone = PersistentDB(schema, 'pk', dbname=tmp('testdb2'), overwrite=True)
+        onebyone.insert_ts("ts-first", db.rows["ts-first"]['ts'])
+        onebyone.add_vp("ts-first")
+        for pk, t, meta in zip(pks, tslist, metas):
+            onebyone.insert_ts(pk, t)
+            onebyone.upsert_meta(pk, meta)
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        for pk in pks:
+            self.assertTrue(np.allclose(db.rows_SAX[pk]['ts'].data, onebyone.rows_SAX[pk]['ts'].data))
+            self.assertTrue(np.array_equal(db.SAX_words[pk], onebyone.SAX_words[pk]))
+            self.assertEqual(newdb.rows[pk], db.rows[pk])
+        self.assertEqual(db.select({'order':{'<':2}}, None)[0], onebyone.select({'order':{'<':2}}, None)[0])
+        self.assertEqual(db.select({'d_vp-ts-first':{'<':0.5}}, None)[0], onebyone.select({'d_vp-ts-first':{'<':0.5}}, None)[0])
+        # An invalid batch leaves the database untouched
+        with self.assertRaises(ValueError):
+            db.insert_many(["ts-new", "ts-1"], [tslist[0].time]*2, [tslist[0].data]*2)
+        with self.assertRaises(ValueError):
+            db.insert_many(["ts-new", "ts-new2"], [tslist[0].time]*2, [tslist[0].data]*2, [{}, {'blarg':1}])
+        self.assertFalse("ts-new" in db.rows)
+        # So does one which would put more than threshold identical words, ts-0's among them, in a leaf
+        copies = ["ts-copy{}".format(i) for i in range(db.threshold)]
+        self.assertFalse(db.SAX_tree.overflows([db.SAX_words["ts-0"]]*(db.threshold-1)))
+        with self.assertRaises(ValueError):
+            db.insert_many(copies, [tslist[0].time]*len(copies), [tslist[0].data]*len(copies))
+        self.assertFalse("ts-copy0" in db.rows)
+        self.assertEqual(len(db.tsstore), len(db.rows))
+        db.close()
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(sorted(newdb.rows), sorted(db.rows))
+        newdb.close()
+
+    def test_choose_vps(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        for i in range(120):
+            db.insert_ts("ts-{}".format(i), tsmaker(np.random.uniform(), np.random.uniform(0.05, 0.4), np.random.uniform(0.05, 0.2)))
+        # add_vp without a pk picks a random row
+        db.add_vp()
+        db.add_vp()
+        self.assertTrue(all(db.rows[vp]['vp'] for vp in db.vps))
+        with self.assertRaises(ValueError):
+            db.choose_vps(0)
+        with self.assertRaises(ValueError):
+            db.choose_vps(2, strategy='random')
+        with self.assertRaises(ValueError):
+            db.choose_vps(200)
+        vps, fraction = db.choose_vps(3, sample=60)
+        self.assertEqual(db.vps[2:], vps)
+        self.assertEqual(len(set(db.vps)), 5)
+        self.assertTrue(all(db.rows[vp]['vp'] for vp in vps))
+        # The fraction is the share of the other rows whose lower bound is below a query's nearest neighbour distance
+        self.assertTrue(0 < fraction <= 1)
+        db._candidate_fraction = lambda queries: PersistentDB._candidate_fraction(db, 200)
+        vps, fraction = db.choose_vps(2, strategy='variance')
+        self.assertEqual(len(db.vps), 7)
+        pks = [pk for pk in db.rows if pk not in db.vpdists]
+        expected = []
+        for q in pks:
+            lower = db.vpdists.lower_bounds([db.vpdists.get(q, vp) for vp in db.vps])
+            nearest = min(db.dist(db.rows[q]['ts'], db.rows[pk]['ts']) for pk in db.rows if pk != q)
+            expected.append(np.mean([lower[db.rowids[pk]] < nearest for pk in pks if pk != q]))
+        self.assertAlmostEqual(fraction, np.mean(expected))
+        # Farthest-first starting without vantage points, and simsearch stays exact
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb2'), overwrite=True)
+        for pk in pks[:50]:
+            newdb.insert_ts(pk, db.rows[pk]['ts'])
+        vps, fraction = newdb.choose_vps(4)
+        self.assertEqual(newdb.vps, vps)
+        query = tsmaker(0.5, 0.2, 0.1)
+        exact = sorted((newdb.dist(query, row['ts']), pk) for pk, row in newdb.rows.items())
+        self.assertEqual([pk for pk, d in newdb.simsearch(query, 3)], [pk for d, pk in exact[:3]])
+        op = TSDBOp_ChooseVPs(4, 'variance')
+        self.assertEqual(TSDBOp.from_json(op.to_json())['strategy'], 'variance')
+        db.close()
+        newdb.close()
+
+    def test_vp_distances(self):
+        db = PersistentDB(schema, 'pk', dbname=tmp('testdb'), overwrite=True)
+        for i in range(40):
+            db.insert_ts("ts-{}".format(i), tsmaker(np.random.uniform(), 0.1, 0.1))
+            db.upsert_meta("ts-{}".format(i), {'order':i%5})
+        db.add_vp("ts-0")
+        db.add_vp("ts-1")
+        db.checkpoint()
+        db.add_vp("ts-2")
+        db.insert_ts("ts-new", tsmaker(0.5, 0.1, 0.1))
+        db.delete_ts("ts-1")
+        db.delete_ts("ts-5")
+        self.assertEqual(db.vps, ["ts-0", "ts-2"])
+        self.assertEqual(db.vpdists.column("ts-0").shape, (41,))
+        newdb = PersistentDB(schema, 'pk', dbname=tmp('testdb'), load=True)
+        self.assertEqual(newdb.vps, db.vps)
+        for pk in db.rows:
+            for vp in db.vps:
+                self.assertAlmostEqual(newdb.vpdists.get(pk, vp), db.dist(db.rows[vp]['ts'], db.rows[pk]['ts']))
+        # Distance predicates are combined with indexed ones
+        meta = {'d_vp-ts-2':{'<':0.6, '>':0.1}, 'order':{'<=':2}}
+        expected = set(pk for pk in db.rows if 0.1 < db.vpdists.get(pk, 'ts-2') < 0.6 and 'order' in db.rows[pk] and db.rows[pk]['order'] <= 2)
+        self.assertEqual(set(newdb.select(meta, None)[0]), expected)
+        pks, fields = newdb.select({'pk':'ts-7'}, ['order', 'd_vp-ts-0'])
+        self.assertEqual(fields[0], {'order':2, 'd_vp-ts-0':db.vpdists.get('ts-7', 'ts-0')})
+        with self.assertRaises(ValueError):
+            newdb.select({'d_vp-ts-1':{'<':0.5}}, None)
+
     ############## TEST WORKS ON LOCAL MACHINE BUT NOT IN TRAVIS #################################
     #def test_client_ops(self):
     #    schema["d_t3"] = {'convert': float, 'index': 1}
@@ -0,0 +1,161 @@
+import numpy as np
+from collections import defaultdict
+
+# Bitmap indexes for low-cardinality metadata fields.  Every row of the
+# database gets a dense integer row id, and an index keeps one bitmap per
+# distinct value with bit i set if row i holds that value.  Bitmaps are numpy
+# uint8 arrays, bit i being bit i%8 of byte i//8: one bit per row rather than
+# a set entry per primary key, a single row is set or cleared in place, and
+# AND/OR of predicates are vectorized over the bytes.
+
+
+def nbytes(nrows):
+    "Length of a bitmap over nrows row ids"
+    return (nrows+7)//8
+
+
+class RowIds:
+    "Dense integer row ids for primary keys, shared by the bitmap indexes of a database"
+
+    def __init__(self):
+        self.ids = {}
+        self.pks = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, pk):
+        return pk in self.ids
+
+    def __getitem__(self, pk):
+        return self.ids[pk]
+
+    def add(self, pk):
+        "Assign the next row id to pk"
+        self.ids[pk] = len(self.pks)
+        self.pks.append(pk)
+        return self.ids[pk]
+
+    def remove(self, pk):
+        "Retire the row id of pk; its id is only reclaimed by compact"
+        self.pks[self.ids.pop(pk)] = None
+
+    def compact(self):
+        """
+        Renumbers the live pks densely, in their current order, dropping the
+        retired ids.  Returns the array of old row ids of the new ones, for
+        remapping whatever is addressed by row id.
+        """
+        old = np.array([rid for rid, pk in enumerate(self.pks) if pk is not None], dtype=np.intp)
+        self.pks = [self.pks[rid] for rid in old.tolist()]
+        self.ids = {pk:rid for rid, pk in enumerate(self.pks)}
+        return old
+
+    def decode(self, bitmap):
+        "Return the set of pks whose bits are set in bitmap"
+        pks = self.pks
+        return set(pks[rid] for rid in np.flatnonzero(np.unpackbits(bitmap, bitorder='little')).tolist())
+
+
+class BitmapIndex:
+    """
+    Index mapping each distinct value of a field to a bitmap of row ids.
+    Offers the put/get/delete/lookup/estimate surface of OrderedIndex, plus
+    bitmap(), which returns the matching rows as a bitmap for combining
+    several predicates with bitwise AND before decoding.
+    """
+
+    def __init__(self, rowids):
+        self.rowids = rowids
+        self._bitmaps = {}
+        self._counts = {}
+        self.count = 0   # number of (key, value) pairs
+
+    @classmethod
+    def from_pairs(cls, rowids, pairs):
+        "Build an index from (key, pk) pairs, with one packed bitmap per key"
+        index = cls(rowids)
+        rids = defaultdict(list)
+        for key, pk in pairs:
+            rids[key].append(rowids[pk])
+        nrows = len(rowids.pks)
+        for key, keyrids in rids.items():
+            mask = np.zeros(nrows, dtype=bool)
+            mask[keyrids] = True
+            index._bitmaps[key] = np.packbits(mask, bitorder='little')
+            index._counts[key] = int(np.count_nonzero(mask))
+            index.count += index._counts[key]
+        return index
+
+    def __len__(self):
+        return len(self._bitmaps)
+
+    def __iter__(self):
+        return iter(sorted(self._bitmaps))
+
+    def __contains__(self, key):
+        return key in self._bitmaps
+
+    def _bit(self, key, pk):
+        # The bitmap of key, grown geometrically to hold the row id of pk, with the byte and mask of its bit
+        rid = self.rowids[pk]
+        bitmap = self._bitmaps.get(key)
+        if bitmap is None or rid//8 >= len(bitmap):
+            grown = np.zeros(max(nbytes(rid+1), 0 if bitmap is None else 2*len(bitmap)), dtype=np.uint8)
+            if bitmap is not None:
+                grown[:len(bitmap)] = bitmap
+            bitmap = self._bitmaps[key] = grown
+        return bitmap, rid//8, np.uint8(1 << (rid%8))
+
+    def put(self, key, pk):
+        bitmap, byte, bit = self._bit(key, pk)
+        if not bitmap[byte] & bit:
+            bitmap[byte] |= bit
+            self._counts[key] = self._counts.get(key, 0) + 1
+            self.count += 1
+
+    def get(self, key):
+        if key in self._bitmaps:
+            return self.rowids.decode(self._bitmaps[key])
+        return None
+
+    def delete(self, key, pk=None):
+        if key not in self._bitmaps:
+            raise KeyError('Error, key not in index')
+        if pk is None:
+            self.count -= self._counts.pop(key)
+            del self._bitmaps[key]
+            return
+        bitmap, byte, bit = self._bit(key, pk)
+        if not bitmap[byte] & bit:
+            raise KeyError('Error, key-value pair not in index')
+        bitmap[byte] ^= bit
+        self._counts[key] -= 1
+        self.count -= 1
+        if self._counts[key] == 0:
+            del self._bitmaps[key]
+            del self._counts[key]
+
+    def remap(self, old):
+        "Renumber the bitmaps after RowIds.compact, old holding the old row id of every new one"
+        for key, bitmap in self._bitmaps.items():
+            bits = np.unpackbits(bitmap, bitorder='little')
+            inrange = old < len(bits)
+            mask = np.zeros(len(old), dtype=bool)
+            mask[inrange] = bits[old[inrange]]
+            self._bitmaps[key] = np.packbits(mask, bitorder='little')
+
+    def bitmap(self, op, key):
+        "Return the OR of the bitmaps of all keys k for which op(k, key) holds, over all row ids"
+        result = np.zeros(nbytes(len(self.rowids.pks)), dtype=np.uint8)
+        for k, bitmap in self._bitmaps.items():
+            if op(k, key):
+                n = min(len(bitmap), len(result))
+                result[:n] |= bitmap[:n]
+        return result
+
+    def lookup(self, op, key):
+        return self.rowids.decode(self.bitmap(op, key))
+
+    def estimate(self, op, key):
+        return sum(c for k, c in self._counts.items() if op(k, key))
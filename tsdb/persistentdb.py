@@ -11,9 +11,18 @@ sys.path.insert(0, '../')
 from timeseries import TimeSeries
 import os
 import procs
-from procs.isax import isax_indb
+from procs.isax import isax_symbols_many, paa_indb, stand_many
 import random
-from .trees import BinarySearchTree, Tree_Initializer
+import pickle
+import heapq
+import itertools
+import time
+from .trees import OrderedIndex, Tree_Initializer
+from .segments import SegmentStore
+from .wal import WriteAheadLog, MAGIC
+from .bitmap import RowIds, BitmapIndex
+from .vptable import VPTable, encode_column, decode_column
+from .workers import PARALLEL_MIN, corr_chunk, standardized_chunk, unpack_spectra
 
 OPMAP = {
     '<': operator.lt,
@@ -23,11 +32,46 @@ OPMAP = {
     '<=': operator.le,
     '>=': operator.ge
 }
+
+# simsearch scores its candidates in batches of this many, so that batched
+# distance functions are used while still stopping early
+SIMSEARCH_BATCH = 32
+
+# Rows are read from the segments and compared to a query in blocks of this many
+DIST_BLOCK = 1024
+
+
+class _Nearest:
+    "The k closest primary keys offered so far, kept in a max-heap of (-distance, pk)"
+
+    def __init__(self, k):
+        self.k = k
+        self._heap = []
+
+    def bound(self):
+        "The distance a pk must beat to be kept, inf until k pks have been offered"
+        if len(self._heap) < self.k:
+            return np.inf
+        return -self._heap[0][0]
+
+    def offer(self, pk, dist):
+        # A distance which is undefined (NaN) cannot be ranked
+        if dist != dist:
+            return
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, (-dist, pk))
+        elif dist < -self._heap[0][0]:
+            heapq.heapreplace(self._heap, (-dist, pk))
+
+    def result(self):
+        "The kept pks as (pk, distance) tuples, closest first"
+        return [(pk, -negdist) for negdist, pk in sorted(self._heap, reverse=True)]
                              
 class PersistentDB:
     "Database implementation with a local dictionary, which saves all necessary data to files for later use"
 
-    def __init__(self, schema, pkfield, load=False, dbname="db", overwrite=False, dist=procs.corr_indb, threshold = 10, wordlength = 16, tslen = 256, cardinality = 64):
+    def __init__(self, schema, pkfield, load=False, dbname="db", overwrite=False, dist=procs.corr_indb, threshold = 10, wordlength = 16, tslen = 256, cardinality = 64,
+                 commit_records = 1, commit_ms = 0, fsync = False, checkpoint_every = None, merge_floor = None):
         """
         Parameters
         ----------
@@ -46,14 +90,33 @@ class PersistentDB:
             If load=False, whether to overwrite an existing database.
         dist : function
             Calculates the distance between two TimeSeries objects, must take arguments (ts1, ts2)
+        commit_records : int
+            Group commit: the log is written out once this many records are pending...
+        commit_ms : int or float
+            ... or once the oldest pending record is this many milliseconds old,
+            which a timer enforces even if no further write comes.  If 0, 
+            only commit_records bounds the group.
+            Pending records are always written by flush() and close().
+        fsync : bool
+            Whether each log write is followed by an fsync
+        checkpoint_every : int or None
+            If not None, checkpoint() is called once the log holds this many records.
+            close() also checkpoints, if the log holds any records.
+        merge_floor : int or None
+            Sibling leaves of the iSAX tree are merged back into their parent once
+            they hold fewer than this many series together (default threshold//2)
         Attributes
         ----------
         indexes : dict
             Key = fieldname
-            Value = binary search tree (if int or float) or dictionary of sets (otherwise) mapping values to pks
+            Value = ordered index mapping values to sets of pks
         rows : dict
             Key = primary key
             Value = dict of the fields associated with each key
+        vpdists : VPTable
+            Distances of every row to every vantage point, queried as the fields d_vp-<vp>
+        workers : ScoringPool or None
+            If set, batches of at least PARALLEL_MIN candidates are scored by its worker processes
         schema : dict (See above)
         pkfield : str (See above)
         dbname : str (See above)
@@ -73,6 +136,8 @@ class PersistentDB:
             raise ValueError("Word length must be greater than zero")
         if '1' in '{0:b}'.format(wordlength)[1:]:
             raise ValueError("Word length must be a power of two")
+        if wordlength > 32:
+            raise ValueError("Word lengths greater than 32 are not supported")
         if not isinstance(tslen, int):
             raise ValueError("TimeSeries length must be of type int")
         if tslen < wordlength:
@@ -93,10 +158,20 @@ class PersistentDB:
             raise ValueError("Database name must be string")
         if not isinstance(overwrite, bool):
             raise ValueError("Overwrite must be of type bool")
+        if not isinstance(commit_records, int) or commit_records <= 0:
+            raise ValueError("Commit records must be a positive int")
+        if not isinstance(commit_ms, (int, float)) or commit_ms < 0:
+            raise ValueError("Commit interval must be a non-negative number")
+        if not isinstance(fsync, bool):
+            raise ValueError("Fsync must be of type bool")
+        if checkpoint_every is not None and (not isinstance(checkpoint_every, int) or checkpoint_every <= 0):
+            raise ValueError("Checkpoint interval must be a positive int or None")
+        if merge_floor is not None and (not isinstance(merge_floor, int) or merge_floor < 0 or merge_floor > threshold):
+            raise ValueError("Merge floor must be an int between zero and the threshold, or None")
         if isinstance(schema, dict):
             for field in schema:
-                if field == 'DELETE':
-                    raise ValueError("The fieldname 'DELETE' is forbidden")
+                if field in ('DELETE', 'd_vp'):
+                    raise ValueError("The fieldname '{}' is forbidden".format(field))
                 if ':' in field:
                     raise ValueError("Field names may not contain the ':' character")
                 if field != 'ts':   
@@ -118,10 +193,12 @@ class PersistentDB:
         # Assign attributes according to schema
         self.indexes = {}
         self.rows = {}
+        self.rowids = RowIds()
         self.rows_SAX = {}
         self.wordlength = wordlength
         self.threshold = threshold
-        self.SAX_tree = Tree_Initializer(threshold = threshold, wordlength = wordlength).tree    
+        self.SAX_tree = Tree_Initializer(threshold = threshold, wordlength = wordlength, cardinality = cardinality, merge_floor = merge_floor).tree    
+        self.SAX_words = {}
         self.card = cardinality
         self.schema = schema
         self.dbname = dbname
@@ -130,75 +207,307 @@ class PersistentDB:
         self.tslen_SAX = tslen
         self.overwrite = overwrite
         self.dist = dist
-        self.vps = []
+        self.vpdists = VPTable(self.rowids)
+        self.vps = self.vpdists.vps
+        self.tsstore = None
+        self.saxstore = None
+        self.specstore = None
+        self.saxspecstore = None
+        self.workers = None
+        self.log = None
+        self.logoptions = {'commit_records':commit_records, 'commit_ms':commit_ms, 'fsync':fsync}
+        self.checkpoint_every = checkpoint_every
         for s in schema:
-            indexinfo = schema[s]['index']
-            if indexinfo is not None:
-                if schema[s]['type'] == int or schema[s]['type'] == float:
-                    self.indexes[s] = BinarySearchTree()
-                else:  # Add a bitmask option for strings?
-                    self.indexes[s] = defaultdict(set)
+            index = self._new_index(s)
+            if index is not None:
+                self.indexes[s] = index
 
         if load:   
             try:
-                fd = open(dbname)
-                for l in fd.readlines():
-                    [pk, field, val] = l.strip().split(":")
-                    if field in self.schema:
-                        if pk not in self.rows:
-                            self.rows[pk] = {pkfield:pk}
-                        else:
-                            if self.schema[field]['type'] == bool:
-                                if val == 'False': 
-                                    self.rows[pk][field] = False
-                                else:
-                                    self.rows[pk][field] = True
-                            else:
-                                self.rows[pk][field] = self.schema[field]['type'](val)
-                        if pk not in self.rows_SAX:
-                            self.rows_SAX[pk] = {pkfield:pk}
-                        else:
-                            if self.schema[field]['type'] == bool:
-                                if val == 'False': 
-                                    self.rows_SAX[pk][field] = False
-                                else:
-                                    self.rows_SAX[pk][field] = True
-                            else:
-                                self.rows_SAX[pk][field] = self.schema[field]['type'](val)
-                        if field == 'vp' and val == 'True':
-                            self.vps.append(pk)
-                            self.indexes['d_vp-'+pk] = BinarySearchTree()
-                    elif field == 'DELETE':
-                        if 'vp' in schema and self.rows[pk]['vp'] == True:
-                            self.del_vp(pk)
-                        del self.rows[pk]
-                        del self.rows_SAX[pk]
-                    elif field[:5] == 'd_vp-':
-                        self.rows[pk][field] = float(val)
-                    else:
-                        raise IOError("Database is incompatible with input schema")
-                fd.close()
-                
-                # Read in timeseries of non-deleted keys
-                for pk in self.rows:
-                    tsarray = np.load(self.dbname+"_ts/"+pk+"_ts.npy")
-                    self.rows[pk]['ts'] = TimeSeries(tsarray[0,:], tsarray[1,:])
-                    self.tslen = tsarray.shape[1]
-                    #tsarray2 = np.load(self.dbname+"_ts_SAX/"+pk+"_ts_SAX.npy")
-                    x1 = np.linspace(min(tsarray[0,:]),max(tsarray[0,:]), self.tslen_SAX)
-                    ts_SAX_data = interp1d(tsarray[0,:], tsarray[1,:])(x1)
-                    ts_SAX_time = x1
-                    ts_SAX = TimeSeries(ts_SAX_time,ts_SAX_data)
-                    self.rows_SAX[pk]['ts'] = ts_SAX
-                    rep = isax_indb(ts_SAX,self.card,self.wordlength)
-                    self.SAX_tree.insert(pk, rep)
-                self.index_bulk(list(self.rows.keys()))
+                self._load()
             except:
                 raise IOError("Database does not exist or has been corrupted")
         else:
             if os.path.exists(dbname) and overwrite == False:
                 raise ValueError("Database of that name already exists. Delete existing db, rename, or set overwrite=True.")
 
+    def _new_index(self, field):
+        # An empty index of the kind the schema asks for on field, or None
+        indexinfo = self.schema[field]['index']
+        if indexinfo == 'bitmap':
+            return BitmapIndex(self.rowids)
+        elif indexinfo is not None:
+            return OrderedIndex()
+        return None
+
+    def _load(self):
+        """ Restores the latest checkpoint, if any, and replays the log written after it """
+        with open(self.dbname, 'rb') as fd:
+            header = fd.read(len(MAGIC))
+        if header != MAGIC and os.path.isdir(self.dbname+"_ts"):
+            return self._import_legacy()
+        self.log = WriteAheadLog(self.dbname, **self.logoptions)
+        generation = 0
+        touched = None
+        deleted = set()
+        # Indexes the schema asks for which the checkpoint lacks, or holds as another kind
+        rebuild = {}
+        if os.path.exists(self.dbname+".ckpt"):
+            with open(self.dbname+".ckpt", 'rb') as fd:
+                ckpt = pickle.load(fd)
+            generation = ckpt['generation']
+            self.rows = ckpt['rows']
+            self.vpdists = ckpt['vpdists']
+            self.vps = self.vpdists.vps
+            self.rowids = ckpt['rowids']
+            # Checkpointed indexes are only reused if the schema still asks for them
+            self.indexes = {}
+            for field in self.schema:
+                index = self._new_index(field)
+                if index is None:
+                    continue
+                if type(ckpt['indexes'].get(field)) is type(index):
+                    self.indexes[field] = ckpt['indexes'][field]
+                else:
+                    rebuild[field] = index
+            for pk, row in self.rows.items():
+                self.rows_SAX[pk] = row.copy()
+            # The iSAX tree is only reused if it was built with the same parameters
+            if ckpt['sax']['params'] == self._sax_params():
+                merge_floor = self.SAX_tree.pool.merge_floor
+                self.SAX_tree = ckpt['sax']['tree']
+                self.SAX_tree.pool.merge_floor = merge_floor
+                self.SAX_words = ckpt['sax']['words']
+            # Rows changed by the log tail, mapped to their checkpointed state
+            touched = {}
+        if self.log.generation > generation:
+            raise IOError("Database log is newer than its checkpoint")
+        elif self.log.generation == generation:
+            for pk, field, val in self.log.replay():
+                if touched is not None and pk not in touched:
+                    touched[pk] = self.rows[pk].copy() if pk in self.rows else None
+                if field == 'DELETE':
+                    deleted.add(pk)
+                    # Unindex a checkpointed row while its row id is still known
+                    if touched is not None and touched[pk] is not None:
+                        self.unindex(pk, touched[pk])
+                        touched[pk] = None
+                self._replay(pk, field, val)
+        else:
+            # The last checkpoint was written, but its log was never truncated
+            self.log.close()
+            self.log = WriteAheadLog(self.dbname, overwrite=True, generation=generation, **self.logoptions)
+
+        # Drop series deleted after the checkpoint from the restored iSAX tree
+        for pk in deleted:
+            if pk in self.SAX_words:
+                self.SAX_tree.delete(self.SAX_words.pop(pk), pk)
+
+        # Map the timeseries segments and read in non-deleted keys
+        resample = False
+        if os.path.exists(self.dbname+"_ts.seg"):
+            self.tsstore = SegmentStore(self.dbname+"_ts.seg")
+            self.saxstore = SegmentStore(self.dbname+"_ts_SAX.seg")
+            self.tslen = self.tsstore.shape[1]
+            # Resampled series are only reused if tslen has not changed
+            resample = self.saxstore.shape[1] != self.tslen_SAX
+            if resample:
+                self.saxstore.close()
+                self.saxstore = SegmentStore(self.dbname+"_ts_SAX.seg", shape=(2, self.tslen_SAX), overwrite=True)
+        # Rows are read, and if need be resampled and appended, in blocks, so 
+        # that the resampled segment is not remapped after every append
+        pks = list(self.rows)
+        for start in range(0, len(pks), DIST_BLOCK):
+            block = pks[start:start+DIST_BLOCK]
+            tsarrays = self.tsstore.get_many(block)
+            if resample:
+                times_SAX, values_SAX = self._resample_many(tsarrays[:,0,:], tsarrays[:,1,:])
+                saxarrays = np.stack((times_SAX, values_SAX), axis=1)
+                self.saxstore.append_many(block, saxarrays)
+            else:
+                saxarrays = self.saxstore.get_many(block)
+            for pk, tsarray, saxarray in zip(block, tsarrays, saxarrays):
+                self.rows[pk]['ts'] = TimeSeries(tsarray[0,:], tsarray[1,:])
+                self.rows_SAX[pk]['ts'] = TimeSeries(saxarray[0,:], saxarray[1,:])
+        # SAX words missing from the checkpoint are encoded in blocks, then bulk loaded
+        missing = [pk for pk in self.rows if pk not in self.SAX_words]
+        reps = [isax_symbols_many(self.saxstore.get_many(missing[start:start+DIST_BLOCK])[:,1,:], self.card, self.wordlength)
+                for start in range(0, len(missing), DIST_BLOCK)]
+        if missing:
+            reps = np.concatenate(reps)
+            self.SAX_tree.insert_many(missing, reps)
+            self.SAX_words.update(zip(missing, reps))
+        if self.tsstore is not None:
+            self.specstore = self._open_spectra(self.dbname+"_ts_spec.seg", self.tsstore, False)
+            self.saxspecstore = self._open_spectra(self.dbname+"_ts_SAX_spec.seg", self.saxstore, resample)
+
+        if touched is None:
+            self.index_bulk(list(self.rows.keys()))
+        else:
+            # Only the rows changed since the checkpoint need reindexing
+            for pk, oldrow in touched.items():
+                if oldrow is not None:
+                    self.unindex(pk, oldrow)
+                if pk in self.rows:
+                    self.update_indices(pk)
+            if rebuild:
+                self.indexes.update(rebuild)
+                self.index_bulk(list(self.rows.keys()), rebuild)
+
+    def _import_legacy(self):
+        # One-time import of a database written in the original layout: a text
+        # log of pk:field:val lines, with each series in dbname_ts/pk_ts.npy.
+        # The text log is kept as dbname.v0, and the distances to vantage points
+        # are recomputed rather than read back
+        metas = OrderedDict()
+        vps = []
+        with open(self.dbname) as fd:
+            for l in fd:
+                [pk, field, val] = l.rstrip('\n').split(':', 2)
+                if field in self.schema:
+                    # The first record of a pk only creates its row
+                    if pk not in metas:
+                        metas[pk] = {}
+                    elif field == 'vp':
+                        if val != 'False' and pk not in vps:
+                            vps.append(pk)
+                        elif val == 'False' and pk in vps:
+                            vps.remove(pk)
+                    elif field != 'ts':
+                        metas[pk][field] = val
+                elif field == 'DELETE':
+                    del metas[pk]
+                    if pk in vps:
+                        vps.remove(pk)
+                elif field[:5] != 'd_vp-':
+                    raise IOError("Database is incompatible with input schema")
+        pks = list(metas.keys())
+        tsarrays = [np.load(self.dbname+"_ts/"+pk+"_ts.npy") for pk in pks]
+        os.replace(self.dbname, self.dbname+".v0")
+        if pks:
+            self.insert_many(pks, [a[0,:] for a in tsarrays], [a[1,:] for a in tsarrays], list(metas.values()))
+        else:
+            self.log = WriteAheadLog(self.dbname, overwrite=True, **self.logoptions)
+        for pk in vps:
+            self.add_vp(pk)
+        self.checkpoint()
+
+    def _open_spectra(self, filename, store, rebuild):
+        # Opens the spectra segment kept alongside store, computing any missing rows
+        if rebuild or not os.path.exists(filename):
+            specstore = SegmentStore(filename, shape=(2, store.shape[1]+1), overwrite=True)
+        else:
+            specstore = SegmentStore(filename)
+        missing = [pk for pk in self.rows if pk not in specstore]
+        for start in range(0, len(missing), DIST_BLOCK):
+            block = missing[start:start+DIST_BLOCK]
+            specstore.append_many(block, self._spectra_records(store.get_many(block)[:,1,:]))
+        return specstore
+
+    def _spectra_records(self, values):
+        """
+        Returns the records stored in the spectra segments for the rows of
+        values: the standardized spectrum of each row followed by its self-
+        kernel, as a row of real parts over a row of imaginary parts.  These 
+        are the parts of procs.corr_indb which depend on one series only.
+        """
+        spectra, kernels = procs.corr_prepare(values)
+        packed = np.concatenate((spectra, kernels[:,np.newaxis]), axis=1)
+        return np.stack((packed.real, packed.imag), axis=1)
+
+    def _replay(self, pk, field, val):
+        """ Applies a single log record to the rows """
+        if field in self.schema:
+            if pk not in self.rows:
+                self.rows[pk] = {self.pkfield:pk}
+                self.rowids.add(pk)
+            else:
+                if self.schema[field]['type'] == bool:
+                    if val == 'False': 
+                        self.rows[pk][field] = False
+                    else:
+                        self.rows[pk][field] = True
+                else:
+                    self.rows[pk][field] = self.schema[field]['type'](val)
+            if pk not in self.rows_SAX:
+                self.rows_SAX[pk] = {self.pkfield:pk}
+            else:
+                if self.schema[field]['type'] == bool:
+                    if val == 'False': 
+                        self.rows_SAX[pk][field] = False
+                    else:
+                        self.rows_SAX[pk][field] = True
+                else:
+                    self.rows_SAX[pk][field] = self.schema[field]['type'](val)
+        elif field == 'DELETE':
+            if pk in self.vps:
+                self.del_vp(pk)
+            self.vpdists.clear(pk)
+            del self.rows[pk]
+            del self.rows_SAX[pk]
+            self.rowids.remove(pk)
+        elif field == 'd_vp':
+            # The whole column of a new vantage point, written by add_vp
+            self.vpdists.add_vp(pk, decode_column(val))
+        elif field[:5] == 'd_vp-':
+            self.vpdists.set(pk, field[5:], float(val))
+        else:
+            raise IOError("Database is incompatible with input schema")
+
+    def checkpoint(self):
+        """
+        Snapshots the rows, indexes, vantage point distances, iSAX tree and
+        SAX words to dbname.ckpt, 
+        then truncates the log.  Row ids of deleted rows are reclaimed first.
+        Loading the database restores the snapshot and replays only the log
+        records written after it.
+        """
+        if self.log is None:
+            return
+        self.log.flush()
+        generation = self.log.generation + 1
+        # Reclaim the row ids of deleted rows.  Only here, as log records of 
+        # vantage point distances are addressed by row id and the log is 
+        # truncated below
+        if len(self.rowids.pks) > len(self.rowids):
+            old = self.rowids.compact()
+            self.vpdists.remap(old)
+            for index in self.indexes.values():
+                if isinstance(index, BitmapIndex):
+                    index.remap(old)
+        rows = {}
+        for pk, row in self.rows.items():
+            rows[pk] = {f:v for f, v in row.items() if f != 'ts'}
+        sax = {'params':self._sax_params(), 'tree':self.SAX_tree, 'words':self.SAX_words}
+        ckpt = {'generation':generation, 'rows':rows, 'rowids':self.rowids, 'vpdists':self.vpdists, 'indexes':self.indexes, 'sax':sax}
+        # Replace the old checkpoint atomically; a crash before the log is 
+        # truncated is detected on load by the log's older generation
+        with open(self.dbname+".ckpt.tmp", 'wb') as fd:
+            pickle.dump(ckpt, fd, protocol=pickle.HIGHEST_PROTOCOL)
+            fd.flush()
+            if self.logoptions['fsync']:
+                os.fsync(fd.fileno())
+        os.replace(self.dbname+".ckpt.tmp", self.dbname+".ckpt")
+        self.log.close()
+        self.log = WriteAheadLog(self.dbname, overwrite=True, generation=generation, **self.logoptions)
+        for store in (self.tsstore, self.saxstore, self.specstore, self.saxspecstore):
+            if store is not None:
+                store.compact_directory()
+
+    def _sax_params(self):
+        # Everything the shape of the iSAX tree depends on
+        return {'wordlength':self.wordlength, 'cardinality':self.card, 'tslen':self.tslen_SAX, 'threshold':self.threshold}
+
+    def _sax_word(self, ts_SAX):
+        "The SAX word of a resampled series, as an array of integer symbols"
+        return isax_symbols_many(np.asarray(ts_SAX.data)[np.newaxis], self.card, self.wordlength)[0]
+
+    def _commit(self):
+        # Every public write ends with one commit, which may trigger a checkpoint
+        self.log.commit()
+        if self.checkpoint_every is not None and self.log.records >= self.checkpoint_every:
+            self.checkpoint()
+
     def insert_ts(self, pk, ts):    
         try:
             pk = str(pk)
@@ -209,115 +518,224 @@ class PersistentDB:
         if not isinstance(ts, TimeSeries):
             raise ValueError('Must insert a TimeSeries object')
 
-        if pk not in self.rows:
-            self.rows[pk] = {self.pkfield:pk}
-        else:
-            raise ValueError('Duplicate primary key found during insert')
-        if pk not in self.rows_SAX:
-            self.rows_SAX[pk] = {self.pkfield:pk}
-        else:
+        if pk in self.rows or pk in self.rows_SAX:
             raise ValueError('Duplicate primary key found during insert')
+        if self.tslen is not None and len(ts) != self.tslen:
+            raise ValueError('All timeseries must be of same length')
+        self.rows[pk] = {self.pkfield:pk}
+        self.rows_SAX[pk] = {self.pkfield:pk}
+        self.rowids.add(pk)
 
         # Save timeseries as a 2d numpy array
         if self.tslen is None:
             self.tslen = len(ts)
-        elif len(ts) != self.tslen:
-            raise ValueError('All timeseries must be of same length')
-        if not os.path.exists(self.dbname+"_ts"):
-            os.makedirs(self.dbname+"_ts")
-        np.save(self.dbname+"_ts/"+pk+"_ts.npy", np.vstack((ts.time, ts.data)))
+        self._create_files()
+        self.tsstore.append(pk, np.vstack((ts.time, ts.data)))
+        self.specstore.append_many([pk], self._spectra_records(ts.data))
         
         x1 = np.linspace(min(ts.time),max(ts.time), self.tslen_SAX)
         ts_SAX_data = interp1d(ts.time, ts.data)(x1)
         ts_SAX_time = x1
         ts_SAX = TimeSeries(ts_SAX_time,ts_SAX_data)
-        if not os.path.exists(self.dbname+"_ts_SAX"):
-            os.makedirs(self.dbname+"_ts_SAX")
-        np.save(self.dbname+"_ts_SAX/"+pk+"_ts_SAX.npy", np.vstack((ts_SAX.time, ts_SAX.data)))
-
-        # Save a record in the database file
-        if self.overwrite or not os.path.exists(self.dbname):
-            fd = open(self.dbname, 'w')
-            self.overwrite = False
-        else:
-            fd = open(self.dbname, 'a')
-        fd.write(pk+':'+self.pkfield+':'+pk+'\n')
+        self.saxstore.append(pk, np.vstack((ts_SAX.time, ts_SAX.data)))
+        self.saxspecstore.append_many([pk], self._spectra_records(ts_SAX.data))
+
+        # Save a record in the database log
+        self.log.append(pk, self.pkfield, pk)
         if 'vp' in self.schema:
-            fd.write(pk+':vp:False\n')
-        fd.close()
+            self.log.append(pk, 'vp', False)
 
         self.rows[pk]['ts'] = ts  
         if 'vp' in self.schema:
             self.rows[pk]['vp'] = False
 
         self.rows_SAX[pk]['ts'] = ts_SAX  
-        rep = isax_indb(ts_SAX,self.card,self.wordlength)
+        rep = self._sax_word(ts_SAX)
         self.SAX_tree.insert(pk, rep)
+        self.SAX_words[pk] = rep
         if 'vp' in self.schema:
             self.rows_SAX[pk]['vp'] = False
 
-        for vp in self.vps:
-            ts1 = self.rows[vp]['ts']
-            self.upsert_meta(pk, {'d_vp-'+vp : self.dist(ts1,ts)})
+        if self.vps:
+            dists = self._dists_to(ts, self.vps)
+            self._upsert_meta(pk, {'d_vp-'+vp : dist for vp, dist in zip(self.vps, dists)})
 
         self.update_indices(pk)
+        self._commit()
+
+    def _create_files(self):
+        # The segments and log of a new database are created by its first insert
+        if self.tsstore is None:
+            self.tsstore = SegmentStore(self.dbname+"_ts.seg", shape=(2, self.tslen), overwrite=True)
+            self.saxstore = SegmentStore(self.dbname+"_ts_SAX.seg", shape=(2, self.tslen_SAX), overwrite=True)
+            self.specstore = SegmentStore(self.dbname+"_ts_spec.seg", shape=(2, self.tslen+1), overwrite=True)
+            self.saxspecstore = SegmentStore(self.dbname+"_ts_SAX_spec.seg", shape=(2, self.tslen_SAX+1), overwrite=True)
+        if self.log is None:
+            self.log = WriteAheadLog(self.dbname, overwrite=True, **self.logoptions)
+            if os.path.exists(self.dbname+".ckpt"):
+                os.remove(self.dbname+".ckpt")
+
+    def insert_many(self, pks, times_matrix, values_matrix, metas=None):
+        """
+        Inserts a batch of timeseries, and optionally their metadata, at once.
+        Resampling and SAX encoding are vectorized over the batch, each segment receives the whole batch with a single write, the log 
+        records of the batch are committed together, and the indexes are
+        updated in bulk.  Either the whole batch is inserted or, if any 
+        argument is invalid or the batch would overflow the iSAX tree, 
+        nothing is.
+        Parameters
+        ----------
+        pks : list of str
+            The primary keys to be associated with the timeseries
+        times_matrix : 2d array-like
+            Row i holds the times of timeseries i
+        values_matrix : 2d array-like
+            Row i holds the values of timeseries i
+        metas : list of dict or None
+            Metadata to upsert for each timeseries
+        """
+        # ---- Validating input ---- #
+        try:
+            pks = [str(pk) for pk in pks]
+        except:
+            raise ValueError("Primary keys must be string-compatible")
+        times = np.asarray(times_matrix, dtype=float)
+        values = np.asarray(values_matrix, dtype=float)
+        if times.ndim != 2 or times.shape != values.shape or times.shape[0] != len(pks):
+            raise ValueError("Times and values must be matrices with one row per primary key")
+        if metas is None:
+            metas = [{} for pk in pks]
+        if len(metas) != len(pks):
+            raise ValueError("Must provide one metadata dictionary per primary key")
+        for pk in pks:
+            if ':' in pk:
+                raise ValueError("Primary keys may not include the ':' character") 
+            if pk in self.rows or pk in self.rows_SAX:
+                raise ValueError('Duplicate primary key found during insert')
+        if len(set(pks)) != len(pks):
+            raise ValueError('Duplicate primary key found during insert')
+        if self.tslen is not None and times.shape[1] != self.tslen:
+            raise ValueError('All timeseries must be of same length')
+        metas = [self._checked_meta(meta) for meta in metas]
+        if len(pks) == 0:
+            return
+        # The iSAX tree is checked before anything is written
+        times_SAX, values_SAX = self._resample_many(times, values)
+        reps = isax_symbols_many(values_SAX, self.card, self.wordlength)
+        if self.SAX_tree.overflows(reps):
+            raise ValueError("Overflow error, consider increasing threshold or cardinality")
+
+        if self.tslen is None:
+            self.tslen = times.shape[1]
+        self._create_files()
+        self.tsstore.append_many(pks, np.stack((times, values), axis=1))
+        self.specstore.append_many(pks, self._spectra_records(values))
+        self.saxstore.append_many(pks, np.stack((times_SAX, values_SAX), axis=1))
+        self.saxspecstore.append_many(pks, self._spectra_records(values_SAX))
+
+        for i, pk in enumerate(pks):
+            self.rows[pk] = {self.pkfield:pk}
+            self.rows_SAX[pk] = {self.pkfield:pk}
+            self.rowids.add(pk)
+            self.log.append(pk, self.pkfield, pk)
+            ts = TimeSeries(times[i], values[i])
+            ts_SAX = TimeSeries(times_SAX[i], values_SAX[i])
+            self.rows[pk]['ts'] = ts
+            self.rows_SAX[pk]['ts'] = ts_SAX
+            if 'vp' in self.schema:
+                self.log.append(pk, 'vp', False)
+                self.rows[pk]['vp'] = False
+                self.rows_SAX[pk]['vp'] = False
+            self.SAX_words[pk] = reps[i]
+            self._set_fields(pk, metas[i])
+            for field in metas[i]:
+                self.log.append(pk, field, metas[i][field])
+
+        self.SAX_tree.insert_many(pks, reps)
+
+        for vp in self.vps:
+            for pk, dist in zip(pks, self._dists_to(self.rows[vp]['ts'], pks)):
+                self.vpdists.set(pk, vp, dist)
+                self.log.append(pk, 'd_vp-'+vp, dist)
+
+        self.index_bulk(pks)
+        self._commit()
 
     def del_vp(self, vp):
-        """ Removes the d_vp-vp field from all rows """
-        for pk in self.rows:
-            if pk != vp:
-                del self.rows[pk]['d_vp-'+vp]
-        self.vps.remove(vp)
-        del self.indexes['d_vp-'+vp]
+        """ Removes the distances to vp, i.e. the field d_vp-vp, from all rows """
+        self.vpdists.del_vp(vp)
 
     def delete_ts(self, pk):    
+        logged = pk in self.rows
         if pk in self.rows:
-            for field in self.rows[pk]:
-                if field[:5] == 'd_vp-':
-                    if field[5:] != pk:
-                        self.indexes[field].delete(self.rows[pk][field], pk)
-                elif self.schema[field]['index'] is not None:
-                    if self.schema[field]['type'] in [int, float]:
-                        self.indexes[field].delete(self.rows[pk][field], pk)
-                    else:
-                        self.indexes[field][self.rows[pk][field]].remove(pk)  
-                if field == 'vp' and self.rows[pk]['vp'] == True:
-                    self.del_vp(pk)
+            self.unindex(pk, self.rows[pk])
+            if pk in self.vps:
+                self.del_vp(pk)
+            self.vpdists.clear(pk)
             del self.rows[pk]
-            fd = open(self.dbname, 'a')
-            fd.write(pk+':DELETE:0\n')
-            fd.close()
+            self.rowids.remove(pk)
+            self.tsstore.delete(pk)
+            self.specstore.delete(pk)
         if pk in self.rows_SAX:
-            rep = isax_indb(self.rows_SAX[pk]['ts'],self.card,self.wordlength)
-            self.SAX_tree.delete(rep,pk)
+            self.SAX_tree.delete(self.SAX_words.pop(pk),pk)
             del self.rows_SAX[pk]
+            self.saxstore.delete(pk)
+            self.saxspecstore.delete(pk)
+        # Committed last, as the commit may checkpoint the whole state
+        if logged:
+            self.log.append(pk, 'DELETE', 0)
+            self._commit()
             
     def upsert_meta(self, pk, meta):
-        if isinstance(meta, dict) == False:
-            raise ValueError('Metadata should be in the form of a dictionary')
+        self._upsert_meta(pk, meta)
+        self._commit()
+
+    def _upsert_meta(self, pk, meta):
+        # Same as upsert_meta, but leaves the log records to the caller's commit
         if pk not in self.rows:
             raise ValueError('Timeseries should be added prior to metadata')
+        values = self._checked_meta(meta)
         oldrow = self.rows[pk].copy()
+        self._set_fields(pk, values)
+
+        for field in values:
+            self.log.append(pk, field, values[field])
+
+        self.update_indices(pk, oldrow)
+
+    def _checked_meta(self, meta):
+        # Validates metadata against the schema, returning the values to store.
+        # Every value is converted to its schema type, as _replay does on load,
+        # so that the keys of an ordered index stay mutually comparable
+        if isinstance(meta, dict) == False:
+            raise ValueError('Metadata should be in the form of a dictionary')
+        values = {}
         for field in meta:
             if field in self.schema:
+                fieldtype = self.schema[field]['type']
                 try:
-                    convertedval = self.schema[field]['type'](meta[field])
-                    if self.schema[field]['type'] == str and ':' in convertedval:
+                    if fieldtype == bool and isinstance(meta[field], str):
+                        convertedval = meta[field] != 'False'
+                    else:
+                        convertedval = fieldtype(meta[field])
+                    if fieldtype == str and ':' in convertedval:
                         raise ValueError("Strings may not include the ':' character") 
-                    self.rows[pk][field] = meta[field]
+                    values[field] = convertedval
                 except:
                     raise ValueError("Value not compatible with type specified in schema")
-            elif field[:5] == 'd_vp-':
-                self.rows[pk][field] = float(meta[field])
+            elif field[:5] == 'd_vp-' and field[5:] in self.vpdists:
+                values[field] = float(meta[field])
             else:
                 raise ValueError('Field not supported by schema')
+        return values
 
-        fd = open(self.dbname, 'a')
-        for field in meta:
-            fd.write(pk+':'+field+':'+str(meta[field])+'\n')
-        fd.close()
-
-        self.update_indices(pk, oldrow)
+    def _set_fields(self, pk, values):
+        # Distances to vantage points live in vpdists, everything else in the row
+        for field, val in values.items():
+            if field[:5] == 'd_vp-':
+                self.vpdists.set(pk, field[5:], val)
+            else:
+                self.rows[pk][field] = val
 
     def add_vp(self, pk=None):
         """
@@ -333,8 +751,8 @@ class PersistentDB:
         if 'vp' not in self.schema:
             raise ValueError("Vantage points not supported by schema, must include 'vp' field")
         if pk is None:
-            pkrand = self.rows.keys()
-            random.shuffle(list(pkrand))
+            pkrand = list(self.rows.keys())
+            random.shuffle(pkrand)
             foundvp = False
             for k in pkrand:
                 if self.rows[k]['vp'] == False:
@@ -348,103 +766,492 @@ class PersistentDB:
         elif self.rows[pk]['vp']:
             raise ValueError("This timeseries is already a vantage point")
         
-        self.vps.append(pk)
-        self.upsert_meta(pk, {'vp':True})
-        self.indexes['d_vp-'+pk] = BinarySearchTree()
+        # The distances to the new vantage point are computed as one column,
+        # and logged as a single record ahead of the vp flag
         ts1 = self.rows[pk]['ts']
-        for key in self.rows:
-            ts2 = self.rows[key]['ts']
-            self.upsert_meta(key, {'d_vp-'+pk:self.dist(ts1,ts2)})
+        column = np.full(len(self.rowids.pks), np.nan)
+        keys = list(self.rows)
+        column[[self.rowids[key] for key in keys]] = self._dists_to(ts1, keys)
+        self.vpdists.add_vp(pk, column)
+        self.log.append(pk, 'd_vp', encode_column(column))
+        self._upsert_meta(pk, {'vp':True})
+        self._commit()
+
+    def choose_vps(self, n, strategy='farthest', sample=256, queries=16):
+        """
+        Chooses and adds n vantage points among a random sample of the rows,
+        by a farthest-first traversal: each one is the sampled row farthest
+        from the vantage points chosen so far, so that they are spread out.
+        With strategy='variance', each one is instead the row whose distances
+        to the sample vary the most, among the half of the sample farthest 
+        from the vantage points so far.  Rows whose distances to a vantage
+        point vary widely are told apart by its triangle inequality bound.
+        Parameters
+        ----------
+        n : int
+            The number of vantage points to add
+        strategy : str
+            'farthest' or 'variance'
+        sample : int
+            The number of rows sampled as candidates
+        queries : int
+            The number of rows used as queries to estimate the candidate fraction
+        Returns
+        -------
+        A tuple of the list of new vantage points and the expected candidate
+        fraction: the fraction of the rows which are not vantage points whose
+        lower bound falls below the distance of a query row to its nearest 
+        neighbour, and which simsearch therefore has to score.
+        """
+        if 'vp' not in self.schema:
+            raise ValueError("Vantage points not supported by schema, must include 'vp' field")
+        if not isinstance(n, int) or n <= 0:
+            raise ValueError("Number of vantage points must be a positive int")
+        if strategy not in ('farthest', 'variance'):
+            raise ValueError("Strategy must be 'farthest' or 'variance'")
+        if not isinstance(sample, int) or sample < n:
+            raise ValueError("Sample must be an int no smaller than the number of vantage points")
+        if not isinstance(queries, int) or queries <= 0:
+            raise ValueError("Number of queries must be a positive int")
+        candidates = [pk for pk in self.rows if pk not in self.vpdists]
+        if len(candidates) < n:
+            raise ValueError("No more primary keys available as vantage points")
+        candidates = random.sample(candidates, min(sample, len(candidates)))
+
+        # Distance of every candidate to its closest vantage point so far
+        if len(self.vps) > 0:
+            rids = [self.rowids[pk] for pk in candidates]
+            closest = np.array([self.vpdists.column(vp)[rids] for vp in self.vps]).min(axis=0)
+        else:
+            # Without vantage points, the traversal starts from the candidate farthest from a random one
+            closest = np.full(len(candidates), np.inf)
+            closest[np.argmax(self._dists_to(self.rows[candidates[0]]['ts'], candidates))] = np.nan
+        if strategy == 'variance':
+            spread = np.array([np.var(self._dists_to(self.rows[pk]['ts'], candidates)) for pk in candidates])
+
+        chosen = []
+        for i in range(n):
+            if np.isnan(closest).any():
+                pick = int(np.flatnonzero(np.isnan(closest))[0])
+            elif strategy == 'variance':
+                far = closest >= np.median(closest[closest >= 0])
+                pick = int(np.flatnonzero(far)[np.argmax(spread[far])])
+            else:
+                pick = int(np.argmax(closest))
+            chosen.append(candidates[pick])
+            closest = np.fmin(closest, self._dists_to(self.rows[candidates[pick]]['ts'], candidates))
+            closest[pick] = -np.inf
+        for pk in chosen:
+            self.add_vp(pk)
+        return chosen, self._candidate_fraction(queries)
+
+    def _candidate_fraction(self, queries):
+        """ Average over up to queries random rows of the fraction of the other rows simsearch has to score """
+        pks = [pk for pk in self.rows if pk not in self.vpdists]
+        if len(pks) < 2:
+            return 0.0
+        rids = np.array([self.rowids[pk] for pk in pks])
+        fractions = []
+        for i in random.sample(range(len(pks)), min(queries, len(pks))):
+            q = pks[i]
+            nearest = [dist for pk, dist in self.simsearch(self.rows[q]['ts'], 2) if pk != q]
+            lower = np.delete(self.vpdists.lower_bounds([self.vpdists.get(q, vp) for vp in self.vps])[rids], i)
+            # Without a neighbour at a defined distance nothing is pruned
+            bound = nearest[0] if nearest else np.inf
+            fractions.append(float(np.mean(lower < bound)))
+        return float(np.mean(fractions))
+
+    def flush(self):
+        """ Writes out any log records still waiting for a group commit """
+        if self.log is not None:
+            self.log.flush()
+
+    def close(self):
+        """ 
+        Checkpoints the database if the log holds any records, so the next
+        load restores the checkpoint instead of replaying the log, and 
+        closes all files held open by the database
+        """
+        if self.log is not None and self.log.records > 0:
+            self.checkpoint()
+        for f in (self.log, self.tsstore, self.saxstore, self.specstore, self.saxspecstore):
+            if f is not None:
+                f.close()
         
-    def simsearch_SAX(self, ts):
+    def simsearch_SAX(self, ts, k=None, exact=False, max_leaves=None, max_candidates=None, deadline_ms=None, standardized=False):
+        """
+        Searches the iSAX tree for the timeseries closest to ts.  By default
+        only the leaf matching the SAX word of ts (or, if it is empty, the 
+        leaf found by a greedy descent) is searched, using the database's 
+        distance.  With exact=True, leaves are instead visited best-first in
+        increasing order of their iSAX MINDIST from ts.  MINDIST bounds the 
+        Euclidean distance between standardized timeseries, not the 
+        database's distance, so the exact search visits every leaf unless
+        standardized=True ranks by the former, when it stops once MINDIST
+        exceeds the distance of the k-th closest timeseries found.
+        Giving any of max_leaves, max_candidates or deadline_ms runs the same
+        best-first search, but stops early once the budget is spent and 
+        returns the closest timeseries found so far, trading recall for 
+        latency.  At least one leaf is always searched.  Timeseries at an
+        undefined distance from ts are never returned.
+        Parameters
+        ----------
+        ts : TimeSeries or [times, values]
+            The query
+        k : int or None
+            The number of nearest neighbours to return
+        exact : bool
+            Whether to search the whole tree, pruned by MINDIST
+        max_leaves : int or None
+            The largest number of leaves to search
+        max_candidates : int or None
+            Stop once at least this many timeseries have been compared to ts
+        deadline_ms : int, float or None
+            Stop once this many milliseconds have passed since the call
+        standardized : bool
+            Whether to rank by the Euclidean distance between standardized,
+            resampled timeseries instead of the database's distance
+        Returns
+        -------
+        If k is None, the primary key of the closest timeseries found, or None
+        if there is none.  Otherwise a list of up to k (pk, distance) tuples,
+        closest first.
+        """
+        start = time.monotonic()
+        if k is not None and (not isinstance(k, int) or k <= 0):
+            raise ValueError("k must be a positive int or None")
+        for budget in (max_leaves, max_candidates):
+            if budget is not None and (not isinstance(budget, int) or budget <= 0):
+                raise ValueError("Leaf and candidate budgets must be positive ints or None")
+        if deadline_ms is not None and (not isinstance(deadline_ms, (int, float)) or deadline_ms <= 0):
+            raise ValueError("Deadline must be a positive number of milliseconds or None")
+        if not isinstance(standardized, bool):
+            raise ValueError("Standardized must be of type bool")
+        ts_SAX = self._resample_SAX(ts)
+        nearest = _Nearest(1 if k is None else k)
+        if exact or max_leaves is not None or max_candidates is not None or deadline_ms is not None:
+            deadline = None if deadline_ms is None else start + deadline_ms/1000
+            self._search_SAX_exact(ts_SAX, nearest, max_leaves, max_candidates, deadline, standardized)
+        else:
+            rep = self._sax_word(ts_SAX)
+            n = self.SAX_tree.search(rep)
+            if n is None or not n.ts:
+                n = self.SAX_tree.search2(rep)
+            candidates = [] if n is None else list(n.ts)
+            for pk, dist in zip(candidates, self._SAX_dists_to(ts_SAX, candidates, standardized)):
+                nearest.offer(pk, float(dist))
+
+        result = nearest.result()
+        if k is None:
+            return result[0][0] if result else None
+        return result
+
+    def _resample_many(self, times, values):
+        """ Every row of times and values resampled onto tslen_SAX evenly spaced times """
+        lo, hi = times.min(axis=1), times.max(axis=1)
+        grid = np.linspace(0, 1, self.tslen_SAX)
+        times_SAX = lo[:,np.newaxis] + (hi-lo)[:,np.newaxis]*grid
+        times_SAX[:,-1] = hi
+        if (times == times[0]).all():
+            # Shared time axis: one set of interpolation weights for the batch
+            right = np.clip(np.searchsorted(times[0], times_SAX[0], side='right'), 1, times.shape[1]-1)
+            weight = (times_SAX[0] - times[0,right-1]) / (times[0,right] - times[0,right-1])
+            values_SAX = values[:,right-1]*(1-weight) + values[:,right]*weight
+        else:
+            values_SAX = np.array([np.interp(x, t, v) for x, t, v in zip(times_SAX, times, values)])
+        return times_SAX, values_SAX
+
+    def _resample_SAX(self, ts):
+        """ The query ts, a TimeSeries or [times, values], resampled to tslen_SAX evenly spaced times """
         if isinstance(ts,TimeSeries):
             ts = [ts.time,ts.data]
         x1 = np.linspace(min(ts[0]),max(ts[0]), self.tslen_SAX)
         ts_SAX_data = interp1d(ts[0], ts[1])(x1)
         ts_SAX_time = x1
-        ts_SAX = TimeSeries(ts_SAX_time,ts_SAX_data)
-        rep = isax_indb(ts_SAX,self.card,self.wordlength)
-        n = self.SAX_tree.search(rep)
-        closestpk = None
-        pkdist = None
-        if n.ts:
-            for pk in n.ts:
-                thisdist = self.dist(ts_SAX, self.rows_SAX[pk]['ts'])
-                if pkdist is None or thisdist < pkdist:
-                    closestpk = pk
-                    pkdist = thisdist
-        else:
-            n = self.SAX_tree.search2(rep)
-            for pk in n.ts:
-                thisdist = self.dist(ts_SAX, self.rows_SAX[pk]['ts'])
-                if pkdist is None or thisdist < pkdist:
-                    closestpk = pk
-                    pkdist = thisdist
-
-        return closestpk
-        # if closestpk:
-        #     return self.rows[closestpk]['ts']
-        # else:
-        #     return None
-        
-    def simsearch(self, ts):
-        """ Search over all timeseries in the database and return the primary key 
-          of the object which is closest """
+        return TimeSeries(ts_SAX_time,ts_SAX_data)
+
+    def _search_SAX_exact(self, ts_SAX, nearest, max_leaves=None, max_candidates=None, deadline=None, standardized=False):
+        # Best-first traversal of the iSAX tree, scoring whole leaves at once,
+        # until the bound is reached (which MINDIST only gives for standardized
+        # distances) or the budget (if any) is spent
+        paa = paa_indb(ts_SAX, self.wordlength)
+        queue = []
+        tiebreak = itertools.count()
+        def push(node):
+            if node.ts or node.left is not None:
+                heapq.heappush(queue, (node.mindist(paa, self.tslen_SAX), next(tiebreak), node))
+        for child in self.SAX_tree.children.values():
+            push(child)
+        leaves, scored = 0, 0
+        while queue:
+            bound, _, node = heapq.heappop(queue)
+            if standardized and bound >= nearest.bound():
+                break
+            if node.left is None:
+                if leaves > 0 and ((max_leaves is not None and leaves >= max_leaves) or
+                                   (max_candidates is not None and scored >= max_candidates) or
+                                   (deadline is not None and time.monotonic() >= deadline)):
+                    break
+                candidates = list(node.ts)
+                for pk, dist in zip(candidates, self._SAX_dists_to(ts_SAX, candidates, standardized)):
+                    nearest.offer(pk, float(dist))
+                leaves += 1
+                scored += len(candidates)
+            else:
+                push(node.left)
+                push(node.right)
+
+    def _SAX_dists_to(self, ts_SAX, pks, standardized):
+        """ Distances from the resampled query ts_SAX to the resampled timeseries of pks, by the metric simsearch_SAX ranks by """
+        if standardized:
+            return self._standardized_dists_to(stand_many(ts_SAX.data)[0], pks)
+        return self._dists_to(ts_SAX, pks, sax=True)
+
+    def _standardized_dists_to(self, query, pks):
+        """ 
+        Euclidean distances from the standardized values query to the 
+        standardized, resampled timeseries of pks.  Constant timeseries 
+        standardize to all zeros.
+        """
+        if len(pks) == 0:
+            return np.empty(0)
+        if self.workers is not None and len(pks) >= PARALLEL_MIN:
+            return self.workers.dists(standardized_chunk, self.saxstore, pks, query)
+        return np.linalg.norm(stand_many(self.saxstore.get_many(pks)[:,1,:]) - query, axis=1)
+
+    def simsearch(self, ts, k=None):
+        """
+        Searches over all timeseries in the database for the ones closest to ts.
+        Every vantage point bounds the distance to a timeseries x from below by
+        |d(ts,vp) - d(x,vp)| (triangle inequality).  Timeseries are compared to
+        ts in increasing order of their largest bound, stopping once the bound 
+        reaches the distance of the k-th closest timeseries found so far.
+        Parameters
+        ----------
+        ts : TimeSeries
+            The query, must have same length as objects in database
+        k : int or None
+            The number of nearest neighbours to return
+        Returns
+        -------
+        If k is None, the primary key of the closest timeseries, or None if 
+        no timeseries is at a defined distance from ts.  Otherwise a list of
+        up to k (pk, distance) tuples for the k closest timeseries, closest first.
+        """
         if not isinstance(ts, TimeSeries):
             raise ValueError("Input must be a TimeSeries object")
         if len(self.vps) == 0:
             raise ValueError("Database must contain vantage points before simsearch can be called")
+        if k is not None and (not isinstance(k, int) or k <= 0):
+            raise ValueError("k must be a positive int or None")
+        nearest = _Nearest(1 if k is None else k)
 
-        # Find closest vantage point
-        closestvp = None
-        vpdist = None
-        for vp in self.vps:
-            thisdist = self.dist(ts, self.rows[vp]['ts'])
-            if vpdist is None or thisdist < vpdist:
-                closestvp = vp
-                vpdist = thisdist
-        
-        # Select all timeseries within 2*vpdist from closestvp
-        closepks,_ = self.select(meta={'d_vp-'+closestvp:{'<=':2*vpdist}}, fields=None)
+        # The vantage points themselves are scored exactly
+        qdists = self._dists_to(ts, self.vps)
+        for vp, dist in zip(self.vps, qdists):
+            nearest.offer(vp, float(dist))
+
+        lower = self.vpdists.lower_bounds(qdists)
+        rids = np.flatnonzero(~np.isnan(lower))
+        rids = rids[np.argsort(lower[rids], kind='stable')].tolist()
+        pks = self.rowids.pks
+        done = False
+        # Batches are made large enough to be worth sending to the workers
+        batchsize = SIMSEARCH_BATCH if self.workers is None else max(SIMSEARCH_BATCH, PARALLEL_MIN)
+        for start in range(0, len(rids), batchsize):
+            batch = []
+            for rid in rids[start:start+batchsize]:
+                if lower[rid] >= nearest.bound():
+                    done = True
+                    break
+                if pks[rid] not in self.vpdists:
+                    batch.append(pks[rid])
+            for pk, dist in zip(batch, self._dists_to(ts, batch)):
+                nearest.offer(pk, float(dist))
+            if done:
+                break
 
-        # Find closest timeseries
-        closestpk = None
-        pkdist = None
-        for pk in closepks:
-            thisdist = self.dist(ts, self.rows[pk]['ts'])
-            if pkdist is None or thisdist < pkdist:
-                closestpk = pk
-                pkdist = thisdist
+        result = nearest.result()
+        if k is None:
+            return result[0][0] if result else None
+        return result
+
+    def range_search(self, ts, r, sax=False):
+        """
+        Finds every timeseries within distance r of ts.  Rows are discarded
+        without being compared to ts when their vantage point lower bound
+        |d(ts,vp) - d(x,vp)| exceeds r, and the rest are scored in blocks.
+        With sax=True, the radius instead applies to the Euclidean distance
+        between standardized, resampled timeseries (as ranked by 
+        simsearch_SAX with exact=True), and whole subtrees of the iSAX tree 
+        are discarded when their MINDIST from ts exceeds r.  MINDIST does not
+        bound the database's distance, so it cannot prune the default search.
+        Parameters
+        ----------
+        ts : TimeSeries
+            The query, must have same length as objects in database
+        r : int or float
+            The radius, non-negative
+        sax : bool
+            Whether to search the iSAX tree by standardized Euclidean distance
+        Returns
+        -------
+        A list of (pk, distance) tuples for every timeseries within r of ts,
+        closest first.
+        """
+        if not isinstance(ts, TimeSeries):
+            raise ValueError("Input must be a TimeSeries object")
+        if isinstance(r, bool) or not isinstance(r, (int, float)) or r < 0:
+            raise ValueError("Radius must be a non-negative number")
+        matches = []
+        if sax:
+            ts_SAX = self._resample_SAX(ts)
+            paa = paa_indb(ts_SAX, self.wordlength)
+            query = stand_many(ts_SAX.data)[0]
+            stack = list(self.SAX_tree.children.values())
+            while stack:
+                node = stack.pop()
+                if node.mindist(paa, self.tslen_SAX) > r:
+                    continue
+                if node.left is None:
+                    candidates = list(node.ts)
+                    matches += zip(candidates, self._standardized_dists_to(query, candidates))
+                else:
+                    stack += [node.left, node.right]
+        else:
+            candidates = list(self.rows)
+            if len(self.vps) > 0:
+                # The vantage points themselves are scored exactly
+                qdists = self._dists_to(ts, self.vps)
+                matches += zip(self.vps, qdists)
+                lower = self.vpdists.lower_bounds(qdists)
+                with np.errstate(invalid='ignore'):
+                    rids = np.flatnonzero(lower <= r).tolist()
+                pks = self.rowids.pks
+                candidates = [pks[rid] for rid in rids if pks[rid] not in self.vpdists]
+            matches += zip(candidates, self._dists_to(ts, candidates))
+        return sorted(((pk, float(dist)) for pk, dist in matches if dist <= r), key=lambda match: (match[1], match[0]))
+
+    def _dists_to(self, ts, pks, sax=False):
+        """
+        Returns an array of the distances from ts to the timeseries of pks (the
+        resampled ones if sax=True).  The default distance procs.corr_indb is
+        computed in blocks by procs.corr_many_prepared, from the spectra and
+        self-kernels stored when the timeseries were inserted, and split
+        between the worker processes if there are enough of them.
+        """
+        if len(pks) == 0:
+            return np.empty(0)
+        if self.dist is procs.corr_indb:
+            specstore = self.saxspecstore if sax else self.specstore
+            if self.workers is not None and len(pks) >= PARALLEL_MIN:
+                return self.workers.dists(corr_chunk, specstore, pks, ts)
+            dists = np.empty(len(pks))
+            for start in range(0, len(pks), DIST_BLOCK):
+                spectra, kernels = unpack_spectra(specstore.get_many(pks[start:start+DIST_BLOCK]))
+                dists[start:start+DIST_BLOCK] = procs.corr_many_prepared(ts, spectra, kernels)
+            return dists
+        rows = self.rows_SAX if sax else self.rows
+        return np.array([self.dist(ts, rows[pk]['ts']) for pk in pks], dtype=float)
 
-        return closestpk
+    def unindex(self, pk, row):
+        """ Removes the values in row from the indexes, skipping indexes which no longer exist """
+        for field in row:
+            if field in self.indexes:
+                self.indexes[field].delete(row[field], pk)
 
-    def index_bulk(self, pks=[]):
+    def index_bulk(self, pks=[], fields=None):
+        """ 
+        Indexes the given rows (all rows if pks is empty) in the given fields
+        (all indexed fields if None), bulk-loading indexes which are still empty 
+        """
         if len(pks) == 0:
             pks = self.rows
+        if fields is None:
+            fields = self.indexes
+        pairs = defaultdict(list)
         for pkid in pks:
-            self.update_indices(pkid)
+            for field, val in self.rows[pkid].items():
+                if field in fields:
+                    pairs[field].append((val, pkid))
+        for field in pairs:
+            if isinstance(self.indexes[field], OrderedIndex) and len(self.indexes[field]) == 0:
+                self.indexes[field] = OrderedIndex.from_pairs(pairs[field])
+            elif isinstance(self.indexes[field], BitmapIndex) and len(self.indexes[field]) == 0:
+                self.indexes[field] = BitmapIndex.from_pairs(self.rowids, pairs[field])
+            else:
+                for val, pkid in pairs[field]:
+                    self.indexes[field].put(val, pkid)
          
     def update_indices(self, pk, oldrow=None):
         # If oldrow = None, assume all assignments are new.  If not, check whether the old values need to be deleted.
         row = self.rows[pk]
         for field in row:
+            if field not in self.indexes:
+                continue
             val = row[field]
-            if field[:5] == 'd_vp-' or (self.schema[field]['index'] is not None and self.schema[field]['type'] in [int,float]):
-                if oldrow is not None and field in oldrow:
-                    if oldrow[field] != val:
-                        oldval = oldrow[field]
-                        self.indexes[field].delete(oldval, pk)
-                        self.indexes[field].put(val, pk)
-                else:
+            if oldrow is not None and field in oldrow:
+                if oldrow[field] != val:
+                    self.indexes[field].delete(oldrow[field], pk)
                     self.indexes[field].put(val, pk)
-            elif self.schema[field]['index'] is not None:
-                if oldrow is not None and field in oldrow:
-                    if oldrow[field] != val:
-                        oldval = oldrow[field]
-                        self.indexes[field][oldval].remove(pk)
-                        self.indexes[field][val].add(pk)
-                else:
-                    self.indexes[field][val].add(pk)
+            else:
+                self.indexes[field].put(val, pk)
+
+    def _match(self, meta):
+        """
+        Returns the set of pks satisfying every predicate in meta.  Predicates
+        on bitmap indexes and on vantage point distances are evaluated together
+        as one bitwise AND.  The other
+        predicates are ordered by the number of rows their index estimates
+        they match; the most selective one is looked up in its index, and each
+        following one is either looked up and intersected or, when the
+        candidate set is already smaller than its estimate, checked directly
+        against the candidate rows.
+        """
+        predicates = []
+        for field in meta:
+            if field not in self.schema and field[:5] != 'd_vp-':
+                raise ValueError('Field not supported by schema')
+            if field not in self.indexes and not (field[:5] == 'd_vp-' and field[5:] in self.vpdists):
+                raise ValueError('May only search by indexed fields or primary key')
+            if isinstance(meta[field],dict):
+                for opkey in meta[field]:
+                    predicates.append((field, OPMAP[opkey], meta[field][opkey]))
+            else:
+                predicates.append((field, OPMAP['=='], meta[field]))
+
+        # Predicates on bitmap indexes and vantage point distances are combined 
+        # with a bitwise AND and decoded once; the rest are ordered by their
+        # estimated cardinality
+        pks = None
+        bitmap = None
+        indexed = []
+        for field, op, compval in predicates:
+            if field not in self.indexes:
+                fieldmap = self.vpdists.bitmap(field[5:], op, compval)
+            elif isinstance(self.indexes[field], BitmapIndex):
+                fieldmap = self.indexes[field].bitmap(op, compval)
+            else:
+                indexed.append((field, op, compval))
+                continue
+            bitmap = fieldmap if bitmap is None else bitmap & fieldmap
+        if bitmap is not None:
+            pks = self.rowids.decode(bitmap)
+            predicates = indexed
+        costed = sorted((self.indexes[field].estimate(op, compval), i) for i, (field, op, compval) in enumerate(predicates))
+        for estimate, i in costed:
+            if pks is not None and not pks:
+                break
+            field, op, compval = predicates[i]
+            if pks is None:
+                pks = self.indexes[field].lookup(op, compval)
+            elif len(pks) < estimate:
+                pks = set(pk for pk in pks if field in self.rows[pk] and op(self.rows[pk][field], compval))
+            else:
+                pks = pks.intersection(self.indexes[field].lookup(op, compval))
+        if pks is None:
+            return set(self.rows)
+        return pks
 
     def select(self, meta, fields, additional=None):
 
@@ -472,38 +1279,7 @@ class PersistentDB:
             pks = [meta['pk']]
         # Otherwise, search for matching rows
         else:
-            first = True
-            for field in meta:
-                # Define operator  (For now assuming just one per field)
-                if isinstance(meta[field],dict):
-                    for opkey in meta[field]:
-                        op = OPMAP[opkey]
-                        compval = meta[field][opkey]
-                else:
-                    op = OPMAP['==']
-                    compval = meta[field]
-
-                pks_field = []
-                if field not in self.schema and field[:5] != 'd_vp-':
-                    raise ValueError('Field not supported by schema')
-                if field[:5] != 'd_vp-' and self.schema[field]['index'] is None:
-                    raise ValueError('May only search by indexed fields or primary key')
-                else:
-                    if field[:5] == 'd_vp-' or self.schema[field]['type'] in [int, float]:
-                        if op == OPMAP['==']:
-                            pks_field = self.indexes[field].get(compval)
-                        else:
-                            pks_field = self.indexes[field].collect(compval, op)
-                    else:
-                        for val in self.indexes[field]:
-                            if op(val,compval):
-                                pks_field = pks_field + list(self.indexes[field][val])
-                    if first: 
-                        pks = set(pks_field)
-                        first = False
-                    else:
-                        pks = pks.intersection(set(pks_field))
-            pks = list(pks)
+            pks = list(self._match(meta))
 
         # Retrieve appropriate fields
         matchfields = []
@@ -525,6 +1301,8 @@ class PersistentDB:
                 for f in allfields:
                     if f != 'ts':
                         pkfields[f] = pkrow[f]
+                for vp in self.vps:
+                    pkfields['d_vp-'+vp] = self.vpdists.get(pk, vp)
                 matchfields.append(pkfields)
                 if 'order' in self.rows[pk] and sort != 0:         
                     orderfield.append(self.rows[pk]['order']*sort)
@@ -538,6 +1316,8 @@ class PersistentDB:
                 for f in fields:
                     if f in pkrow:
                         pkfields[f] = pkrow[f]
+                    elif f[:5] == 'd_vp-' and f[5:] in self.vpdists:
+                        pkfields[f] = self.vpdists.get(pk, f[5:])
                 matchfields.append(pkfields)
                 if 'order' in self.rows[pk] and sort != 0:
                     orderfield.append(self.rows[pk]['order']*sort)
@@ -0,0 +1,157 @@
+import os
+import numpy as np
+
+# Append-only storage for fixed-width float records.  A segment is a single
+# data file holding a short header followed by records of identical shape,
+# plus a text directory file mapping each primary key to its record number.
+# Records are never rewritten in place: inserting appends one record and one
+# directory line, and deleting only appends a tombstone to the directory.
+# Reads go through a read-only np.memmap of the data file, so loading a
+# database maps one file instead of opening one .npy file per primary key.
+
+MAGIC = b'TSDBSEG1'
+HEADER_LENGTH = 16
+DTYPE = np.dtype('<f8')
+
+
+class SegmentStore:
+    "Append-only file of fixed-shape float64 records addressed by primary key"
+
+    def __init__(self, filename, shape=None, overwrite=False):
+        """
+        Parameters
+        ----------
+        filename : str
+            Name of the data file.  The directory is stored in filename+'.dir'
+        shape : tuple of int or None
+            Shape of every record, e.g. (2, tslen) for a time series.  Required
+            when creating a new segment, read from the header otherwise.
+        overwrite : bool
+            Whether to discard any existing segment of the same name.
+        Attributes
+        ----------
+        directory : dict
+            Key = primary key
+            Value = record number within the data file
+        nrecords : int
+            Number of records in the data file, including deleted ones
+        """
+        self.filename = filename
+        self.dirname = filename+'.dir'
+        self.directory = {}
+        self._map = None
+        if overwrite or not os.path.exists(filename):
+            if shape is None:
+                raise ValueError("Record shape must be given when creating a segment")
+            self.shape = tuple(int(s) for s in shape)
+            # A new file rather than the old one truncated, so that readers
+            # still mapping the old segment (e.g. worker processes) can tell
+            with open(filename+'.tmp', 'wb') as fd:
+                fd.write(MAGIC)
+                fd.write(np.array(self.shape, dtype='<u4').tobytes())
+            os.replace(filename+'.tmp', filename)
+            open(self.dirname, 'w').close()
+            self.nrecords = 0
+        else:
+            with open(filename, 'rb') as fd:
+                header = fd.read(HEADER_LENGTH)
+            if len(header) != HEADER_LENGTH or header[:8] != MAGIC:
+                raise IOError("Segment file {} is corrupted".format(filename))
+            self.shape = tuple(int(s) for s in np.frombuffer(header[8:], dtype='<u4'))
+            if shape is not None and tuple(shape) != self.shape:
+                raise ValueError("Segment record shape does not match")
+            # A torn final record (e.g. after a crash) is dropped
+            datalen = os.path.getsize(filename) - HEADER_LENGTH
+            self.nrecords = datalen // self.reclen
+            if datalen > self.nrecords*self.reclen:
+                with open(filename, 'r+b') as fd:
+                    fd.truncate(HEADER_LENGTH + self.nrecords*self.reclen)
+            if os.path.exists(self.dirname):
+                with open(self.dirname) as fd:
+                    for l in fd:
+                        if ':' not in l:
+                            continue
+                        pk, recno = l.rstrip('\n').rsplit(':', 1)
+                        recno = int(recno)
+                        if recno < 0:
+                            self.directory.pop(pk, None)
+                        elif recno < self.nrecords:
+                            self.directory[pk] = recno
+        self._datafd = open(filename, 'ab')
+        self._dirfd = open(self.dirname, 'a')
+
+    @property
+    def reclen(self):
+        "Number of bytes per record"
+        return int(np.prod(self.shape)) * DTYPE.itemsize
+
+    def __len__(self):
+        return len(self.directory)
+
+    def __contains__(self, pk):
+        return pk in self.directory
+
+    def keys(self):
+        return self.directory.keys()
+
+    def append(self, pk, record):
+        "Append a single record for pk, replacing any earlier one in the directory"
+        self.append_many([pk], np.asarray(record)[np.newaxis])
+
+    def append_many(self, pks, records):
+        "Append a block of records (first axis indexed like pks) with one write"
+        records = np.ascontiguousarray(records, dtype=DTYPE)
+        if records.shape != (len(pks),)+self.shape:
+            raise ValueError("Records must have shape {}".format(self.shape))
+        self._datafd.write(records.tobytes())
+        self._datafd.flush()
+        lines = []
+        for i, pk in enumerate(pks):
+            self.directory[pk] = self.nrecords + i
+            lines.append('{}:{}\n'.format(pk, self.nrecords + i))
+        self._dirfd.write(''.join(lines))
+        self._dirfd.flush()
+        self.nrecords += len(pks)
+
+    def delete(self, pk):
+        "Remove pk from the directory; the record itself stays in the data file"
+        if pk in self.directory:
+            del self.directory[pk]
+            self._dirfd.write(pk+':-1\n')
+            self._dirfd.flush()
+
+    def compact_directory(self):
+        "Rewrite the directory file with one line per live primary key"
+        self._dirfd.close()
+        with open(self.dirname+'.tmp', 'w') as fd:
+            fd.write(''.join('{}:{}\n'.format(pk, recno) for pk, recno in self.directory.items()))
+        os.replace(self.dirname+'.tmp', self.dirname)
+        self._dirfd = open(self.dirname, 'a')
+
+    def _mapped(self, recno):
+        # Remap lazily, only once a record beyond the current mapping is read
+        if self._map is None or recno >= self._map.shape[0]:
+            self._map = np.memmap(self.filename, dtype=DTYPE, mode='r', offset=HEADER_LENGTH,
+                                  shape=(self.nrecords,)+self.shape)
+        return self._map
+
+    def get(self, pk):
+        "Return a read-only view of the record stored for pk"
+        recno = self.directory[pk]
+        return self._mapped(recno)[recno]
+
+    def get_many(self, pks):
+        "Return a copy of the records stored for pks, stacked along the first axis"
+        recnos = np.array([self.directory[pk] for pk in pks], dtype=np.intp)
+        if len(recnos) == 0:
+            return np.empty((0,)+self.shape, dtype=DTYPE)
+        return self._mapped(recnos.max())[recnos]
+
+    def flush(self):
+        self._datafd.flush()
+        self._dirfd.flush()
+
+    def close(self):
+        self._map = None
+        self._datafd.close()
+        self._dirfd.close()
@@ -1,250 +1,184 @@
 import numpy as np
-
-# Adapted from http://interactivepython.org/runestone/static/pythonds/Trees/SearchTreeImplementation.html
-# to allow nodes to contain multiple values, 
-# to delete one value at a time rather than the whole node,
-# and to perform traversals that collect the values for keys greater than or less than a given key
-class BinarySearchTree:
-
-    def __init__(self):
-        self.root = None
-        self.size = 0
+import operator
+from bisect import bisect_left, bisect_right, insort
+
+
+class OrderedIndex:
+    """
+    Balanced ordered index mapping keys to sets of values (primary keys).
+
+    Keys are kept in a list of sorted blocks of bounded size, together with
+    the largest key of each block, so the structure is a two-level B+tree:
+    a lookup bisects the block maxima and then one block, and an insert or
+    delete only shifts keys within a single block.  No operation recurses,
+    and the depth does not depend on the order in which keys arrive.
+    Offers put/get/delete/collect over the set of values of each key.
+    """
+
+    def __init__(self, load=1000):
+        self.load = load
+        self._blocks = []
+        self._maxes = []
+        self._payload = {}
+        self.count = 0   # number of (key, value) pairs
+
+    @classmethod
+    def from_pairs(cls, pairs, load=1000):
+        "Bulk-load an index from an iterable of (key, value) pairs with one sort"
+        index = cls(load)
+        for key, val in pairs:
+            if key in index._payload:
+                index._payload[key].add(val)
+            else:
+                index._payload[key] = {val}
+        index.count = sum(len(vals) for vals in index._payload.values())
+        keys = sorted(index._payload)
+        index._blocks = [keys[i:i+load] for i in range(0, len(keys), load)]
+        index._maxes = [block[-1] for block in index._blocks]
+        return index
 
     def length(self):
-        return self.size
+        return len(self._payload)
 
     def __len__(self):
-        return self.size
+        return len(self._payload)
 
     def __iter__(self):
-        return self.root.__iter__()
+        for block in self._blocks:
+            yield from block
+
+    def __contains__(self, key):
+        return key in self._payload
+
+    def put(self, key, val):
+        if key in self._payload:
+            if val not in self._payload[key]:
+                self._payload[key].add(val)
+                self.count += 1
+            return
+        self._payload[key] = {val}
+        self.count += 1
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+            return
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+        block = self._blocks[i]
+        insort(block, key)
+        self._maxes[i] = block[-1]
+        if len(block) > 2*self.load:
+            self._blocks[i:i+1] = [block[:self.load], block[self.load:]]
+            self._maxes[i:i+1] = [block[self.load-1], block[-1]]
+
+    def __setitem__(self, k, v):
+        self.put(k, v)
+
+    def get(self, key):
+        return self._payload.get(key)
+
+    def __getitem__(self, key):
+        return self.get(key)
 
-    def put(self,key,val):
-        if self.root:
-            self._put(key,val,self.root)
+    def delete(self, key, val=None):
+        if key not in self._payload:
+            raise KeyError('Error, key not in tree')
+        if val is not None:
+            try:
+                self._payload[key].remove(val)
+            except KeyError:
+                raise KeyError('Error, key-value pair not in tree')
+            self.count -= 1
+            if self._payload[key]:
+                return
         else:
-            self.root = TreeNode(key,val)
-        self.size = self.size + 1
-
-    def _put(self,key,val,currentNode):
-        if key == currentNode.key:
-            currentNode.payload.append(val)
-        elif key < currentNode.key:
-            if currentNode.hasLeftChild():
-                   self._put(key,val,currentNode.leftChild)
-            else:
-                   currentNode.leftChild = TreeNode(key,val,parent=currentNode)
+            self.count -= len(self._payload[key])
+        del self._payload[key]
+        i = bisect_left(self._maxes, key)
+        block = self._blocks[i]
+        del block[bisect_left(block, key)]
+        if block:
+            self._maxes[i] = block[-1]
         else:
-            if currentNode.hasRightChild():
-                   self._put(key,val,currentNode.rightChild)
-            else:
-                   currentNode.rightChild = TreeNode(key,val,parent=currentNode)
+            del self._blocks[i]
+            del self._maxes[i]
 
-    def __setitem__(self,k,v):
-        self.put(k,v)
+    def __delitem__(self, key):
+        self.delete(key)
 
-    def get(self,key):
-        if self.root:
-            res = self._get(key,self.root)
-            if res:
-                return res.payload
-            else:
-                return None
+    def _locate(self, key, right=False):
+        # Position (block, offset) of the first key >= key, or > key if right
+        bis = bisect_right if right else bisect_left
+        i = bis(self._maxes, key)
+        if i == len(self._maxes):
+            return i, 0
+        return i, bis(self._blocks[i], key)
+
+    def _keys(self, start, stop):
+        # Keys from position start up to (not including) position stop
+        i, j = start
+        k, l = stop
+        while i < k or (i == k and j < l):
+            block = self._blocks[i]
+            yield from block[j:(l if i == k else len(block))]
+            i, j = i+1, 0
+
+    def _rank(self, position):
+        # Number of keys before a position
+        i, j = position
+        return sum(len(block) for block in self._blocks[:i]) + j
+
+    def estimate(self, op, key):
+        """
+        Estimate the number of values lookup(op, key) would return: exact for
+        == and !=, and for ranges the number of matching keys times the mean
+        number of values per key.
+        """
+        if op is operator.eq:
+            return len(self._payload.get(key, ()))
+        elif op is operator.ne:
+            return self.count - len(self._payload.get(key, ()))
+        elif op is operator.lt:
+            nkeys = self._rank(self._locate(key))
+        elif op is operator.le:
+            nkeys = self._rank(self._locate(key, right=True))
+        elif op is operator.gt:
+            nkeys = len(self._payload) - self._rank(self._locate(key, right=True))
+        elif op is operator.ge:
+            nkeys = len(self._payload) - self._rank(self._locate(key))
         else:
-            return None
-
-    def _get(self,key,currentNode):
-        if not currentNode:
-            return None
-        elif currentNode.key == key:
-            return currentNode
-        elif key < currentNode.key:
-            return self._get(key,currentNode.leftChild)
+            return self.count
+        return nkeys * self.count / max(len(self._payload), 1)
+
+    def keys(self, op, key):
+        "Iterate over the keys k for which op(k, key) holds, in ascending order"
+        first, last = (0, 0), (len(self._blocks), 0)
+        if op is operator.lt:
+            return self._keys(first, self._locate(key))
+        elif op is operator.le:
+            return self._keys(first, self._locate(key, right=True))
+        elif op is operator.gt:
+            return self._keys(self._locate(key, right=True), last)
+        elif op is operator.ge:
+            return self._keys(self._locate(key), last)
+        elif op is operator.eq:
+            return iter([key] if key in self._payload else [])
         else:
-            return self._get(key,currentNode.rightChild)
+            return (k for k in self._keys(first, last) if op(k, key))
 
-    def __getitem__(self,key):
-        return self.get(key)
-
-    def __contains__(self,key):
-        if self._get(key,self.root):
-            return True
-        else:
-            return False
+    def lookup(self, op, key):
+        "Return the union of the values stored under keys k for which op(k, key) holds"
+        if op is operator.eq:
+            return set(self._payload.get(key, ()))
+        return set().union(*(self._payload[k] for k in self.keys(op, key)))
 
     def collect(self, key, op):
         pklist = []
-        if self.root:
-            pklist += self._collect(key, op, self.root)
-
+        for k in self.keys(op, key):
+            pklist.extend(self._payload[k])
         return pklist
 
-    def _collect(self, key, op, currentNode):
-        pklist = []
-        if op(currentNode.key, key):
-            pklist += currentNode.payload
-        if currentNode.hasLeftChild():
-            pklist += self._collect(key, op, currentNode.leftChild)
-        if currentNode.hasRightChild():
-            pklist += self._collect(key, op, currentNode.rightChild)
-
-        return pklist
-
-    def delete(self,key,val=None):
-        if self.size > 1:
-            nodeToRemove = self._get(key,self.root)
-            if nodeToRemove:
-                if val is None:
-                    self.remove(nodeToRemove)
-                    self.size = self.size-1
-                else:
-                    try:
-                        nodeToRemove.payload.remove(val)
-                    except:
-                        raise KeyError('Error, key-value pair not in tree')
-                    if len(nodeToRemove.payload) == 0:
-                        self.remove(nodeToRemove)
-                        self.size = self.size-1
-            else:
-                raise KeyError('Error, key not in tree')
-        elif self.size == 1 and self.root.key == key:
-            if val is None:
-                self.root = None
-                self.size = self.size-1
-            else:
-                try:
-                    self.root.payload.remove(val)
-                except:
-                    raise KeyError('Error, key-value pair not in tree')
-                if len(self.root.payload) == 0:
-                    self.root = None
-                    self.size = self.size-1
-        else:
-            raise KeyError('Error, key not in tree')
-
-    def __delitem__(self,key):
-        self.delete(key)
-
-    def remove(self,currentNode):
-        if currentNode.isLeaf(): #leaf
-            if currentNode == currentNode.parent.leftChild:
-                currentNode.parent.leftChild = None
-            else:
-                currentNode.parent.rightChild = None
-        elif currentNode.hasBothChildren(): #interior
-            succ = currentNode.findSuccessor()
-            succ.spliceOut()
-            currentNode.key = succ.key
-            currentNode.payload = succ.payload
-        else: # this node has one child
-            if currentNode.hasLeftChild():
-                if currentNode.isLeftChild():
-                    currentNode.leftChild.parent = currentNode.parent
-                    currentNode.parent.leftChild = currentNode.leftChild
-                elif currentNode.isRightChild():
-                    currentNode.leftChild.parent = currentNode.parent
-                    currentNode.parent.rightChild = currentNode.leftChild
-                else:
-                    currentNode.replaceNodeData(currentNode.leftChild.key,
-                                                currentNode.leftChild.payload,
-                                                currentNode.leftChild.leftChild,
-                                                currentNode.leftChild.rightChild)
-            else:
-                if currentNode.isLeftChild():
-                    currentNode.rightChild.parent = currentNode.parent
-                    currentNode.parent.leftChild = currentNode.rightChild
-                elif currentNode.isRightChild():
-                    currentNode.rightChild.parent = currentNode.parent
-                    currentNode.parent.rightChild = currentNode.rightChild
-                else:
-                    currentNode.replaceNodeData(currentNode.rightChild.key,
-                                                currentNode.rightChild.payload,
-                                                currentNode.rightChild.leftChild,
-                                                currentNode.rightChild.rightChild)
-
-class TreeNode:
-    def __init__(self,key,val,left=None,right=None,parent=None):
-        self.key = key
-        self.payload = [val]
-        self.leftChild = left
-        self.rightChild = right
-        self.parent = parent
-
-    def hasLeftChild(self):
-        return self.leftChild
-
-    def hasRightChild(self):
-        return self.rightChild
-
-    def isLeftChild(self):
-        return self.parent and self.parent.leftChild == self
-
-    def isRightChild(self):
-        return self.parent and self.parent.rightChild == self
-
-    def isRoot(self):
-        return not self.parent
-
-    def isLeaf(self):
-        return not (self.rightChild or self.leftChild)
-
-    def hasAnyChildren(self):
-        return self.rightChild or self.leftChild
-
-    def hasBothChildren(self):
-        return self.rightChild and self.leftChild
-
-    def replaceNodeData(self,key,value,lc,rc):
-        self.key = key
-        self.payload = value
-        self.leftChild = lc
-        self.rightChild = rc
-        if self.hasLeftChild():
-            self.leftChild.parent = self
-        if self.hasRightChild():
-            self.rightChild.parent = self
-
-    def spliceOut(self):
-        if self.isLeaf():
-            if self.isLeftChild():
-                self.parent.leftChild = None
-            else:
-                self.parent.rightChild = None
-        elif self.hasAnyChildren():
-            if self.hasLeftChild():
-                if self.isLeftChild():
-                    self.parent.leftChild = self.leftChild
-                else:
-                    self.parent.rightChild = self.leftChild
-                self.leftChild.parent = self.parent
-            else:
-                if self.isLeftChild():
-                    self.parent.leftChild = self.rightChild
-                else:
-                    self.parent.rightChild = self.rightChild
-                self.rightChild.parent = self.parent
-
-    def findSuccessor(self):
-        succ = None
-        if self.hasRightChild():
-            succ = self.rightChild.findMin()
-        else:
-            if self.parent:
-                if self.isLeftChild():
-                    succ = self.parent
-                else:
-                    self.parent.rightChild = None
-                    succ = self.parent.findSuccessor()
-                    self.parent.rightChild = self
-        return succ
-
-    def findMin(self):
-        current = self
-        while current.hasLeftChild():
-            current = current.leftChild
-        return current
-
-
 ##################
 
 Breakpoints = {}
@@ -257,38 +191,148 @@ Breakpoints[64] = np.array([-2.1539,-1.8627,-1.6759,-1.5341,-1.4178,-1.318,-1.22
 
 Breakpoints[128] = np.array([-2.4176,-2.1539,-1.9874,-1.8627,-1.7617,-1.6759,-1.601,-1.5341,-1.4735,-1.4178,-1.3662,-1.318,-1.2727,-1.2299,-1.1892,-1.1503,-1.1132,-1.0775,-1.0432,-1.01,-0.9779,-0.94678,-0.91656,-0.88715,-0.85848,-0.83051,-0.80317,-0.77642,-0.75022,-0.72451,-0.69928,-0.67449,-0.6501,-0.6261,-0.60245,-0.57913,-0.55613,-0.53341,-0.51097,-0.48878,-0.46683,-0.4451,-0.42358,-0.40225,-0.38111,-0.36013,-0.33931,-0.31864,-0.2981,-0.27769,-0.25739,-0.2372,-0.21711,-0.1971,-0.17717,-0.15731,-0.13751,-0.11777,-0.098072,-0.078412,-0.058783,-0.039176,-0.019584,0,0.019584,0.039176,0.058783,0.078412,0.098072,0.11777,0.13751,0.15731,0.17717,0.1971,0.21711,0.2372,0.25739,0.27769,0.2981,0.31864,0.33931,0.36013,0.38111,0.40225,0.42358,0.4451,0.46683,0.48878,0.51097,0.53341,0.55613,0.57913,0.60245,0.6261,0.6501,0.67449,0.69928,0.72451,0.75022,0.77642,0.80317,0.83051,0.85848,0.88715,0.91656,0.94678,0.9779,1.01,1.0432,1.0775,1.1132,1.1503,1.1892,1.2299,1.2727,1.318,1.3662,1.4178,1.4735,1.5341,1.601,1.6759,1.7617,1.8627,1.9874,2.1539,2.4176])
 
-class BinaryTree:
-    def __init__(self, rep=None, parent=None,threshold = 10,wordlength = 16):
-        self.parent = parent
-        self.SAX = rep
-        self.ts = []
-        self.ts_SAX = []
-        self.children = []
+# SAX words are stored as integers rather than strings of bits.  A full word,
+# as computed from a series, is an array of wordlength symbols at the full
+# cardinality 2**card_bits of the tree.  The word of a node is a pair of
+# arrays: its symbols and the number of bits of each symbol, i.e. the
+# cardinality of each segment at that node.  Symbol s with b bits covers the
+# full-cardinality symbols whose top b bits equal s.
+
+MAX_BITS = 7
+
+def _symbol_tables():
+    "Lookup tables indexed by [bits, symbol]: split breakpoint, lower and upper bound of the PAA values covered"
+    size = 2**MAX_BITS
+    split, lower, upper = (np.full((MAX_BITS+1, size), np.nan) for _ in range(3))
+    lower[0, 0], upper[0, 0] = -np.inf, np.inf
+    for b in range(1, MAX_BITS+1):
+        card = 2**b
+        lower[b, :card] = np.concatenate(([-np.inf], Breakpoints[card]))
+        upper[b, :card] = np.concatenate((Breakpoints[card], [np.inf]))
+        if 2*card in Breakpoints:
+            split[b, :card] = Breakpoints[2*card][2*np.arange(card)]
+    return split, lower, upper
+
+SPLIT_VALUES, LOWER_VALUES, UPPER_VALUES = _symbol_tables()
+
+def symbol_dtype(cardinality):
+    "Smallest unsigned integer type holding the symbols of the given cardinality"
+    return np.uint8 if cardinality <= 2**8 else np.uint16
+
+class LeafPool:
+    """
+    State shared by all nodes of one SAX tree: its parameters, the full SAX
+    word of every stored primary key and the leaf holding it, and the online
+    statistics of the leaves.  Each leaf owns one row of the count, mean and
+    dev_accum arrays, which grow geometrically; rows of leaves that split,
+    merge or are dropped are reused.
+    """
+    __slots__ = ('th', 'merge_floor', 'word_length', 'card_bits', 'words', 'leaves', 'count', 'mean', 'dev_accum', 'free')
+
+    def __init__(self, threshold=10, wordlength=16, cardinality=64, merge_floor=None):
         self.th = threshold
-        self.count = 0
-        self.splitting_index = None 
+        self.merge_floor = threshold//2 if merge_floor is None else merge_floor
         self.word_length = wordlength
-        self.online_mean = np.zeros(self.word_length)
-        self.online_stdev = np.zeros(self.word_length)
-        self.dev_accum = np.zeros(self.word_length)
+        self.card_bits = int(np.log2(cardinality))
+        self.words = {}
+        self.leaves = {}
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros((0, wordlength))
+        self.dev_accum = np.zeros((0, wordlength))
+        self.free = []
+
+    def allocate(self):
+        "A zeroed row for a new leaf"
+        if not self.free:
+            n = len(self.count)
+            size = max(16, 2*n)
+            self.count = np.concatenate((self.count, np.zeros(size-n, dtype=np.int64)))
+            self.mean = np.vstack((self.mean, np.zeros((size-n, self.word_length))))
+            self.dev_accum = np.vstack((self.dev_accum, np.zeros((size-n, self.word_length))))
+            self.free = list(range(size-1, n-1, -1))
+        return self.free.pop()
+
+    def release(self, row):
+        self.count[row] = 0
+        self.mean[row] = 0
+        self.dev_accum[row] = 0
+        self.free.append(row)
+
+    def add(self, row, value):
+        "Welford update of the statistics of row with one more value"
+        self.count[row] += 1
+        delta = value - self.mean[row]
+        self.mean[row] += delta/self.count[row]
+        self.dev_accum[row] += delta*(value - self.mean[row])
+
+    def add_many(self, row, values):
+        "The statistics of row with the rows of values added, combined pairwise with those already there"
+        n1, n2 = self.count[row], len(values)
+        if n2 == 0:
+            return
+        n = n1 + n2
+        mean2 = values.mean(axis=0)
+        delta = mean2 - self.mean[row]
+        self.dev_accum[row] += ((values - mean2)**2).sum(axis=0) + delta**2*n1*n2/n
+        self.mean[row] += delta*n2/n
+        self.count[row] = n
+
+    def remove(self, row, value):
+        "Inverse of add: the statistics of row without one of its values"
+        n = self.count[row] - 1
+        if n == 0:
+            self.mean[row] = 0
+            self.dev_accum[row] = 0
+        elif n == 1:
+            self.mean[row] = 2*self.mean[row] - value
+            self.dev_accum[row] = 0
+        else:
+            mean = (self.count[row]*self.mean[row] - value)/n
+            self.dev_accum[row] = np.maximum(self.dev_accum[row] - (value - mean)*(value - self.mean[row]), 0)
+            self.mean[row] = mean
+        self.count[row] = n
+
+    def combine(self, row1, row2):
+        "A new row holding the statistics of the values of both rows, which are released"
+        row = self.allocate()
+        n1, n2 = self.count[row1], self.count[row2]
+        n = n1 + n2
+        if n > 0:
+            delta = self.mean[row2] - self.mean[row1]
+            self.mean[row] = self.mean[row1] + delta*n2/n
+            self.dev_accum[row] = self.dev_accum[row1] + self.dev_accum[row2] + delta**2*n1*n2/n
+        self.count[row] = n
+        self.release(row1)
+        self.release(row2)
+        return row
+
+    def stdev(self, row):
+        if self.count[row] > 1:
+            return np.sqrt(self.dev_accum[row]/(self.count[row]-1))
+        return np.zeros(self.word_length)
+
+
+# The children of every non-root node, which has no root buckets; never written to
+_NO_CHILDREN = {}
+
+class BinaryTree:
+    __slots__ = ('parent', 'left', 'right')
+
+    def __init__(self, parent=None):
+        self.parent = parent
         self.left = None
-        self.right = None    
-            
-    def addLeftChild(self, rep,threshold,wordlength): 
-        n = self.__class__(rep=rep, parent=self,threshold=threshold, wordlength=wordlength)
+        self.right = None
+
+    def addLeftChild(self, rep):
+        n = self.__class__(rep=rep, parent=self)
         self.left = n
         return n
-        
-    def addRightChild(self, rep,threshold,wordlength):
-        n = self.__class__(rep=rep, parent=self,threshold=threshold, wordlength=wordlength)
+
+    def addRightChild(self, rep):
+        n = self.__class__(rep=rep, parent=self)
         self.right = n
         return n
-        
-    def addChild(self, rep,threshold,wordlength):
-        n = self.__class__(rep=rep, parent=self,threshold=threshold, wordlength=wordlength)
-        self.children += [n]
-        return n
-    
+
     def hasLeftChild(self):
         return self.left is not None
 
@@ -300,10 +344,10 @@ class BinaryTree:
 
     def hasBothChildren(self):
         return self.hasRightChild() and self.hasLeftChild()
-    
+
     def hasNoChildren(self):
         return not self.hasRightChild() and not self.hasLeftChild()
-    
+
     def isLeftChild(self):
         return self.parent and self.parent.left == self
 
@@ -314,48 +358,123 @@ class BinaryTree:
         return not self.parent
 
     def isLeaf(self):
-        return not (self.right or self.left)    
-                
+        return not (self.right or self.left)
+
 class SAXTree(BinaryTree):
-        
-    def __init__(self, rep=None, parent=None, threshold = 10, wordlength = 16):
-        super().__init__(rep, parent,threshold,wordlength)
-        
+    # Nodes are slotted.  Parameters, words and leaf statistics live in the
+    # LeafPool shared by the whole tree: a leaf holds its primary keys and the
+    # row of its statistics, an internal node only its word, splitting index
+    # and children (its ts is an empty tuple and its row None), and only the
+    # root uses children, buckets and bucket_counts.
+    __slots__ = ('pool', 'SAX', 'SAX_bits', 'ts', 'row', 'splitting_index', 'children', 'buckets', 'bucket_counts')
+
+    def __init__(self, rep=None, parent=None, threshold = 10, wordlength = 16, cardinality = 64, merge_floor = None):
+        super().__init__(parent)
+        if rep is None:
+            self.SAX, self.SAX_bits = None, None
+        else:
+            self.SAX, self.SAX_bits = rep
+        self.splitting_index = None
+        if parent is None:
+            self.pool = LeafPool(threshold, wordlength, cardinality, merge_floor)
+            self.ts = ()
+            self.row = None
+            self.children = {}
+            self.buckets = []
+            self.bucket_counts = {}
+        else:
+            self.pool = parent.pool
+            self.ts = []
+            self.row = self.pool.allocate()
+            self.children = _NO_CHILDREN
+            self.buckets = self.bucket_counts = None
+
+    @property
+    def th(self):
+        return self.pool.th
+
+    @property
+    def word_length(self):
+        return self.pool.word_length
+
+    @property
+    def card_bits(self):
+        return self.pool.card_bits
+
+    @property
+    def count(self):
+        return 0 if self.row is None else int(self.pool.count[self.row])
+
+    @property
+    def online_mean(self):
+        return None if self.row is None else self.pool.mean[self.row]
+
+    @property
+    def online_stdev(self):
+        return None if self.row is None else self.pool.stdev(self.row)
+
+    @property
+    def ts_SAX(self):
+        return [self.pool.words[pk] for pk in self.ts]
+
     def _insert_hook(self):
         pass
-            
+
+    def root_index(self, rep):
+        "Index of the root child holding the full word rep, from the top bit of each symbol"
+        top = (np.asarray(rep, dtype=np.int64) >> (self.card_bits-1)) & 1
+        return int(top @ (1 << np.arange(self.word_length-1, -1, -1)))
+
+    def bucket_words(self, indexes):
+        "The 1-bit symbols of the root children with the given indexes, one row per child"
+        shifts = np.arange(self.word_length-1, -1, -1)
+        return (np.asarray(indexes, dtype=np.int64)[:,np.newaxis] >> shifts) & 1
+
+    def bucket(self, index):
+        "The root child with the given index, created on first use"
+        if index not in self.children:
+            symbols = self.bucket_words([index])[0].astype(symbol_dtype(2**self.card_bits))
+            bits = np.ones(self.word_length, dtype=np.uint8)
+            self.children[index] = self.__class__(rep=(symbols, bits), parent=self)
+        return self.children[index]
+
+    def goes_right(self, rep):
+        "Whether the full word rep belongs under the right child of this internal node"
+        l = int(self.SAX_bits[self.splitting_index])
+        return (int(rep[self.splitting_index]) >> (self.card_bits-l-1)) & 1 == 1
+
     def insert(self, pk,rep):
         if self.parent == None:
-            index = 0
-            for i,symbol in enumerate(rep):
-                if symbol[0] == '1':
-                    index += 2**(self.word_length-i-1)
-            self.children[index].insert(pk,rep)
+            # Root children are created lazily, and buckets lists the non-empty ones
+            index = self.root_index(rep)
+            self.pool.words[pk] = rep
+            self.bucket(index).insert(pk,rep)
+            if index not in self.bucket_counts:
+                self.bucket_counts[index] = 0
+                insort(self.buckets, index)
+            self.bucket_counts[index] += 1
         elif self.right == None and self.left == None and self.count < self.th:
-            self.ts += [pk]
-            self.ts_SAX += [rep]
+            self.ts.append(pk)
+            self.pool.leaves[pk] = self
             self.mean_std_calculator(rep)
         elif self.right == None and self.left == None:
             self.split()
-            l = len(self.SAX[self.splitting_index])
-            if rep[self.splitting_index][l] == '1':
+            if self.goes_right(rep):
                 self.right.insert(pk,rep)
             else:
                 self.left.insert(pk,rep)
         else:
-            l = len(self.SAX[self.splitting_index])
-            if rep[self.splitting_index][l] == '1':
+            if self.goes_right(rep):
                 self.right.insert(pk,rep)
             else:
                 self.left.insert(pk,rep)
-            
+
     def search(self, rep, pk = None):
         if pk is not None:
             if self.parent == None:
-                index = 0
-                for i,symbol in enumerate(rep):
-                    if symbol[0] == '1':
-                        index += 2**(self.word_length-i-1)
+                index = self.root_index(rep)
+                if index not in self.children:
+                    raise ValueError('"{}" not found'.format(pk))
                 return self.children[index].search(rep,pk)
             elif self.right == None and self.left == None:
                 if pk in self.ts:
@@ -363,40 +482,30 @@ class SAXTree(BinaryTree):
                 else:
                     raise ValueError('"{}" not found'.format(pk))
             else:
-                l = len(self.SAX[self.splitting_index])
-                if rep[self.splitting_index][l] == '1':
+                if self.goes_right(rep):
                     return self.right.search(rep,pk)
                 else:
                     return self.left.search(rep,pk)
         else:
             if self.parent == None:
-                index = 0
-                for i,symbol in enumerate(rep):
-                    if symbol[0] == '1':
-                        index += 2**(self.word_length-i-1)
-                return self.children[index].search(rep)
+                return self.children.get(self.root_index(rep))
             elif self.right == None and self.left == None:
                 return self
             else:
-                l = len(self.SAX[self.splitting_index])
-                if rep[self.splitting_index][l] == '1':
+                if self.goes_right(rep):
                     return self.right.search(rep)
                 else:
                     return self.left.search(rep)
-    
+
     def search2(self, rep):
         if self.parent == None:
-            children = []
-            for i, child in enumerate(self.children):
-                if child.splitting_index is not None or len(child.ts)>0:
-                    children += [child]
-            dists = np.zeros(len(children))
+            # Nearest non-empty bucket, ties going to the lowest index
+            if not self.buckets:
+                return None
             num0 = self.word2number(rep)
-            for i, child in enumerate(children):
-                num1 = self.word2number(child.SAX)
-                dists[i] = np.linalg.norm(num1-num0)
-            index = np.argmin(dists)
-            return children[index].search2(rep)
+            num1 = SPLIT_VALUES[1, self.bucket_words(self.buckets)]
+            dists = np.linalg.norm(num1-num0, axis=1)
+            return self.children[self.buckets[np.argmin(dists)]].search2(rep)
         elif self.right == None and self.left == None:
             return self
         else:
@@ -408,140 +517,226 @@ class SAXTree(BinaryTree):
             if self.left.splitting_index is not None or len(self.left.ts)>0:
                 children += [self.left]
             for i, child in enumerate(children):
-                num1 = self.word2number(child.SAX)
+                num1 = self.word2number(child.SAX, child.SAX_bits)
                 dists[i] = np.linalg.norm(num1-num0)
             index = np.argmin(dists)
             return children[index].search2(rep)
-            
-    def delete(self, rep, pk):        
-        n = self.search(rep,pk)
-        index = n.ts.index(pk)
+
+    def _release(self):
+        "Return the statistics rows of the leaves under this node to the pool"
+        if self.row is not None:
+            self.pool.release(self.row)
+            self.row = None
+        for child in (self.left, self.right):
+            if child is not None:
+                child._release()
+
+    def delete(self, rep, pk):
+        if pk not in self.pool.leaves:
+            raise ValueError('"{}" not found'.format(pk))
+        n = self.pool.leaves.pop(pk)
+        word = self.pool.words.pop(pk)
+        index = self.root_index(word)
+        self.bucket_counts[index] -= 1
+        if self.bucket_counts[index] == 0:
+            # Empty buckets are dropped along with any splits below them
+            del self.bucket_counts[index]
+            self.children.pop(index)._release()
+            self.buckets.pop(bisect_left(self.buckets, index))
+            return
         n.ts.remove(pk)
-        n.ts_SAX = n.ts_SAX[:index]+n.ts_SAX[index+1:]
-        n.online_mean = np.zeros(self.word_length)
-        n.online_stdev = np.zeros(self.word_length)
-        n.dev_accum = np.zeros(self.word_length)
-        n.count = 0
-        for word in n.ts_SAX:
-            n.mean_std_calculator(word)
-        
-       
-    def word2number(self,word):
-        number = []
-        for j in word:
-            l = len(j)
-            length = 2**l
-            for t in sorted(Breakpoints.keys()):
-                if length < t:
-                    key = t
-                    break
-            num = int(j,2)
-            ind = 2*num
-            number += [Breakpoints[key][ind]]
-        return np.array(number)
-    
+        self.pool.remove(n.row, self.word2number(word))
+        # Fold sparse sibling leaves back into their parent, up the tree
+        node = n.parent
+        while node.parent is not None and node.left.row is not None and node.right.row is not None \
+                and node.left.count + node.right.count < self.pool.merge_floor:
+            node.merge()
+            node = node.parent
+
+    def merge(self):
+        "Turn this internal node, whose children are both leaves, back into a leaf holding their series"
+        self.ts = self.left.ts + self.right.ts
+        self.row = self.pool.combine(self.left.row, self.right.row)
+        for pk in self.ts:
+            self.pool.leaves[pk] = self
+        self.left = None
+        self.right = None
+        self.splitting_index = None
+
+
+    def word2number(self, symbols, bits=None):
+        "Breakpoints at which the given symbols would be split; bits defaults to the full cardinality"
+        if bits is None:
+            bits = self.card_bits
+        return SPLIT_VALUES[bits, symbols]
+
+    def mindist(self, paa, tslen):
+        """
+        iSAX MINDIST: a lower bound on the Euclidean distance between a
+        standardized series of length tslen, with PAA values paa, and any
+        standardized series stored under this node
+        """
+        lower = LOWER_VALUES[self.SAX_bits, self.SAX]
+        upper = UPPER_VALUES[self.SAX_bits, self.SAX]
+        gap = np.maximum(lower-paa, 0) + np.maximum(paa-upper, 0)
+        return np.sqrt(tslen/len(paa)) * np.linalg.norm(gap)
+
     def mean_std_calculator(self,word):
-        self.count += 1
-        mu_1 = self.online_mean
-        value = self.word2number(word)
-        delta = value - self.online_mean
-        self.online_mean = self.online_mean + delta/self.count
-        prod = (value-self.online_mean)*(value-mu_1)
-        self.dev_accum = self.dev_accum + prod
-        if self.count > 1:
-            self.online_stdev = np.sqrt(self.dev_accum/(self.count-1))
-    
-    def getBreakPoint(self,s):
-        l = len(s)
-        length = 2**l
-        for t in sorted(Breakpoints.keys()):
-            if length < t:
-                key = t
-                break
-        num = int(s,2)
-        ind = 2*num
-        return Breakpoints[key][ind]
-    
+        self.pool.add(self.row, self.word2number(word))
+
     def split(self):
+        if self.SAX is not None:
+            self.IncreaseCardinality(None,self.split_order(self.online_mean,self.online_stdev),0)
+
+    def split_order(self, online_mean, online_stdev):
+        "Segments in the order they are tried for splitting a leaf whose words have the given statistics"
         segmentToSplit = None
         if self.SAX is not None:
+            breakpoints = self.word2number(self.SAX, self.SAX_bits)
             diff = None
             diffs = np.zeros(self.word_length)
             diffs = diffs+10.
-            for i,s in enumerate(self.SAX):
-                b = self.getBreakPoint(s) 
-                if b <= self.online_mean[i] + 3*self.online_stdev[i] and b >= self.online_mean[i] - 3*self.online_stdev[i]:
-                    if diff is None or np.abs(self.online_mean[i] - b) < diff:
+            for i,b in enumerate(breakpoints):
+                if b <= online_mean[i] + 3*online_stdev[i] and b >= online_mean[i] - 3*online_stdev[i]:
+                    if diff is None or np.abs(online_mean[i] - b) < diff:
                         segmentToSplit = i
-                        diff = np.abs(self.online_mean[i] - b)
+                        diff = np.abs(online_mean[i] - b)
                         diffs[i] = diff
-            
+
             if segmentToSplit == None:
                 diff = None
                 diffs = np.zeros(self.word_length)
                 diffs = diffs + 10.
-                for i,s in enumerate(self.SAX):
-                    b = self.getBreakPoint(s) 
-                    if diff is None or np.abs(self.online_mean[i] - b) < diff:
+                for i,b in enumerate(breakpoints):
+                    if diff is None or np.abs(online_mean[i] - b) < diff:
                         segmentToSplit = i
-                        diff = np.abs(self.online_mean[i] - b)
+                        diff = np.abs(online_mean[i] - b)
                         diffs[i] = diff
-                
-            self.IncreaseCardinality(segmentToSplit,np.argsort(diffs),0)
-    
+
+            return np.argsort(diffs)
+
     def IncreaseCardinality(self, segment,order,index):
         segment = order[index]
         if self.SAX is None:
             raise ValueError('Cannot increase cardinality of root node')
-        newSAXupper = list(self.SAX)
-        newSAXupper[segment] = newSAXupper[segment]+'1'
-        newSAXlower = list(self.SAX)
-        newSAXlower[segment] = newSAXlower[segment]+'0'
-        newtsupper = []
-        newtslower = []
-        newts_SAXupper = []
-        newts_SAXlower = [] 
-        t = 0
-        l = len(newSAXupper[segment])
-        for i,word in enumerate(self.ts_SAX):
-            if len(word[segment])<l:
-                for ts in self.ts:
-                    lengths = len([i for i, j in enumerate(self.ts) if j == ts])
-                    if lengths > 1:
-                        raise ValueError("Inserted same time series twice")
-                if index == len(order):
-                    raise ValueError("Overflow error, consider increasing threshold or cardinality")
-                else:
-                    self.IncreaseCardinality(segment,order,index+1)
-                    t = 1
-                    break
-            if word[segment][l-1] == '1':
-                newts_SAXupper += [word]
-                newtsupper += [self.ts[i]]
-            else:
-                newts_SAXlower += [word]
-                newtslower += [self.ts[i]]
-        
-        if t == 0:
-            self.addLeftChild(rep=newSAXlower,threshold=self.th, wordlength=self.word_length)
-            self.addRightChild(rep=newSAXupper,threshold=self.th, wordlength=self.word_length)
-            for word in newts_SAXupper:
-                self.right.mean_std_calculator(word)
-            self.right.ts = list(newtsupper)
-            self.right.ts_SAX = list(newts_SAXupper)
-            for word in newts_SAXlower:
-                self.left.mean_std_calculator(word)
-            self.left.ts = list(newtslower)
-            self.left.ts_SAX = list(newts_SAXlower)
+        l = int(self.SAX_bits[segment]) + 1
+        if l > self.card_bits:
+            # every stored word is already fully split on this segment
+            if len(set(self.ts)) < len(self.ts):
+                raise ValueError("Inserted same time series twice")
+            if index+1 == len(order):
+                raise ValueError("Overflow error, consider increasing threshold or cardinality")
+            return self.IncreaseCardinality(segment,order,index+1)
+        pks, words = self.ts, self.ts_SAX
+        self.split_on(segment)
+        for pk, word in zip(pks, words):
+            child = self.right if self.goes_right(word) else self.left
+            child.ts.append(pk)
+            self.pool.leaves[pk] = child
+            child.mean_std_calculator(word)
+
+    def split_on(self, segment):
+        "Turn this leaf into an internal node split on segment, with two empty leaves"
+        l = int(self.SAX_bits[segment]) + 1
+        bits = self.SAX_bits.copy()
+        bits[segment] = l
+        newSAXlower = self.SAX.copy()
+        newSAXlower[segment] = 2*newSAXlower[segment]
+        newSAXupper = newSAXlower.copy()
+        newSAXupper[segment] += 1
+        self.addLeftChild(rep=(newSAXlower, bits))
+        self.addRightChild(rep=(newSAXupper, bits))
+        self.ts = ()
+        self.pool.release(self.row)
+        self.row = None
+        self.splitting_index = segment
+
+    # Bulk loading, after iSAX 2.0: the words of a batch are buffered per
+    # root bucket, and each buffer is pushed down its subtree in one pass,
+    # splitting a node at most once however many of the words land in it.
+    # Words are 2d arrays of symbols, one row per primary key.
+
+    def insert_many(self, pks, reps):
+        "Inserts the full words reps of the primary keys pks, at the root"
+        words = np.asarray(reps)
+        if len(pks) == 0:
+            return
+        top = (words.astype(np.int64) >> (self.card_bits-1)) & 1
+        indexes = top @ (1 << np.arange(self.word_length-1, -1, -1))
+        order = np.argsort(indexes, kind='stable')
+        pks = np.array(pks, dtype=object)[order]
+        words, indexes = words[order], indexes[order]
+        self.pool.words.update(zip(pks, words))
+        buckets, starts, counts = np.unique(indexes, return_index=True, return_counts=True)
+        for index, start, count in zip(buckets.tolist(), starts, counts):
+            self.bucket(index).load(pks[start:start+count], words[start:start+count])
+            if index not in self.bucket_counts:
+                self.bucket_counts[index] = 0
+                insort(self.buckets, index)
+            self.bucket_counts[index] += int(count)
+
+    def overflows(self, reps):
+        """
+        Whether inserting the full words reps would raise an overflow error.
+        A leaf only overflows when it holds more than threshold identical 
+        words, which no split can separate.
+        """
+        words, counts = np.unique(np.asarray(reps), axis=0, return_counts=True)
+        for word, count in zip(words, counts.tolist()):
+            node = self.children.get(self.root_index(word))
+            while node is not None and node.row is None:
+                node = node.right if node.goes_right(word) else node.left
+            if node is not None and count + node.count > self.th:
+                count += sum(1 for stored in node.ts_SAX if np.array_equal(stored, word))
+            if count > self.th:
+                return True
+        return False
+
+    def load(self, pks, words):
+        "Adds a buffer of words to the subtree under this node"
+        if len(pks) == 0:
+            return
+        if self.row is None:
+            si = self.splitting_index
+            l = int(self.SAX_bits[si])
+            upper = ((words[:,si].astype(np.int64) >> (self.card_bits-l-1)) & 1).astype(bool)
+            self.left.load(pks[~upper], words[~upper])
+            self.right.load(pks[upper], words[upper])
+        elif self.count + len(pks) <= self.th:
+            self.ts.extend(pks)
+            for pk in pks:
+                self.pool.leaves[pk] = self
+            self.pool.add_many(self.row, self.word2number(words))
+        else:
+            # The leaf overflows: rebuild it from its own words and the buffer
+            if self.ts:
+                pks = np.concatenate((np.array(self.ts, dtype=object), pks))
+                words = np.concatenate((np.array(self.ts_SAX), words))
             self.ts = []
-            self.ts_SAX = []
-            self.count = 0
-            self.online_mean = None
-            self.online_stdev = None
-            self.dev_accum = None
-            self.splitting_index = segment
-        
-        
+            self.pool.release(self.row)
+            self.row = self.pool.allocate()
+            self.build(pks, words)
+
+    def build(self, pks, words):
+        "Fills this empty leaf with the given words, splitting it as many times as needed"
+        if len(pks) <= self.th:
+            self.load(pks, words)
+            return
+        values = self.word2number(words)
+        for segment in self.split_order(values.mean(axis=0), values.std(axis=0, ddof=1)):
+            if self.SAX_bits[segment] < self.card_bits:
+                break
+        else:
+            if len(set(pks)) < len(pks):
+                raise ValueError("Inserted same time series twice")
+            raise ValueError("Overflow error, consider increasing threshold or cardinality")
+        self.split_on(segment)
+        l = int(self.SAX_bits[segment]) + 1
+        upper = ((words[:,segment].astype(np.int64) >> (self.card_bits-l)) & 1).astype(bool)
+        self.left.build(pks[~upper], words[~upper])
+        self.right.build(pks[upper], words[upper])
+
+
     def __iter__(self):
         if self is not None:
             if self.hasLeftChild():
@@ -552,23 +747,21 @@ class SAXTree(BinaryTree):
             if self.hasRightChild():
                 for node in self.right:
                     yield node
-                    
+
     def __len__(self):#expensive O(n) version
         start=0
         for node in self:
             start += 1
         return start
-    
+
     def __getitem__(self, i):
         return self.ithorder(i+1)
-    
+
     def __contains__(self, data):
         return self.search(data) is not None
 
 class Tree_Initializer():
-    def __init__(self, threshold = 10, wordlength = 16):
-        self.tree = SAXTree(threshold=threshold, wordlength=wordlength)
-        words = [list('{0:b}'.format(i).zfill(int(np.log(2**wordlength-1)/np.log(2))+1)) for i in range(2**wordlength)]
-        for i in range(2**wordlength):
-            self.tree.addChild(words[i],threshold,wordlength)
-        
\ No newline at end of file
+    def __init__(self, threshold = 10, wordlength = 16, cardinality = 64, merge_floor = None):
+        # The root has one child per combination of the top bits of the
+        # symbols; they are created by SAXTree.bucket on first insert
+        self.tree = SAXTree(threshold=threshold, wordlength=wordlength, cardinality=cardinality, merge_floor=merge_floor)
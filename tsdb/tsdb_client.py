@@ -14,6 +14,11 @@ class TSDBClient(object):
         print("C> insert_ts msg", msg)
         return self._send(msg)
 
+    def insert_many(self, primary_keys, tslist, metas=None):
+        msg = TSDBOp_InsertMany(primary_keys, tslist, metas).to_json()
+        print("C> insert_many msg", msg)
+        return self._send(msg)
+
     def upsert_meta(self, primary_key, metadata_dict):
         msg = TSDBOp_UpsertMeta(primary_key, metadata_dict).to_json()
         print("C> upsert msg", msg)
@@ -29,14 +34,24 @@ class TSDBClient(object):
         print("C> add_vp msg", msg)
         return self._send(msg)
 
-    def simsearch(self, ts):
-        msg = TSDBOp_SimSearch(ts).to_json()
+    def choose_vps(self, n, strategy='farthest'):
+        msg = TSDBOp_ChooseVPs(n, strategy).to_json()
+        print("C> choose_vps msg", msg)
+        return self._send(msg)
+
+    def simsearch(self, ts, k=None):
+        msg = TSDBOp_SimSearch(ts, k).to_json()
         print("C> simsearch msg", msg)
         return self._send(msg)
 
-    def sim_search_SAX(self, arg):
+    def range_search(self, ts, r, sax=False):
+        msg = TSDBOp_RangeSearch(ts, r, sax).to_json()
+        print("C> range_search msg", msg)
+        return self._send(msg)
+
+    def sim_search_SAX(self, arg, k=None, exact=False, max_leaves=None, max_candidates=None, deadline_ms=None, standardized=False):
         #your code here
-        msg = TSDBOp_SimsearchSAX(arg).to_json()
+        msg = TSDBOp_SimsearchSAX(arg, k, exact, max_leaves, max_candidates, deadline_ms, standardized).to_json()
         print("C> simsearch_sax", msg)
         return self._send(msg)
     
@@ -77,29 +92,32 @@ class TSDBClient(object):
         loop.run_until_complete(coro)
         return coro.result()
         
-async def tcp_echo_client(message,loop,port,host='127.0.0.1'):
-    reader, writer = await asyncio.open_connection(host, port,
-                                                        loop=loop)
+async def request(message, port, host='127.0.0.1'):
+    "Sends the JSON operation message to the server on port, and returns its whole decoded response"
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(serialize(message))
+        deserializer = Deserializer()
+        # Responses (e.g. large selects) may arrive over several reads
+        while not deserializer.ready():
+            data = await reader.read(8192)
+            if not data:
+                raise TSDBConnectionError("Server on port {} closed the connection".format(port))
+            deserializer.append(data)
+        return deserializer.deserialize()
+    finally:
+        writer.close()
 
+async def tcp_echo_client(message,loop,port,host='127.0.0.1'):
     print('Send: %r' % message)
-    writer.write(serialize(message))
-    status= None
-    payload=None
-    data = await reader.read(8192)
+    msg = await request(message, port, host)
     print('C>received message')
-    deserializer=Deserializer()
-    deserializer.append(data)
-    if deserializer.ready():
-        msg=deserializer.deserialize()
-        status = TSDBStatus(msg['status'])
-        print ("C> status:", status)
-        payload = msg['payload']
-        print ("C> payload:", payload)
+    status = TSDBStatus(msg['status'])
+    print ("C> status:", status)
+    payload = msg['payload']
+    print ("C> payload:", payload)
     return status, payload
 
-    print('Close the socket')
-    writer.close()
-
 # message = sys.argv[1]
 # loop = asyncio.get_event_loop()
 # loop.run_until_complete(tcp_echo_client(message, loop))
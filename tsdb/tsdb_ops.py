@@ -23,13 +23,15 @@ class TSDBOp(dict):
         json_dict = {}
         if isinstance(obj, str) or not hasattr(obj, '__len__') or obj is None:
             return obj
+        if isinstance(obj, (list, tuple)):
+            return [i.to_json() if hasattr(i, 'to_json') else self.to_json(i) for i in obj]
         for k, v in obj.items():
             if isinstance(v, str) or not hasattr(v, '__len__') or v is None:
                 json_dict[k] = v
             elif isinstance(v, TSDBStatus):
                 json_dict[k] = v.name
-            elif isinstance(v, list):
-                json_dict[k] = [self.to_json(i) for i in v]
+            elif isinstance(v, (list, tuple)):
+                json_dict[k] = self.to_json(v)
             elif isinstance(v, OrderedDict):
                 tuples=[]
                 for key in v:
@@ -61,6 +63,15 @@ class TSDBOp_InsertTS(TSDBOp):
     def from_json(cls, json_dict):
         return cls(json_dict['pk'], ts.TimeSeries(*(json_dict['ts'])))
 
+class TSDBOp_InsertMany(TSDBOp):
+    def __init__(self, pks, ts, metas=None):
+        super().__init__('insert_many')
+        self['pks'], self['ts'], self['metas'] = pks, ts, metas
+
+    @classmethod
+    def from_json(cls, json_dict):
+        return cls(json_dict['pks'], [ts.TimeSeries(*t) for t in json_dict['ts']], json_dict['metas'])
+
 class TSDBOp_DeleteTS(TSDBOp):
     def __init__(self, pk):
         super().__init__('delete_ts')
@@ -79,14 +90,32 @@ class TSDBOp_AddVP(TSDBOp):
     def from_json(cls, json_dict):
         return cls(json_dict['pk'])
 
+class TSDBOp_ChooseVPs(TSDBOp):
+    def __init__(self, n, strategy='farthest'):
+        super().__init__('choose_vps')
+        self['n'], self['strategy'] = n, strategy
+
+    @classmethod
+    def from_json(cls, json_dict):
+        return cls(json_dict['n'], json_dict.get('strategy', 'farthest'))
+
 class TSDBOp_SimSearch(TSDBOp):
-    def __init__(self, ts):
+    def __init__(self, ts, k=None):
         super().__init__('simsearch')
-        self['ts'] = ts
+        self['ts'], self['k'] = ts, k
+
+    @classmethod
+    def from_json(cls, json_dict):
+        return cls(ts.TimeSeries(*(json_dict['ts'])), json_dict.get('k'))
+
+class TSDBOp_RangeSearch(TSDBOp):
+    def __init__(self, ts, r, sax=False):
+        super().__init__('range_search')
+        self['ts'], self['r'], self['sax'] = ts, r, sax
 
     @classmethod
     def from_json(cls, json_dict):
-        return cls(ts.TimeSeries(*(json_dict['ts'])))
+        return cls(ts.TimeSeries(*(json_dict['ts'])), json_dict['r'], json_dict.get('sax', False))
 
 class TSDBOp_Return(TSDBOp):
 
@@ -123,13 +152,21 @@ class TSDBOp_Select(TSDBOp):
 
 class TSDBOp_SimsearchSAX(TSDBOp):
 
-    def __init__(self, arg):
+    def __init__(self, arg, k=None, exact=False, max_leaves=None, max_candidates=None, deadline_ms=None, standardized=False):
         super().__init__('sim_search_SAX')
         self['arg'] = arg
+        self['k'] = k
+        self['exact'] = exact
+        self['max_leaves'] = max_leaves
+        self['max_candidates'] = max_candidates
+        self['deadline_ms'] = deadline_ms
+        self['standardized'] = standardized
 
     @classmethod
     def from_json(cls, json_dict):
-        return cls(json_dict['arg'])
+        return cls(json_dict['arg'], json_dict.get('k'), json_dict.get('exact', False),
+                   json_dict.get('max_leaves'), json_dict.get('max_candidates'), json_dict.get('deadline_ms'),
+                   json_dict.get('standardized', False))
 
 class TSDBOp_AugmentedSelect(TSDBOp):
     """
@@ -182,9 +219,12 @@ class TSDBOp_RemoveTrigger(TSDBOp):
 # This simplifies reconstructing TSDBOp instances from network data.
 typemap = {
   'insert_ts': TSDBOp_InsertTS,
+  'insert_many': TSDBOp_InsertMany,
   'delete_ts': TSDBOp_DeleteTS,
   'add_vp': TSDBOp_AddVP,
+  'choose_vps': TSDBOp_ChooseVPs,
   'simsearch': TSDBOp_SimSearch,
+  'range_search': TSDBOp_RangeSearch,
   'sim_search_SAX': TSDBOp_SimsearchSAX,
   'upsert_meta': TSDBOp_UpsertMeta,
   'select': TSDBOp_Select,
@@ -1,10 +1,14 @@
 import asyncio
+import heapq
+import zlib
 from .persistentdb import PersistentDB
+from .workers import ScoringPool, PARALLEL_MIN
 from importlib import import_module
 from collections import defaultdict, OrderedDict
 from .tsdb_serialization import Deserializer, serialize
 from .tsdb_error import *
 from .tsdb_ops import *
+from .tsdb_client import request
 import procs
 
 def trigger_callback_maker(pk, target, calltomake):
@@ -22,6 +26,13 @@ class TSDBProtocol(asyncio.Protocol):
         self.deserializer = Deserializer()
         self.futures = []
 
+    async def _offload(self, fn, *args):
+        # Operations which may wait for the worker processes run in a thread,
+        # so that the loop keeps serving other connections meanwhile
+        if self.server.db.workers is None:
+            return fn(*args)
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
     def _insert_ts(self, op):
         try:
             self.server.db.insert_ts(op['pk'], op['ts'])
@@ -30,6 +41,15 @@ class TSDBProtocol(asyncio.Protocol):
         self._run_trigger('insert_ts', [op['pk']])
         return TSDBOp_Return(TSDBStatus.OK, op['op'])
 
+    async def _insert_many(self, op):
+        try:
+            tslist = op['ts']
+            await self._offload(self.server.db.insert_many, op['pks'], [t.time for t in tslist], [t.data for t in tslist], op['metas'])
+        except ValueError as e:
+            return TSDBOp_Return(TSDBStatus.INVALID_KEY, op['op'])
+        self._run_trigger('insert_ts', op['pks'])
+        return TSDBOp_Return(TSDBStatus.OK, op['op'])
+
     def _delete_ts(self, op):
         try:
             self.server.db.delete_ts(op['pk'])
@@ -38,22 +58,37 @@ class TSDBProtocol(asyncio.Protocol):
         self._run_trigger('delete_ts', [op['pk']])
         return TSDBOp_Return(TSDBStatus.OK, op['op'])
 
-    def _add_vp(self, op):
+    async def _add_vp(self, op):
         try:
-            self.server.db.add_vp(op['pk'])
+            await self._offload(self.server.db.add_vp, op['pk'])
         except ValueError as e:
             return TSDBOp_Return(TSDBStatus.INVALID_KEY, op['op'])
         self._run_trigger('add_vp', [op['pk']])
         return TSDBOp_Return(TSDBStatus.OK, op['op'])
 
-    def _simsearch(self, op):
+    async def _choose_vps(self, op):
         try:
-            match = self.server.db.simsearch(op['ts'])
+            vps, fraction = await self._offload(self.server.db.choose_vps, op['n'], op['strategy'])
+        except ValueError as e:
+            return TSDBOp_Return(TSDBStatus.INVALID_KEY, op['op'])
+        self._run_trigger('add_vp', vps)
+        return TSDBOp_Return(TSDBStatus.OK, op['op'], [vps, fraction])
+
+    async def _simsearch(self, op):
+        try:
+            match = await self._offload(self.server.db.simsearch, op['ts'], op['k'])
             self._run_trigger('simsearch', [op['ts']])
         except:
             return TSDBOp_Return(TSDBStatus.INVALID_KEY, op['op'])
         return TSDBOp_Return(TSDBStatus.OK, op['op'], match)
 
+    async def _range_search(self, op):
+        try:
+            matches = await self._offload(self.server.db.range_search, op['ts'], op['r'], op['sax'])
+        except ValueError as e:
+            return TSDBOp_Return(TSDBStatus.INVALID_KEY, op['op'])
+        return TSDBOp_Return(TSDBStatus.OK, op['op'], matches)
+
     def _upsert_meta(self, op):
         try:
             self.server.db.upsert_meta(op['pk'], op['md'])
@@ -75,14 +110,15 @@ class TSDBProtocol(asyncio.Protocol):
             d = OrderedDict((k,{}) for k in loids)
             return TSDBOp_Return(TSDBStatus.OK, op['op'], d)
         
-    def _sim_search_SAX(self, op):
+    async def _sim_search_SAX(self, op):
         try:
-            pk = self.server.db.simsearch_SAX(op['arg'])
+            pk = await self._offload(self.server.db.simsearch_SAX, op['arg'], op['k'], op['exact'],
+                                     op['max_leaves'], op['max_candidates'], op['deadline_ms'], op['standardized'])
         except ValueError as e:
             return TSDBOp_Return(TSDBStatus.INVALID_KEY, op['op'])
         return TSDBOp_Return(TSDBStatus.OK, op['op'], pk)
     
-    def _augmented_select(self, op):
+    async def _augmented_select(self, op):
         "run a select and then synchronously run some computation on it"
         try:
             loids, fields = self.server.db.select(op['md'], None, op['additional'])
@@ -102,10 +138,18 @@ class TSDBProtocol(asyncio.Protocol):
             results=[]
         except:
             return TSDBOp_Return(TSDBStatus.INVALID_KEY, op['op'])
-        for pk in loids:
-            row = self.server.db.rows[pk]
-            result = storedproc(pk, row, arg)
-            results.append(dict(zip(target, result)))
+        workers = self.server.db.workers
+        if workers is not None and len(loids) >= PARALLEL_MIN:
+            # The workers read the timeseries from the segments themselves
+            loids = list(loids)
+            rows = [{field: value for field, value in self.server.db.rows[pk].items() if field != 'ts'} for pk in loids]
+            for result in await workers.run_proc(proc, self.server.db.tsstore, loids, rows, arg):
+                results.append(dict(zip(target, result)))
+        else:
+            for pk in loids:
+                row = self.server.db.rows[pk]
+                result = storedproc(pk, row, arg)
+                results.append(dict(zip(target, result)))
         return TSDBOp_Return(TSDBStatus.OK, op['op'], dict(zip(loids, results)))
 
     def _add_trigger(self, op):
@@ -148,7 +192,20 @@ class TSDBProtocol(asyncio.Protocol):
             for pk in rowmatch:
                 row = self.server.db.rows[pk]
                 task = asyncio.ensure_future(t(pk, row, arg))
-                task.add_done_callback(trigger_callback_maker(pk, target, self.server.db.upsert_meta))
+                task.add_done_callback(trigger_callback_maker(pk, target, self._upsert_later))
+
+    def _upsert_later(self, pk, meta):
+        # A trigger finishes outside of _respond, so its upsert is queued
+        # behind the database lock like any request
+        task = asyncio.ensure_future(self._locked_upsert(pk, meta))
+        self.futures.append(task)
+        task.add_done_callback(self.futures.remove)
+
+    async def _locked_upsert(self, pk, meta):
+        async with self.server.dblock:
+            # The row may have been deleted while the trigger ran
+            if pk in self.server.db.rows:
+                self.server.db.upsert_meta(pk, meta)
 
 
     def connection_made(self, conn):
@@ -160,6 +217,15 @@ class TSDBProtocol(asyncio.Protocol):
         self.deserializer.append(data)
         if self.deserializer.ready():
             msg = self.deserializer.deserialize()
+            # The loop only keeps a weak reference to the task
+            task = asyncio.ensure_future(self._respond(msg))
+            self.futures.append(task)
+            task.add_done_callback(self.futures.remove)
+
+    async def _respond(self, msg):
+        # Requests to the database are handled one at a time, in order, even
+        # while one of them waits for the worker processes
+        async with self.server.dblock:
             status = TSDBStatus.OK  # until proven otherwise.
             response = TSDBOp_Return(status, None)  # until proven otherwise.
             try:
@@ -167,20 +233,26 @@ class TSDBProtocol(asyncio.Protocol):
                 if status is TSDBStatus.OK:
                     if isinstance(op, TSDBOp_InsertTS):
                         response = self._insert_ts(op)
+                    elif isinstance(op, TSDBOp_InsertMany):
+                        response = await self._insert_many(op)
                     elif isinstance(op, TSDBOp_DeleteTS):
                         response = self._delete_ts(op)
                     elif isinstance(op, TSDBOp_AddVP):
-                        response = self._add_vp(op)
+                        response = await self._add_vp(op)
+                    elif isinstance(op, TSDBOp_ChooseVPs):
+                        response = await self._choose_vps(op)
                     elif isinstance(op, TSDBOp_SimSearch):
-                        response = self._simsearch(op)
+                        response = await self._simsearch(op)
+                    elif isinstance(op, TSDBOp_RangeSearch):
+                        response = await self._range_search(op)
                     elif isinstance(op, TSDBOp_UpsertMeta):
                         response = self._upsert_meta(op)
                     elif isinstance(op, TSDBOp_Select):
                         response = self._select(op)
                     elif isinstance(op, TSDBOp_SimsearchSAX):
-                        response = self._sim_search_SAX(op)
+                        response = await self._sim_search_SAX(op)
                     elif isinstance(op, TSDBOp_AugmentedSelect):
-                        response = self._augmented_select(op)
+                        response = await self._augmented_select(op)
                     elif isinstance(op, TSDBOp_AddTrigger):
                         response = self._add_trigger(op)
                     elif isinstance(op, TSDBOp_RemoveTrigger):
@@ -189,19 +261,219 @@ class TSDBProtocol(asyncio.Protocol):
                         response = TSDBOp_Return(TSDBStatus.UNKNOWN_ERROR, op['op'])
             except TypeError as e:
                 response = TSDBOp_Return(TSDBStatus.INVALID_OPERATION, None)
-            print('S>response',response.to_json())
-            self.conn.write(serialize(response.to_json()))
-            self.conn.close()
+            self._reply(response)
+
+    def _reply(self, response):
+        print('S>response',response.to_json())
+        self.conn.write(serialize(response.to_json()))
+        self.conn.close()
 
     def connection_lost(self, transport):
         print('S> connection lost')
 
 
+def shard_of(pk, nshards):
+    "The shard holding pk, by crc32 since str hashes differ between processes"
+    return zlib.crc32(str(pk).encode()) % nshards
+
+def _sort_and_limit(additional):
+    "The sort direction and limit PersistentDB.select applies for additional"
+    sort, limit = 0, None
+    if additional is not None:
+        sort = {'+order': 1, '-order': -1}.get(additional.get('sort_by'), 0)
+        if len(additional) > 1 and 'limit' in additional:
+            limit = int(additional['limit'])
+    return sort, limit
+
+def _merge_rows(payloads, sort, limit):
+    "Merges the OrderedDicts returned by the shards for a select into one list of (pk, fields)"
+    rows = [(pk, fields) for payload in payloads for pk, fields in payload.items()]
+    if sort != 0:
+        # The key select sorts by on each shard, so their top rows merge into the global ones
+        rows.sort(key=lambda row: (row[1]['order']*sort if 'order' in row[1] else float('inf'), row[0]))
+    return rows[:limit]
+
+class TSDBCoordinatorProtocol(TSDBProtocol):
+    """
+    Serves a database hash-partitioned by pk between the shard servers on the
+    ports server.shards.  Writes are routed to the shard owning their pk,
+    while selects and searches are sent to every shard and their results
+    merged.  Each shard only sees its own rows, so a write to several shards
+    is not atomic and vantage points are chosen per shard: add_vp with a pk
+    is rejected, as the other shards could not measure their rows against it.
+    """
+
+    def data_received(self, data):
+        self.deserializer.append(data)
+        if self.deserializer.ready():
+            msg = self.deserializer.deserialize()
+            # The loop only keeps a weak reference to the task
+            task = asyncio.ensure_future(self._coordinate(msg))
+            self.futures.append(task)
+            task.add_done_callback(self.futures.remove)
+
+    async def _coordinate(self, msg):
+        try:
+            op = TSDBOp.from_json(msg)
+            if isinstance(op, (TSDBOp_InsertTS, TSDBOp_DeleteTS, TSDBOp_UpsertMeta)):
+                response = await self._route(msg)
+            elif isinstance(op, TSDBOp_AddVP):
+                if op['pk'] is None:
+                    response = await self._broadcast(msg)
+                else:
+                    response = TSDBOp_Return(TSDBStatus.INVALID_OPERATION, op['op'])
+            elif isinstance(op, TSDBOp_ChooseVPs):
+                response = await self._gather_choose_vps(msg)
+            elif isinstance(op, TSDBOp_InsertMany):
+                response = await self._scatter_insert_many(msg)
+            elif isinstance(op, (TSDBOp_SimSearch, TSDBOp_SimsearchSAX)):
+                response = await self._gather_nearest(msg)
+            elif isinstance(op, TSDBOp_RangeSearch):
+                response = await self._gather_range_search(msg)
+            elif isinstance(op, (TSDBOp_Select, TSDBOp_AugmentedSelect)) and list(op['md']) == [self.server.pkfield]:
+                # Other shards don't hold the row, and would fail the whole select
+                response = await self._route(msg, op['md'][self.server.pkfield])
+            elif isinstance(op, TSDBOp_Select):
+                response = await self._gather_select(msg)
+            elif isinstance(op, TSDBOp_AugmentedSelect):
+                response = await self._gather_augmented_select(msg)
+            elif isinstance(op, (TSDBOp_AddTrigger, TSDBOp_RemoveTrigger)):
+                response = await self._broadcast(msg)
+            else:
+                response = TSDBOp_Return(TSDBStatus.UNKNOWN_ERROR, op['op'])
+        except TypeError as e:
+            response = TSDBOp_Return(TSDBStatus.INVALID_OPERATION, None)
+        except (OSError, TSDBConnectionError) as e:
+            print('S> shard unreachable:', e)
+            response = TSDBOp_Return(TSDBStatus.UNKNOWN_ERROR, msg.get('op'))
+        self._reply(response)
+
+    async def _ask(self, shard, msg):
+        response = await request(msg, self.server.shards[shard])
+        return TSDBStatus(response['status']), response['payload']
+
+    async def _gather(self, msgs):
+        "Sends msgs[shard] to each shard in msgs, returning the first error status (or OK) and all payloads"
+        replies = await asyncio.gather(*(self._ask(shard, msg) for shard, msg in msgs.items()))
+        status = next((status for status, payload in replies if status != TSDBStatus.OK), TSDBStatus.OK)
+        return status, [payload for status, payload in replies]
+
+    def _everywhere(self, msg):
+        return {shard: msg for shard in range(len(self.server.shards))}
+
+    async def _route(self, msg, pk=None):
+        """ Sends msg to the shard owning pk (by default msg['pk']) only """
+        pk = msg['pk'] if pk is None else pk
+        status, payload = await self._ask(shard_of(pk, len(self.server.shards)), msg)
+        return TSDBOp_Return(status, msg['op'], payload)
+
+    async def _broadcast(self, msg):
+        status, payloads = await self._gather(self._everywhere(msg))
+        return TSDBOp_Return(status, msg['op'])
+
+    async def _scatter_insert_many(self, msg):
+        pks, tslist, metas = msg['pks'], msg['ts'], msg.get('metas')
+        if len(tslist) != len(pks) or (metas is not None and len(metas) != len(pks)):
+            return TSDBOp_Return(TSDBStatus.INVALID_KEY, msg['op'])
+        parts = {}
+        for i, pk in enumerate(pks):
+            part = parts.setdefault(shard_of(pk, len(self.server.shards)),
+                                    {'op': 'insert_many', 'pks': [], 'ts': [], 'metas': None if metas is None else []})
+            part['pks'].append(pk)
+            part['ts'].append(tslist[i])
+            if metas is not None:
+                part['metas'].append(metas[i])
+        status, payloads = await self._gather(parts)
+        return TSDBOp_Return(status, msg['op'])
+
+    async def _gather_choose_vps(self, msg):
+        # Every shard chooses its own; the shards are about equally large, so their fractions are averaged
+        status, payloads = await self._gather(self._everywhere(msg))
+        if status != TSDBStatus.OK:
+            return TSDBOp_Return(status, msg['op'])
+        vps = [vp for chosen, fraction in payloads for vp in chosen]
+        return TSDBOp_Return(status, msg['op'], [vps, sum(fraction for chosen, fraction in payloads)/len(payloads)])
+
+    async def _gather_nearest(self, msg):
+        # Every shard returns its own k nearest, with distances even when k is None
+        k = msg.get('k')
+        status, payloads = await self._gather(self._everywhere(dict(msg, k=1 if k is None else k)))
+        if status != TSDBStatus.OK:
+            return TSDBOp_Return(status, msg['op'])
+        nearest = heapq.nsmallest(1 if k is None else k, (tuple(match) for payload in payloads for match in payload),
+                                  key=lambda match: (match[1], match[0]))
+        if k is None:
+            return TSDBOp_Return(status, msg['op'], nearest[0][0] if nearest else None)
+        return TSDBOp_Return(status, msg['op'], nearest)
+
+    async def _gather_range_search(self, msg):
+        status, payloads = await self._gather(self._everywhere(msg))
+        if status != TSDBStatus.OK:
+            return TSDBOp_Return(status, msg['op'])
+        matches = sorted((tuple(match) for payload in payloads for match in payload), key=lambda match: (match[1], match[0]))
+        return TSDBOp_Return(status, msg['op'], matches)
+
+    async def _gather_select(self, msg):
+        sort, limit = _sort_and_limit(msg['additional'])
+        fields = msg['fields']
+        # The shards must return order for their rows to be merged by it
+        strip = sort != 0 and (fields is None or (len(fields) > 0 and 'order' not in fields))
+        shardfields = (fields or []) + ['order'] if strip else fields
+        status, payloads = await self._gather(self._everywhere(dict(msg, fields=shardfields)))
+        if status != TSDBStatus.OK:
+            return TSDBOp_Return(status, msg['op'])
+        rows = _merge_rows(payloads, sort, limit)
+        if strip:
+            rows = [(pk, {field: value for field, value in row.items() if field != 'order'}) for pk, row in rows]
+        return TSDBOp_Return(status, msg['op'], OrderedDict(rows))
+
+    async def _gather_augmented_select(self, msg):
+        sort, limit = _sort_and_limit(msg['additional'])
+        msgs = [self._gather(self._everywhere(msg))]
+        if sort != 0:
+            # The results carry only the targets, so the global order comes from a select alongside
+            select = {'op': 'select', 'md': msg['md'], 'fields': ['order'], 'additional': msg['additional']}
+            msgs.append(self._gather(self._everywhere(select)))
+        replies = await asyncio.gather(*msgs)
+        status = next((status for status, payloads in replies if status != TSDBStatus.OK), TSDBStatus.OK)
+        if status != TSDBStatus.OK:
+            return TSDBOp_Return(status, msg['op'])
+        results = {}
+        for payload in replies[0][1]:
+            results.update(payload)
+        if sort != 0:
+            pks = [pk for pk, row in _merge_rows(replies[1][1], sort, limit)]
+        else:
+            pks = list(results)[:limit]
+        return TSDBOp_Return(status, msg['op'], OrderedDict((pk, results[pk]) for pk in pks if pk in results))
+
+
 class TSDBServer(object):
 
-    def __init__(self, db, port=9999):
+    def __init__(self, db, port=9999, workers=0, shards=None, pkfield='pk'):
+        """
+        Serves db on port.  If workers is positive, a pool of that many
+        processes scores the candidates of simsearch and augmented_select.
+        If shards is a list of ports, db must be None and the server is
+        instead a coordinator for the shard servers listening on them,
+        whose databases have the primary key field pkfield.
+        """
+        if not isinstance(workers, int) or workers < 0:
+            raise ValueError("Number of workers must be a non-negative int")
+        if shards is not None:
+            if not isinstance(shards, list) or len(shards) == 0 or not all(isinstance(shard, int) for shard in shards):
+                raise ValueError("Shards must be a non-empty list of ports")
+            if db is not None or workers > 0:
+                raise ValueError("A coordinator has no database or workers of its own")
+        if not isinstance(pkfield, str):
+            raise ValueError("Primary key field must be of type str")
         self.port = port
         self.db = db
+        self.shards = shards
+        self.pkfield = pkfield if db is None else db.pkfield
+        if workers > 0:
+            self.db.workers = ScoringPool(workers)
+        self.dblock = asyncio.Lock()
         self.triggers = defaultdict(list)
         self.trigger_arg_cache = defaultdict(dict)
         self.autokeys = {}
@@ -216,7 +488,8 @@ class TSDBServer(object):
         #       currently it dumps the protocol and keeps going; new connections
         #       are unaffected. Rather nice, actually.
         #loop.set_exception_handler(self.exception_handler)
-        self.listener = loop.create_server(lambda: TSDBProtocol(self), '127.0.0.1', self.port)
+        protocol = TSDBProtocol if self.shards is None else TSDBCoordinatorProtocol
+        self.listener = loop.create_server(lambda: protocol(self), '127.0.0.1', self.port)
         print('S> Starting TSDB server on port',self.port)
         listener = loop.run_until_complete(self.listener)
         try:
@@ -228,6 +501,12 @@ class TSDBServer(object):
         finally:
             listener.close()
             loop.close()
+            if self.db is not None:
+                if self.db.workers is not None:
+                    self.db.workers.close()
+                    self.db.workers = None
+                # Write out log records still waiting for a group commit
+                self.db.close()
 
 
 if __name__=='__main__':
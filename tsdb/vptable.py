@@ -0,0 +1,131 @@
+import base64
+import numpy as np
+
+# Distances from every row of the database to every vantage point, kept as a
+# dense float64 array of shape rows x vps.  Rows are addressed by the row ids
+# shared with the bitmap indexes, and each vantage point's distances form one
+# contiguous column, so range predicates such as d_vp-<pk> <= r are a single
+# vectorized comparison instead of a walk over a per-vantage-point index.
+# Entries of rows without a distance (e.g. deleted rows) are NaN.
+
+
+def encode_column(column):
+    "Encode a column of distances as text, for a single log record"
+    return base64.b64encode(np.ascontiguousarray(column, dtype='<f8').tobytes()).decode()
+
+
+def decode_column(text):
+    "Inverse of encode_column"
+    return np.frombuffer(base64.b64decode(text), dtype='<f8').copy()
+
+
+class VPTable:
+    "Dense rows x vps array of vantage point distances, aligned to the database row ids"
+
+    def __init__(self, rowids):
+        """
+        Parameters
+        ----------
+        rowids : RowIds
+            The row ids of the database
+        Attributes
+        ----------
+        vps : list
+            The primary keys of the vantage points, in column order
+        """
+        self.rowids = rowids
+        self.vps = []
+        self._dists = np.full((0, 0), np.nan, order='F')
+
+    def __len__(self):
+        return len(self.vps)
+
+    def __contains__(self, vp):
+        return vp in self.vps
+
+    def __iter__(self):
+        return iter(self.vps)
+
+    def _reserve(self, nrows):
+        # Grow the row capacity geometrically, so appending rows is amortized O(1)
+        if nrows > self._dists.shape[0]:
+            dists = np.full((max(nrows, 2*self._dists.shape[0]), len(self.vps)), np.nan, order='F')
+            dists[:self._dists.shape[0]] = self._dists
+            self._dists = dists
+
+    def add_vp(self, vp, column=None):
+        """
+        Adds a column for vp.  column holds the distances of the rows with
+        row ids 0, 1, ..., len(column)-1 to vp; missing entries are NaN.
+        """
+        if vp in self.vps:
+            raise ValueError("This timeseries is already a vantage point")
+        self._reserve(len(self.rowids.pks))
+        dists = np.full((self._dists.shape[0], len(self.vps)+1), np.nan, order='F')
+        dists[:, :-1] = self._dists
+        if column is not None:
+            dists[:len(column), -1] = column
+        self._dists = dists
+        self.vps.append(vp)
+
+    def del_vp(self, vp):
+        j = self.vps.index(vp)
+        self._dists = np.asfortranarray(np.delete(self._dists, j, axis=1))
+        self.vps.remove(vp)
+
+    def column(self, vp):
+        "Return a view of the distances of all row ids to vp"
+        nrows = len(self.rowids.pks)
+        self._reserve(nrows)
+        return self._dists[:nrows, self.vps.index(vp)]
+
+    def remap(self, old):
+        "Renumber the rows after RowIds.compact, old holding the old row id of every new one"
+        self._reserve(int(old[-1])+1 if len(old) else 0)
+        self._dists = np.asfortranarray(self._dists[old])
+
+    def get(self, pk, vp):
+        rid = self.rowids[pk]
+        if rid >= self._dists.shape[0]:
+            return np.nan
+        return float(self._dists[rid, self.vps.index(vp)])
+
+    def set(self, pk, vp, dist):
+        rid = self.rowids[pk]
+        self._reserve(rid+1)
+        self._dists[rid, self.vps.index(vp)] = dist
+
+    def row(self, pk):
+        "Return the distances of pk as a dict keyed by vantage point"
+        return {vp:self.get(pk, vp) for vp in self.vps}
+
+    def clear(self, pk):
+        "Forget the distances of pk, before its row id is retired"
+        rid = self.rowids[pk]
+        if rid < self._dists.shape[0]:
+            self._dists[rid] = np.nan
+
+    def lower_bounds(self, qdists):
+        """
+        Given the distances qdists of a query to each vantage point, return
+        for every row id the largest |d(q,vp) - d(row,vp)| over the vantage
+        points, a lower bound on d(q,row) by the triangle inequality.  NaN 
+        for rows without distances.
+        """
+        nrows = len(self.rowids.pks)
+        self._reserve(nrows)
+        return np.abs(self._dists[:nrows] - np.asarray(qdists, dtype=float)).max(axis=1)
+
+    def mask(self, vp, op, key):
+        "Return a boolean array over row ids, True where op(distance, key) holds"
+        column = self.column(vp)
+        with np.errstate(invalid='ignore'):
+            return op(column, key) & ~np.isnan(column)
+
+    def bitmap(self, vp, op, key):
+        "Same as mask, packed into a bitmap as used by BitmapIndex"
+        return np.packbits(self.mask(vp, op, key), bitorder='little')
+
+    def lookup(self, vp, op, key):
+        pks = self.rowids.pks
+        return set(pks[rid] for rid in np.flatnonzero(self.mask(vp, op, key)).tolist())
@@ -0,0 +1,155 @@
+import os
+import time
+import struct
+import threading
+import zlib
+
+# Binary write-ahead log for PersistentDB.  The log starts with a header
+# (magic bytes and a 64-bit generation number) followed by framed records:
+#
+#     <payload length : uint32> <crc32 of payload : uint32> <payload>
+#
+# where the payload is the utf-8 encoding of pk, field and value separated by
+# NUL bytes.  Records are buffered in memory and written with a single write()
+# per group commit; a torn or corrupted final frame is discarded on replay.
+# With a commit interval, a timer writes out a pending group that no later
+# commit fills, so no record waits longer than the interval.
+
+MAGIC = b'TSDBWAL1'
+HEADER = struct.Struct('<8sQ')
+FRAME = struct.Struct('<II')
+
+
+class WriteAheadLog:
+    "Append-only framed binary log of (pk, field, value) records with group commit"
+
+    def __init__(self, filename, overwrite=False, commit_records=1, commit_ms=0, fsync=False, generation=0):
+        """
+        Parameters
+        ----------
+        filename : str
+            Name of the log file
+        overwrite : bool
+            Whether to start a new, empty log.  If False, the log must exist.
+        commit_records : int
+            A commit writes out buffered records once at least this many are pending
+        commit_ms : float
+            ... or once the oldest pending record has waited at least this long.
+            If 0, there is no time bound: records wait for commit_records
+            of them to be pending, or for flush()
+        fsync : bool
+            Whether every write is followed by os.fsync
+        generation : int
+            Generation number written to the header of a new log
+        """
+        self.filename = filename
+        self.commit_records = commit_records
+        self.commit_ms = commit_ms
+        self.fsync = fsync
+        self._buffer = []
+        self._first_pending = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._fd = None
+        # Records in this log, whether replayed, written or pending
+        self.records = 0
+        if overwrite:
+            self.generation = generation
+            self._fd = open(filename, 'wb')
+            self._fd.write(HEADER.pack(MAGIC, generation))
+            self._sync()
+            self._end = HEADER.size
+        else:
+            with open(filename, 'rb') as fd:
+                header = fd.read(HEADER.size)
+            if len(header) != HEADER.size or header[:8] != MAGIC:
+                raise IOError("{} is not a database log".format(filename))
+            self.generation = HEADER.unpack(header)[1]
+            self._end = None
+
+    @property
+    def pending(self):
+        "Number of records appended but not yet written"
+        return len(self._buffer)
+
+    def replay(self):
+        "Yield the (pk, field, value) records on file, stopping at the first invalid frame"
+        with open(self.filename, 'rb') as fd:
+            fd.seek(HEADER.size)
+            end = HEADER.size
+            while True:
+                head = fd.read(FRAME.size)
+                if len(head) < FRAME.size:
+                    break
+                length, crc = FRAME.unpack(head)
+                payload = fd.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                end += FRAME.size + length
+                self.records += 1
+                pk, field, val = payload.decode().split('\0', 2)
+                yield pk, field, val
+        self._end = end
+
+    def append(self, pk, field, value):
+        "Buffer one record; it is written by the next commit that fills the window"
+        payload = '\0'.join((pk, field, str(value))).encode()
+        with self._lock:
+            self._buffer.append(FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.records += 1
+            if self._first_pending is None:
+                self._first_pending = time.monotonic()
+                if self.commit_ms > 0:
+                    self._timer = threading.Timer(self.commit_ms/1000, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+    def commit(self, force=False):
+        """
+        Write out the buffered records if the group-commit window is full,
+        i.e. at least commit_records are pending or the oldest has waited
+        commit_ms milliseconds.  With force=True, write them regardless.
+        """
+        with self._lock:
+            if not self._buffer:
+                return
+            if not force and len(self._buffer) < self.commit_records and \
+               (self.commit_ms == 0 or (time.monotonic() - self._first_pending)*1000 < self.commit_ms):
+                return
+            fd = self._open()
+            fd.write(b''.join(self._buffer))
+            self._sync()
+            self._buffer = []
+            self._first_pending = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def flush(self):
+        self.commit(force=True)
+
+    def _open(self):
+        if self._fd is None:
+            if self._end is None:
+                replayed = self.records
+                for _ in self.replay():
+                    pass
+                self.records = replayed
+            # Drop a torn tail so that new frames follow the last valid one
+            if os.path.getsize(self.filename) > self._end:
+                with open(self.filename, 'r+b') as fd:
+                    fd.truncate(self._end)
+            self._fd = open(self.filename, 'ab')
+        return self._fd
+
+    def _sync(self):
+        self._fd.flush()
+        if self.fsync:
+            os.fsync(self._fd.fileno())
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
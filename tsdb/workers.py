@@ -0,0 +1,114 @@
+import os
+import asyncio
+from importlib import import_module
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import procs
+from procs.isax import stand_many
+from timeseries import TimeSeries
+from .segments import HEADER_LENGTH, DTYPE
+
+# An optional pool of worker processes scoring candidates in parallel.  The
+# series are not pickled to the workers: each worker memory-maps the
+# database's segment files itself, so only record numbers, the query and the
+# results cross process boundaries, and the records themselves are shared
+# through the page cache.  Segments are append-only and every append is
+# flushed, so a worker sees every record the database has written.
+# ScoringPool.map blocks until the workers are done, so the server calls the
+# database off its event loop; run_proc is awaited on the loop directly.
+
+# Fewer candidates than this are scored in the calling process, where the
+# round trip to the workers would cost more than it saves
+PARALLEL_MIN = 256
+
+# Mapped segment files of this worker, by filename, with their inode and the
+# file size they were mapped at.  A segment recreated under the same name 
+# gets a new inode, and a file shorter than its mapping was truncated, so 
+# either way it is remapped
+_maps = {}
+
+
+def _records(filename, shape, recnos):
+    "The records recnos of the segment file filename, of record shape shape"
+    stat = os.stat(filename)
+    mapped = _maps.get(filename)
+    if mapped is None or mapped[0] != stat.st_ino or mapped[1] > stat.st_size or mapped[2].shape[0] <= max(recnos):
+        nrecords = (stat.st_size - HEADER_LENGTH) // (int(np.prod(shape)) * DTYPE.itemsize)
+        mapped = (stat.st_ino, stat.st_size, np.memmap(filename, dtype=DTYPE, mode='r', offset=HEADER_LENGTH, shape=(nrecords,)+tuple(shape)))
+        _maps[filename] = mapped
+    return mapped[2][np.asarray(recnos, dtype=np.intp)]
+
+
+def unpack_spectra(records):
+    "Split records of a spectra segment into the standardized spectra and the self-kernels of their series"
+    packed = records[:,0,:] + 1j*records[:,1,:]
+    return packed[:,:-1], packed[:,-1]
+
+
+def corr_chunk(filename, shape, recnos, query):
+    "procs.corr_indb distances from query to the series whose spectra are the given records"
+    spectra, kernels = unpack_spectra(_records(filename, shape, recnos))
+    return procs.corr_many_prepared(query, spectra, kernels)
+
+
+def standardized_chunk(filename, shape, recnos, query):
+    "Euclidean distances from the standardized values query to the standardized series of the given records"
+    return np.linalg.norm(stand_many(_records(filename, shape, recnos)[:,1,:]) - query, axis=1)
+
+
+def proc_chunk(filename, shape, recnos, proc, pks, rows, arg):
+    "The results of procs.<proc>.proc_main for the given rows, whose series are the given records"
+    storedproc = getattr(import_module('procs.'+proc), 'proc_main')
+    results = []
+    for pk, row, record in zip(pks, rows, _records(filename, shape, recnos)):
+        row = dict(row, ts=TimeSeries(record[0], record[1]))
+        results.append(storedproc(pk, row, arg))
+    return results
+
+
+class ScoringPool:
+    "Worker processes scoring chunks of candidates read straight from segment files"
+
+    def __init__(self, processes):
+        """
+        Parameters
+        ----------
+        processes : int
+            The number of worker processes
+        """
+        if not isinstance(processes, int) or processes <= 0:
+            raise ValueError("Number of worker processes must be a positive int")
+        self.processes = processes
+        self._executor = ProcessPoolExecutor(processes)
+
+    def _chunks(self, n):
+        # One chunk per worker, unless that makes chunks too small to pay off
+        size = max(PARALLEL_MIN//4, -(-n//self.processes))
+        return [slice(start, start+size) for start in range(0, n, size)]
+
+    def map(self, fn, store, pks, *args):
+        """
+        Calls fn(filename, shape, recnos, *args) in the workers for chunks of
+        the record numbers of pks in store, and returns the results in order.
+        Blocks until all chunks are done.
+        """
+        recnos = [store.directory[pk] for pk in pks]
+        futures = [self._executor.submit(fn, store.filename, store.shape, recnos[chunk], *args)
+                   for chunk in self._chunks(len(recnos))]
+        return [future.result() for future in futures]
+
+    def dists(self, fn, store, pks, query):
+        "The distances computed by fn (corr_chunk or standardized_chunk) for pks, as one array"
+        if len(pks) == 0:
+            return np.empty(0)
+        return np.concatenate(self.map(fn, store, pks, query))
+
+    async def run_proc(self, proc, store, pks, rows, arg):
+        "procs.<proc>.proc_main(pk, row, arg) for every pk and row, the series being read from store"
+        recnos = [store.directory[pk] for pk in pks]
+        futures = [asyncio.wrap_future(self._executor.submit(proc_chunk, store.filename, store.shape, recnos[chunk], proc, pks[chunk], rows[chunk], arg))
+                   for chunk in self._chunks(len(pks))]
+        return [result for chunk in await asyncio.gather(*futures) for result in chunk]
+
+    def close(self):
+        self._executor.shutdown()